@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+"""Compare two results of benchmarks/loadtest.py
+
+Exits with status 1 if a metric got worse by more than the threshold.
+
+Usage: python benchmarks/compare.py [options] OLD.json NEW.json
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import optparse
+
+# (label, getter, whether more is better)
+METRICS = [
+    ('req/s', lambda s: s['throughput'], True),
+    ('p50 ms', lambda s: s['latency'] and s['latency']['p50'] * 1000, False),
+    ('p99 ms', lambda s: s['latency'] and s['latency']['p99'] * 1000, False),
+    ('ttfb p50 ms', lambda s: s['ttfb'] and s['ttfb']['p50'] * 1000, False),
+    ('ttfb p99 ms', lambda s: s['ttfb'] and s['ttfb']['p99'] * 1000, False),
+    ('cpu ms/req', lambda s: s['cpu_per_request'] is not None and s['cpu_per_request'] * 1000, False),
+    ('rss MiB', lambda s: s['peak_rss'] is not None and s['peak_rss'] / 1048576.0, False),
+    ('errors', lambda s: s['errors'], False),
+]
+
+def describe(report):
+    return '%s%s, Python %s, Tornado %s' % ((report['commit'] or 'unknown')[:10], ' (dirty)' if report['dirty'] else '',
+                                            report['python'], report['tornado'])
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] OLD.json NEW.json')
+    parser.add_option('-t', '--threshold', type='float', default=10, help='percent a metric may get worse [%default]')
+    opts, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('expected two result files')
+
+    with open(args[0]) as f:
+        old = json.load(f)
+    with open(args[1]) as f:
+        new = json.load(f)
+
+    print('old: %s' % describe(old))
+    print('new: %s' % describe(new))
+    for key in ('repository', 'concurrency', 'server_args', 'cpus'):
+        if old.get(key) != new.get(key):
+            print('warning: %s differs (%r vs. %r)' % (key, old.get(key), new.get(key)))
+
+    regressions = 0
+    print('%-20s %-12s %10s %10s %8s' % ('scenario', 'metric', 'old', 'new', 'change'))
+    for name in sorted(set(old['scenarios']) & set(new['scenarios'])):
+        for label, get, more_is_better in METRICS:
+            before, after = get(old['scenarios'][name]), get(new['scenarios'][name])
+            if before is None or after is None or before is False or after is False:
+                continue
+
+            change = (after - before) * 100.0 / before if before else (0 if after == before else float('inf'))
+            worse = -change if more_is_better else change
+            flag = ''
+            if worse > opts.threshold:
+                flag = '  <-- worse'
+                regressions += 1
+            print('%-20s %-12s %10.2f %10.2f %+7.1f%%%s' % (name, label, before, after, change, flag))
+
+    if regressions:
+        print('%d metrics got worse by more than %g%%' % (regressions, opts.threshold))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
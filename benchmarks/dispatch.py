@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+"""Per request overhead of classifying dumb protocol requests in FileHandler
+
+Run from the repository root: python benchmarks/dispatch.py
+"""
+
+import os
+import sys
+import timeit
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gittornado import get_file_headers, get_etag
+from gittornado.util import get_date_header
+
+PATHS = [
+    '/group/project.git/HEAD',
+    '/group/project.git/objects/info/packs',
+    '/group/project.git/objects/info/alternates',
+    '/group/project.git/objects/3f/' + 'a' * 38,
+    '/group/project.git/objects/pack/pack-' + 'b' * 40 + '.idx',
+    '/group/project.git/objects/pack/pack-' + 'b' * 40 + '.pack',
+    '/group/project.git/objects/zz/not-an-object',
+]
+
+def classify():
+    for path in PATHS:
+        get_file_headers(path)
+
+def etag():
+    for path in PATHS:
+        get_etag(path)
+
+def date():
+    for path in PATHS:
+        get_date_header()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--number', type='int', default=20000, help='iterations per run')
+    parser.add_option('-r', '--repeat', type='int', default=5, help='runs, the fastest one counts')
+    opts, args = parser.parse_args()
+
+    for name, func in [('get_file_headers', classify), ('get_etag', etag), ('get_date_header', date)]:
+        best = min(timeit.repeat(func, number=opts.number, repeat=opts.repeat))
+        print('%-20s %6.2f us per request' % (name, best / opts.number / len(PATHS) * 1e6))
+
+if __name__ == '__main__':
+    main()
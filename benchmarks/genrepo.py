@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+"""Generate a synthetic bare repository for benchmarks
+
+The content only depends on the parameters, so results of runs against
+repositories generated with the same parameters are comparable.
+
+Usage: python benchmarks/genrepo.py [options] PATH
+"""
+
+import os
+import hashlib
+import optparse
+import subprocess
+
+WORDS = [b'tornado', b'git', b'pack', b'object', b'delta', b'commit', b'tree', b'blob', b'ref', b'http']
+
+def _content(seed, size, compressible):
+    """Deterministic file content"""
+    chunks, total, counter = [], 0, 0
+    while total < size:
+        digest = hashlib.sha256(b'%d:%d' % (seed, counter)).digest()
+        if compressible:
+            digest = b' '.join(WORDS[ord(digest[i:i + 1]) % len(WORDS)] for i in range(8)) + b'\n'
+        chunks.append(digest)
+        total += len(digest)
+        counter += 1
+    return b''.join(chunks)[:size]
+
+def generate(path, commits=100, files=20, changes=5, blob_size=4096, branches=10, tags=10, loose=50, compressible=False):
+    """Create a bare repository at path
+
+    :param commits: number of commits on master
+    :param files: number of files in the tree
+    :param changes: number of files changed by every commit
+    :param blob_size: size of every file in bytes
+    :param branches: number of additional branches, spread over the history
+    :param tags: number of tags, spread over the history
+    :param loose: number of loose objects, for the dumb protocol
+    :param compressible: generate text instead of random bytes
+    """
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    fast_import = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+    out = fast_import.stdin
+
+    mark = 0
+    commit_marks = []
+    for commit in range(commits):
+        changed = range(files) if commit == 0 else [(commit * changes + i) % files for i in range(changes)]
+        modifications = []
+        for f in changed:
+            mark += 1
+            data = _content(commit * files + f, blob_size, compressible)
+            out.write(b'blob\nmark :%d\ndata %d\n%s\n' % (mark, len(data), data))
+            modifications.append(b'M 100644 :%d dir%d/file%d\n' % (mark, f % 10, f))
+
+        mark += 1
+        commit_marks.append(mark)
+        message = b'Commit %d\n' % commit
+        timestamp = 1300000000 + commit * 60
+        out.write(b'commit refs/heads/master\nmark :%d\n' % mark +
+                  b'author Bench <bench@example.com> %d +0000\n' % timestamp +
+                  b'committer Bench <bench@example.com> %d +0000\n' % timestamp +
+                  b'data %d\n%s' % (len(message), message))
+        if commit > 0:
+            out.write(b'from :%d\n' % commit_marks[-2])
+        out.write(b''.join(modifications) + b'\n')
+
+    for i in range(branches):
+        out.write(b'reset refs/heads/branch-%d\nfrom :%d\n\n' % (i, commit_marks[i * commits // branches]))
+    for i in range(tags):
+        out.write(b'reset refs/tags/v%d\nfrom :%d\n\n' % (i, commit_marks[i * commits // tags]))
+
+    out.close()
+    if fast_import.wait() != 0:
+        raise RuntimeError('git fast-import failed')
+
+    for i in range(loose):
+        hash_object = subprocess.Popen(['git', 'hash-object', '-w', '--stdin'], cwd=path, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        hash_object.communicate(_content(-1 - i, blob_size, compressible))
+
+    # for dumb clients
+    subprocess.check_call(['git', 'update-server-info'], cwd=path)
+
+def loose_objects(path):
+    """Paths of the loose objects of a repository, relative to it"""
+    found = []
+    objects = os.path.join(path, 'objects')
+    for name in sorted(os.listdir(objects)):
+        if len(name) == 2:
+            found.extend('objects/%s/%s' % (name, obj) for obj in sorted(os.listdir(os.path.join(objects, name))))
+    return found
+
+def add_options(parser):
+    parser.add_option('--commits', type='int', default=100, help='number of commits [%default]')
+    parser.add_option('--files', type='int', default=20, help='number of files in the tree [%default]')
+    parser.add_option('--changes', type='int', default=5, help='files changed per commit [%default]')
+    parser.add_option('--blob-size', type='int', default=4096, help='size of every file [%default]')
+    parser.add_option('--branches', type='int', default=10, help='number of branches [%default]')
+    parser.add_option('--tags', type='int', default=10, help='number of tags [%default]')
+    parser.add_option('--loose', type='int', default=50, help='number of loose objects [%default]')
+    parser.add_option('--compressible', action='store_true', default=False, help='text instead of random content')
+
+def get_params(opts):
+    return {'commits': opts.commits, 'files': opts.files, 'changes': opts.changes, 'blob_size': opts.blob_size,
+            'branches': opts.branches, 'tags': opts.tags, 'loose': opts.loose, 'compressible': opts.compressible}
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] PATH')
+    add_options(parser)
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected the path of the repository')
+    if os.path.exists(args[0]):
+        parser.error('%s exists already' % args[0])
+    generate(args[0], **get_params(opts))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+"""Load test gittornado.server with git clients and raw HTTP requests
+
+Generates a repository, starts gittornado.server from this checkout on it and
+runs every scenario with the given concurrency. Reports throughput, latency,
+time to first byte and the CPU time and peak memory of the server including its
+git processes, and writes the results as JSON for benchmarks/compare.py.
+
+Usage: python benchmarks/loadtest.py [options] [SCENARIO...]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import socket
+import tempfile
+import optparse
+import platform
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import genrepo
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+REPO = 'bench.git'
+# a copy of REPO receiving the pushes, so they don't change the other scenarios
+PUSH_REPO = 'push.git'
+USER = 'bench'
+
+# push last, it takes the longest to set up
+SCENARIOS = ['info-refs', 'info-refs-dumb', 'upload-pack', 'upload-pack-gzip', 'upload-pack-chunked', 'upload-pack-http10',
+             'head', 'loose-object', 'pack', 'clone', 'fetch', 'push']
+GIT_SCENARIOS = ['clone', 'fetch', 'push']
+
+def pkt_line(data):
+    return b'%04x' % (len(data) + 4) + data
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def percentile(values, p):
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+class Server(object):
+    """gittornado.server from this checkout running in the background"""
+
+    def __init__(self, python, gitbase, accessfile, args, log):
+        self.port = get_free_port()
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.abspath(ROOT)] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+        command = [python, '-c', 'from gittornado.server import main; main()',
+                   '--port=%d' % self.port, '--gitbase=%s' % gitbase, '--accessfile=%s' % accessfile] + args
+        self.process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+        deadline = time.time() + 30
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError('server exited with %d, see its log' % self.process.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise RuntimeError('server did not start listening')
+                time.sleep(0.1)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait()
+        except KeyboardInterrupt:
+            self.process.kill()
+
+class ResourceSampler(threading.Thread):
+    """Samples memory and CPU time of a process and its descendants from /proc"""
+
+    def __init__(self, pid, interval=0.05):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.available = os.path.exists('/proc/%d/stat' % pid)
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if self.available else 0
+        self.ticks = float(os.sysconf('SC_CLK_TCK')) if self.available else 1
+        self.stopped = False
+        self.reset()
+
+    def reset(self):
+        self.peak_rss = 0
+        self.peak_rss_total = 0
+
+    def run(self):
+        while self.available and not self.stopped:
+            pids = self._tree()
+            rss = [self._rss(pid) for pid in pids]
+            self.peak_rss = max(self.peak_rss, rss[0])
+            self.peak_rss_total = max(self.peak_rss_total, sum(rss))
+            time.sleep(self.interval)
+
+    def cpu_time(self):
+        """CPU seconds used by the process and its descendants, including those that exited"""
+        if not self.available:
+            return None
+        total = 0
+        for pid in self._tree():
+            fields = self._stat(pid)
+            if fields is not None:
+                # utime, stime, cutime, cstime
+                total += sum(int(value) for value in fields[11:15])
+        return total / self.ticks
+
+    def _stat(self, pid):
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                # the command may contain spaces
+                return f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError, IndexError):
+            return None
+
+    def _rss(self, pid):
+        try:
+            with open('/proc/%d/statm' % pid) as f:
+                return int(f.read().split()[1]) * self.page_size
+        except (IOError, OSError, IndexError):
+            return 0
+
+    def _tree(self):
+        children = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                fields = self._stat(int(name))
+                if fields is not None:
+                    children.setdefault(int(fields[1]), []).append(int(name))
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending.extend(children.get(pid, []))
+        return pids
+
+def http_request(port, method, path, headers=(), body=None, chunk_size=None, http10=False, timeout=300):
+    """Send a request on a new connection and read the whole response"""
+    start = time.time()
+    sock = socket.create_connection(('127.0.0.1', port), timeout)
+    try:
+        lines = [b'%s %s HTTP/%s' % (method.encode(), path.encode(), b'1.0' if http10 else b'1.1'), b'Host: 127.0.0.1']
+        if not http10:
+            lines.append(b'Connection: close')
+        lines.extend(b'%s: %s' % (name.encode(), value.encode()) for name, value in headers)
+        if body is not None and chunk_size:
+            lines.append(b'Transfer-Encoding: chunked')
+        elif body is not None:
+            lines.append(b'Content-Length: %d' % len(body))
+        sock.sendall(b'\r\n'.join(lines) + b'\r\n\r\n')
+
+        if body is not None and chunk_size:
+            for offset in range(0, len(body), chunk_size):
+                chunk = body[offset:offset + chunk_size]
+                sock.sendall(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            sock.sendall(b'0\r\n\r\n')
+        elif body is not None:
+            sock.sendall(body)
+
+        # the server closes the connection after the response
+        ttfb = None
+        received = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            if ttfb is None:
+                ttfb = time.time() - start
+            received.append(data)
+    finally:
+        sock.close()
+
+    response = b''.join(received)
+    head, _, content = response.partition(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1]) if head.startswith(b'HTTP/') else None
+    return {'ok': status == 200, 'latency': time.time() - start, 'ttfb': ttfb, 'bytes': len(content),
+            'error': None if status == 200 else 'status %s' % status}
+
+def run_git(args, cwd=None):
+    start = time.time()
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    process = subprocess.Popen(['git'] + args, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    error = None
+    if process.returncode != 0:
+        error = err.decode('utf-8', 'replace').strip() or 'exit code %d' % process.returncode
+    return {'ok': process.returncode == 0, 'latency': time.time() - start, 'ttfb': None, 'bytes': None, 'error': error}
+
+class Scenarios(object):
+    """The requests of every scenario, called with the number of the request"""
+
+    def __init__(self, repo, workdir, port):
+        self.repo = repo
+        self.workdir = workdir
+        self.port = port
+        self.url = 'http://127.0.0.1:%d/%s' % (port, REPO)
+        self.push_url = 'http://%s:%s@127.0.0.1:%d/%s' % (USER, USER, port, PUSH_REPO)
+        self.push_repo = os.path.join(os.path.dirname(repo), PUSH_REPO)
+
+        refs = subprocess.check_output(['git', 'for-each-ref', '--format=%(objectname)'], cwd=repo).split()
+        wants = sorted(set(refs))
+        lines = [pkt_line(b'want ' + wants[0] + b' multi_ack_detailed side-band-64k thin-pack no-progress ofs-delta\n')]
+        lines.extend(pkt_line(b'want ' + want + b'\n') for want in wants[1:])
+        self.clone_request = b''.join(lines) + b'0000' + pkt_line(b'done\n')
+
+        self.loose = genrepo.loose_objects(repo)
+        packs = [name for name in os.listdir(os.path.join(repo, 'objects', 'pack')) if name.endswith('.pack')]
+        self.pack_file = max(packs, key=lambda name: os.path.getsize(os.path.join(repo, 'objects', 'pack', name)))
+
+    def get(self, name):
+        return getattr(self, name.replace('-', '_'))
+
+    def info_refs(self, i):
+        return http_request(self.port, 'GET', '/%s/info/refs?service=git-upload-pack' % REPO)
+
+    def info_refs_dumb(self, i):
+        return http_request(self.port, 'GET', '/%s/info/refs' % REPO)
+
+    def _upload_pack(self, headers=(), **kwargs):
+        headers = [('Content-Type', 'application/x-git-upload-pack-request')] + list(headers)
+        return http_request(self.port, 'POST', '/%s/git-upload-pack' % REPO, headers, **kwargs)
+
+    def upload_pack(self, i):
+        return self._upload_pack(body=self.clone_request)
+
+    def upload_pack_gzip(self, i):
+        if not hasattr(self, 'clone_request_gzip'):
+            path = os.path.join(self.workdir, 'request.gz')
+            with gzip.open(path, 'wb') as f:
+                f.write(self.clone_request)
+            with open(path, 'rb') as f:
+                self.clone_request_gzip = f.read()
+        return self._upload_pack([('Content-Encoding', 'gzip'), ('Accept-Encoding', 'gzip')], body=self.clone_request_gzip)
+
+    def upload_pack_chunked(self, i):
+        return self._upload_pack(body=self.clone_request, chunk_size=1024)
+
+    def upload_pack_http10(self, i):
+        return self._upload_pack(body=self.clone_request, http10=True)
+
+    def head(self, i):
+        return http_request(self.port, 'GET', '/%s/HEAD' % REPO)
+
+    def loose_object(self, i):
+        if not self.loose:
+            return {'ok': False, 'latency': 0, 'ttfb': None, 'bytes': None, 'error': 'no loose objects'}
+        return http_request(self.port, 'GET', '/%s/%s' % (REPO, self.loose[i % len(self.loose)]))
+
+    def pack(self, i):
+        return http_request(self.port, 'GET', '/%s/objects/pack/%s' % (REPO, self.pack_file))
+
+    def clone(self, i):
+        target = os.path.join(self.workdir, 'clone-%d' % i)
+        try:
+            return run_git(['clone', '-q', '--bare', self.url, target])
+        finally:
+            shutil.rmtree(target, ignore_errors=True)
+
+    def fetch(self, i):
+        # fetch master into a repository borrowing the older history of the last branch
+        base = os.path.join(self.workdir, 'fetch-base')
+        if not os.path.exists(base):
+            branches = subprocess.check_output(['git', 'for-each-ref', '--format=%(refname:short)', 'refs/heads/branch-*'], cwd=self.repo).split()
+            branch = sorted(branches, key=lambda name: int(name.split(b'-')[1]))[-1].decode() if branches else 'master'
+            subprocess.check_call(['git', 'clone', '-q', '--bare', '--single-branch', '-b', branch, self.repo, base])
+
+        target = os.path.join(self.workdir, 'fetch-%d' % i)
+        try:
+            subprocess.check_call(['git', 'init', '-q', '--bare', target])
+            with open(os.path.join(target, 'objects', 'info', 'alternates'), 'w') as f:
+                f.write(os.path.join(os.path.abspath(base), 'objects') + '\n')
+            return run_git(['fetch', '-q', self.url, 'refs/heads/master:refs/heads/master'], cwd=target)
+        finally:
+            shutil.rmtree(target, ignore_errors=True)
+
+    def push(self, i):
+        # a new commit with a new file on top of master, built without a work tree
+        base = os.path.join(self.workdir, 'push-base')
+        if not os.path.exists(base):
+            subprocess.check_call(['git', 'clone', '-q', '--bare', self.repo, base])
+            subprocess.check_call(['git', 'clone', '-q', '--bare', self.repo, self.push_repo])
+
+        size = int(subprocess.check_output(['git', 'cat-file', '-s', 'master:dir0/file0'], cwd=base))
+        blob = subprocess.Popen(['git', 'hash-object', '-w', '--stdin'], cwd=base, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        blob = blob.communicate(genrepo._content(10 ** 6 + i, size, False))[0].strip()
+        tree = subprocess.Popen(['git', 'mktree'], cwd=base, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        tree = tree.communicate(b'100644 blob ' + blob + b'\tpushed-' + str(i).encode() + b'\n')[0].strip()
+        env = dict(os.environ, GIT_AUTHOR_NAME='Bench', GIT_AUTHOR_EMAIL='bench@example.com',
+                   GIT_COMMITTER_NAME='Bench', GIT_COMMITTER_EMAIL='bench@example.com')
+        commit = subprocess.Popen(['git', 'commit-tree', tree.decode(), '-p', 'master', '-m', 'push %d' % i],
+                                  cwd=base, env=env, stdout=subprocess.PIPE).communicate()[0].strip().decode()
+
+        return run_git(['push', '-q', self.push_url, '%s:refs/heads/bench/%d' % (commit, i)], cwd=base)
+
+    def cleanup(self):
+        for name in ('fetch-base', 'push-base'):
+            shutil.rmtree(os.path.join(self.workdir, name), ignore_errors=True)
+        shutil.rmtree(self.push_repo, ignore_errors=True)
+
+def run_load(func, requests, concurrency):
+    results = []
+    lock = threading.Lock()
+    counter = [0]
+
+    def worker():
+        while True:
+            with lock:
+                i = counter[0]
+                counter[0] += 1
+            if i >= requests:
+                return
+            try:
+                result = func(i)
+            except Exception as e:
+                result = {'ok': False, 'latency': None, 'ttfb': None, 'bytes': None, 'error': repr(e)}
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def summarize(results, wall_time, cpu_time, sampler):
+    ok = [result for result in results if result['ok']]
+
+    def distribution(key):
+        values = sorted(result[key] for result in ok if result[key] is not None)
+        if not values:
+            return None
+        return {'p50': percentile(values, 50), 'p99': percentile(values, 99),
+                'mean': sum(values) / len(values), 'max': values[-1]}
+
+    sizes = [result['bytes'] for result in ok if result['bytes'] is not None]
+    errors = [result['error'] for result in results if not result['ok']]
+    return {'requests': len(results),
+            'errors': len(errors),
+            'first_error': errors[0] if errors else None,
+            'wall_time': wall_time,
+            'throughput': len(ok) / wall_time if wall_time else None,
+            'latency': distribution('latency'),
+            'ttfb': distribution('ttfb'),
+            'bytes_per_request': sum(sizes) / len(sizes) if sizes else None,
+            'cpu_per_request': cpu_time / len(results) if cpu_time is not None and results else None,
+            'peak_rss': sampler.peak_rss if sampler.available else None,
+            'peak_rss_total': sampler.peak_rss_total if sampler.available else None}
+
+def describe_checkout():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip().decode()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def format_ms(value):
+    return '%8.1f' % (value * 1000) if value is not None else '%8s' % '-'
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [SCENARIO...]')
+    parser.add_option('-c', '--concurrency', type='int', default=8, help='concurrent clients [%default]')
+    parser.add_option('-n', '--requests', type='int', default=100, help='requests per scenario [%default]')
+    parser.add_option('--git-requests', type='int', default=20, help='requests per clone, fetch and push scenario [%default]')
+    parser.add_option('--warmup', type='int', default=1, help='unmeasured requests before every scenario [%default]')
+    parser.add_option('--python', default=sys.executable, help='interpreter running the server [%default]')
+    parser.add_option('--server-arg', action='append', default=[], metavar='ARG',
+                      help='pass ARG to gittornado.server, e.g. --server-arg=--gzip')
+    parser.add_option('--workdir', help='where to put the repository and clones, a temporary directory by default')
+    parser.add_option('--keep', action='store_true', default=False, help="don't remove the temporary directory")
+    parser.add_option('-o', '--output', help='write the results as JSON to this file')
+    parser.add_option('--list', action='store_true', default=False, help='list the scenarios')
+    option_group = optparse.OptionGroup(parser, 'Repository')
+    genrepo.add_options(option_group)
+    parser.add_option_group(option_group)
+    opts, scenario_names = parser.parse_args()
+
+    if opts.list:
+        print('\n'.join(SCENARIOS))
+        return
+    for name in scenario_names:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario %s' % name)
+
+    workdir = opts.workdir or tempfile.mkdtemp(prefix='gittornado-bench-')
+    gitbase = os.path.join(workdir, 'repos')
+    repo = os.path.join(gitbase, REPO)
+    params = genrepo.get_params(opts)
+
+    # the repository is reused if it was generated with the same parameters
+    params_file = os.path.join(workdir, 'repo-params.json')
+    if os.path.exists(repo):
+        with open(params_file) as f:
+            if json.load(f) != params:
+                parser.error('%s was generated with other parameters' % repo)
+    else:
+        print('Generating repository in %s' % repo)
+        os.makedirs(gitbase)
+        genrepo.generate(repo, **params)
+        with open(params_file, 'w') as f:
+            json.dump(params, f)
+
+    accessfile = os.path.join(workdir, 'access.ini')
+    with open(accessfile, 'w') as f:
+        f.write('[users]\n%s = %s\n[access]\n%s = %s\n' % (USER, USER, USER, PUSH_REPO))
+
+    with open(os.path.join(workdir, 'server.log'), 'ab') as log:
+        server = Server(opts.python, gitbase, accessfile, opts.server_arg, log)
+    sampler = ResourceSampler(server.process.pid)
+    sampler.start()
+    scenarios = Scenarios(repo, workdir, server.port)
+
+    commit, dirty = describe_checkout()
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'commit': commit,
+              'dirty': dirty,
+              'python': subprocess.check_output([opts.python, '-c', 'import platform; print(platform.python_version())']).strip().decode(),
+              'tornado': subprocess.check_output([opts.python, '-c', 'import tornado; print(tornado.version)']).strip().decode(),
+              'platform': platform.platform(),
+              'cpus': os.sysconf('SC_NPROCESSORS_ONLN') if hasattr(os, 'sysconf') else None,
+              'repository': params,
+              'concurrency': opts.concurrency,
+              'server_args': opts.server_arg,
+              'scenarios': {}}
+
+    try:
+        print('%-20s %8s %8s %8s %8s %8s %8s %9s %6s' % ('scenario', 'req/s', 'p50 ms', 'p99 ms', 'ttfb p50', 'ttfb p99', 'cpu ms', 'rss MiB', 'errors'))
+        for name in scenario_names or SCENARIOS:
+            func = scenarios.get(name)
+            requests = opts.git_requests if name in GIT_SCENARIOS else opts.requests
+            run_load(func, opts.warmup, 1)
+
+            sampler.reset()
+            cpu_before = sampler.cpu_time()
+            start = time.time()
+            results = run_load(func, requests, opts.concurrency)
+            wall_time = time.time() - start
+            # wait for git processes finishing after the response
+            time.sleep(sampler.interval * 2)
+            cpu_time = sampler.cpu_time() - cpu_before if cpu_before is not None else None
+
+            summary = report['scenarios'][name] = summarize(results, wall_time, cpu_time, sampler)
+            latency, ttfb = summary['latency'] or {}, summary['ttfb'] or {}
+            print('%-20s %8.1f %s %s %s %s %s %9s %6d' % (
+                  name, summary['throughput'] or 0, format_ms(latency.get('p50')), format_ms(latency.get('p99')),
+                  format_ms(ttfb.get('p50')), format_ms(ttfb.get('p99')), format_ms(summary['cpu_per_request']),
+                  '%.1f' % (summary['peak_rss'] / 1048576.0) if summary['peak_rss'] is not None else '-', summary['errors']))
+            if summary['first_error']:
+                print('    first error: %s' % summary['first_error'][:200])
+    finally:
+        sampler.stopped = True
+        server.stop()
+        scenarios.cleanup()
+        if not opts.workdir and not opts.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Results written to %s' % opts.output)
+
+if __name__ == '__main__':
+    main()
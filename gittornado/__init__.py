@@ -19,18 +19,22 @@
 
 import urlparse
 import re
+import zlib
+import os
 import os.path
-import datetime
+import math
+import time
 
 import tornado.web
+import tornado.ioloop
 
-from gittornado.iowrapper import ProcessWrapper, FileWrapper
-from gittornado.util import get_date_header
+from gittornado.iowrapper import ProcessWrapper, FileWrapper, BufferWrapper, GzipOutput
+from gittornado.util import accepts_gzip, get_date_header, get_http_date, get_request_body, get_git_protocol, get_protocol_version, pkt_line
 
 import logging
 logger = logging.getLogger(__name__)
 
-cache_forever = lambda: [('Expires', get_date_header(datetime.datetime.now() + datetime.timedelta(days=365))),
+cache_forever = lambda: [('Expires', get_http_date(365 * 24 * 3600)),
                  ('Pragma', 'no-cache'),
                  ('Cache-Control', 'public, max-age=31556926')]
 
@@ -38,15 +42,54 @@ dont_cache = lambda: [('Expires', 'Fri, 01 Jan 1980 00:00:00 GMT'),
               ('Pragma', 'no-cache'),
               ('Cache-Control', 'no-cache, max-age=0, must-revalidate')]
 
+def get_advertisement_prelude(rpc):
+    """The service announcement smart clients expect in front of the ref advertisement"""
+    return pkt_line('# service=git-' + rpc) + '0000' # packet flush
+
+# largest ls-refs request answered by RPCHandler itself
+MAX_LS_REFS_REQUEST = 64 * 1024
+
 class BaseHandler(tornado.web.RequestHandler):
     auth = None
     auth_failed = None
     gitlookup = None
     gitcommand = None
+    scheduler = None
+    # gittornado.flight.SingleFlight to run only one process for identical requests
+    single_flight = None
+    # gittornado.metrics.Metrics to record requests in
+    metrics = None
+    # gittornado.refs.RefIndex to list refs without running git
+    ref_index = None
+    # gittornado.maintenance.MaintenanceScheduler to be told about pushes
+    maintenance = None
+    # gittornado.spawner.Spawner to start git processes with
+    spawner = None
+    # gittornado.ratelimit.RateLimiter limiting requests and bandwidth
+    rate_limiter = None
+    # gittornado.ratelimit.Throttle pacing the response of this request
+    throttle = None
+    # gittornado.packhook.PackObjectsCache for upload-pack to reuse packs from
+    pack_objects_cache = None
+    # gittornado.accesslog.AccessLog to log requests in
+    access_log = None
+    # gittornado.accesslog.AccessEntry of this request
+    access = None
+    # name of the user auth verified the credentials of, see get_user
+    user = None
 
     public_readble = True
     public_writable = False
 
+    # how FileWrapper sends files, see FileHandler
+    use_sendfile = None
+    file_chunk_size = None
+
+    # gzip compression of responses of RPCHandler and InfoRefsHandler
+    gzip_output = None
+    gzip_level = None
+    gzip_min_size = None
+
     def initialize(self, **kwargs):
         for name, value in kwargs.items():
             if hasattr(self, name) and getattr(self, name) is None:
@@ -55,6 +98,23 @@ class BaseHandler(tornado.web.RequestHandler):
         # set defaults
         if self.gitcommand is None:
             self.gitcommand = 'git'
+        if self.use_sendfile is None:
+            self.use_sendfile = False
+        if self.file_chunk_size is None:
+            self.file_chunk_size = 8192
+        if self.gzip_level is None:
+            self.gzip_level = 6
+        if self.gzip_min_size is None:
+            self.gzip_min_size = 1024
+
+        if self.metrics is not None:
+            self.request = self.metrics.track(self.request, self.get_service())
+        if self.access_log is not None:
+            self.access = self.access_log.entry(self.request, self.get_service())
+
+    def get_service(self):
+        """Name of the service for metrics"""
+        return 'other'
 
     def get_gitdir(self):
         """Determine the git repository for this request"""
@@ -65,9 +125,91 @@ class BaseHandler(tornado.web.RequestHandler):
         if gitdir is None:
             raise tornado.web.HTTPError(404, 'unable to find repository')
         logger.debug("Accessing git at: %s", gitdir)
+        if self.access is not None:
+            self.access.repo = gitdir
+            self.access.mark('lookup')
 
         return gitdir
 
+    def get_gzip_output(self, skip_input_suffixes=()):
+        """Get the GzipOutput for this request or None if the response should not be compressed"""
+        if not self.gzip_output or not accepts_gzip(self.request):
+            return None
+        return GzipOutput(self.gzip_level, self.gzip_min_size, skip_input_suffixes)
+
+    def get_git_protocol(self):
+        """Get the Git-Protocol header of the request if it is valid or None"""
+        protocol = get_git_protocol(self.request)
+        if protocol is None and 'Git-Protocol' in self.request.headers:
+            logger.debug("Ignoring invalid Git-Protocol header %r", self.request.headers['Git-Protocol'])
+        return protocol
+
+    def get_git_env(self):
+        """Get the environment for git processes, passing the Git-Protocol header on as GIT_PROTOCOL"""
+        protocol = self.get_git_protocol()
+        if protocol is None:
+            return None
+        env = dict(os.environ)
+        env['GIT_PROTOCOL'] = protocol
+        return env
+
+    def get_user(self):
+        """Name of the user the client authenticated as or None
+
+        Only auth with a check method (like gittornado.auth.CachingAuth) tells who
+        it verified, the user name of the Authorization header alone proves nothing.
+        """
+        return self.user
+
+    def get_rpc_command(self, rpc, gitdir):
+        """Get the command line of git answering a stateless RPC request"""
+        command = [self.gitcommand]
+        if rpc == 'upload-pack' and self.pack_objects_cache is not None:
+            command += self.pack_objects_cache.get_config()
+        return command + [rpc, '--stateless-rpc', gitdir]
+
+    def get_client_id(self):
+        """Identify the client for fair queueing, by the verified user or else its address"""
+        user = self.get_user()
+        if user is not None:
+            return 'user:' + user
+        return 'ip:' + self.request.remote_ip
+
+    def run_process(self, service, gitdir, start):
+        """Call start as soon as the scheduler allows to run a git process for service
+
+        start gets a finish callback that has to be passed on to ProcessWrapper.
+        """
+        if self.scheduler is None:
+            start(None)
+            return
+
+        def on_start(ticket):
+            if self.request.connection.stream.closed():
+                logger.debug("Client went away while waiting")
+                ticket.release()
+                if self.access is not None:
+                    self.access.finish()
+                return
+            start(lambda retval: ticket.release())
+
+        def on_timeout():
+            msg = 'Too many requests, please try again later'
+            self.send_response('HTTP/1.1 503 Service Unavailable\r\nDate: %s\r\nRetry-After: %d\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n%s' % (
+                               get_date_header(), self.scheduler.retry_after, len(msg), msg))
+
+        def on_close():
+            if ticket.running or ticket.done:
+                return # whatever answers the request took over
+            # don't keep the place in the queue if the client goes away
+            ticket.cancel()
+            if self.access is not None:
+                self.access.finish()
+
+        ticket = self.scheduler.schedule(service, gitdir, self.get_client_id(), on_start, on_timeout)
+        if not ticket.running and not ticket.done:
+            self.request.connection.stream.set_close_callback(on_close)
+
     def check_auth(self):
         """Check authentication/authorization of client"""
         # access permissions
@@ -76,26 +218,112 @@ class BaseHandler(tornado.web.RequestHandler):
 
         return self.public_readble, self.public_writable
 
-    def enforce_perms(self, rpc):
-        read, write = self.check_auth()
+    def authorize(self, callback, gitdir=None):
+        """Call callback with the read and write permissions of the client
+
+        If auth has a check method (like gittornado.auth.CachingAuth), it is called
+        with the request and a callback instead, so it doesn't have to block. That
+        callback also gets the verified user, which is kept for get_user.
+
+        Given the repository, permitted requests are counted against the rate_limiter
+        and callback is delayed resp. never called if the request was turned away."""
+        def on_perms(perms, user=None):
+            read, write = perms
+            self.user = user
+            if self.access is not None:
+                self.access.user = self.get_user()
+                self.access.mark('auth')
+            delay = self.limit_rate(gitdir, read, write)
+            if delay is None:
+                return
+            if delay:
+                tornado.ioloop.IOLoop.instance().add_timeout(time.time() + delay, lambda: self._on_delayed(callback, read, write))
+            else:
+                callback(read, write)
+
+        if self.auth is not None and hasattr(self.auth, 'check'):
+            self.auth.check(self.request, on_perms)
+        else:
+            on_perms(self.check_auth())
+
+    def _on_delayed(self, callback, read, write):
+        if self.request.connection.stream.closed():
+            logger.debug("Client went away while being delayed")
+            if self.access is not None:
+                self.access.finish()
+            return
+        callback(read, write)
+
+    def limit_rate(self, gitdir, read, write):
+        """Count the request against the rate limits and pick its throttle
+
+        Returns the seconds to delay the request or None if it was answered with 429.
+        Requests lacking permissions don't count, so nobody can use up the requests of others.
+        """
+        if self.rate_limiter is None or gitdir is None or not (read or write):
+            return 0
+
+        user = self.get_user()
+        admitted, delay = self.rate_limiter.admit(user, self.request.remote_ip, gitdir)
+        if not admitted:
+            if self.metrics is not None:
+                self.metrics.rate_limited(self.get_service())
+            self.too_many_requests(int(math.ceil(delay)))
+            return None
+
+        self.throttle = self.rate_limiter.get_throttle(user, self.request.remote_ip, gitdir)
+        return delay
+
+    def too_many_requests(self, retry_after):
+        """Answer a request exceeding its rate limit"""
+        msg = 'Too many requests, please try again later'
+        self.send_response('HTTP/1.1 429 Too Many Requests\r\nDate: %s\r\nRetry-After: %d\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n%s' % (
+                           get_date_header(), retry_after, len(msg), msg))
+
+    def deny(self):
+        """Answer a request lacking permissions, returns False"""
+        if self.metrics is not None:
+            self.metrics.auth_failed(self.get_service())
+        if self.auth_failed:
+            self.auth_failed(self.request)
+            if self.access is not None and self.access.status is None:
+                # auth_failed answers with 401 and a challenge
+                self.access.status = 401
+            self.finish_request()
+            return False
+        else:
+            raise tornado.web.HTTPError(403, 'You are not allowed to perform this action')
+
+    def send_response(self, response):
+        """Answer the request with a complete HTTP response, written as is"""
+        if self.access is not None:
+            self.access.write(response)
+        self.request.write(response)
+        self.finish_request()
+
+    def finish_request(self):
+        """Finish a request answered by writing to it directly"""
+        self.request.finish()
+        if self.access is not None:
+            self.access.finish()
+
+    def on_finish(self):
+        # responses sent through Tornado, like errors, don't go through the wrappers
+        if self.access is not None and not self.access.done:
+            if self.access.status is None:
+                self.access.status = self.get_status()
+            self.access.finish()
+
+    def enforce_perms(self, rpc, perms=None):
+        read, write = perms if perms is not None else self.check_auth()
 
         if rpc in ['git-receive-pack', 'receive-pack']:
             if not write:
-                if self.auth_failed:
-                    self.auth_failed(self.request)
-                    self.request.finish()
-                    return False
-                else:
-                    raise tornado.web.HTTPError(403, 'You are not allowed to perform this action')
+                return self.deny()
 
         elif rpc in ['git-upload-pack', 'upload-pack']:
             if not read:
-                if self.auth_failed:
-                    self.auth_failed(self.request)
-                    self.request.finish()
-                    return False
-                else:
-                    raise tornado.web.HTTPError(403, 'You are not allowed to perform this action')
+                return self.deny()
 
         else:
             raise tornado.web.HTTPError(400, 'Unknown RPC command')
@@ -105,25 +333,177 @@ class BaseHandler(tornado.web.RequestHandler):
 class RPCHandler(BaseHandler):
     """Request handler for RPC calls
     
-    Use this handler to handle example.git/git-upload-pack and example.git/git-receive-pack URLs"""
+    Use this handler to handle example.git/git-upload-pack and example.git/git-receive-pack URLs
+
+    Set max_request_size to limit the size of the decompressed request body and pass a
+    gittornado.packcache.PackCache as pack_cache to reuse responses to identical upload-pack requests.
+    With single_flight, identical upload-pack requests arriving at the same time share one process.
+    Pass a gittornado.maintenance.MaintenanceScheduler as maintenance to maintain repositories after pushes.
+    Pass a gittornado.refs.RefIndex as ref_index to answer protocol v2 ls-refs requests without git.
+    With a gittornado.packhook.PackObjectsCache as pack_objects_cache, upload-pack reuses the packs
+    generated for earlier requests asking for the same objects."""
+    max_request_size = None
+    pack_cache = None
+    rpc = None
+
+    def get_service(self):
+        rpc = self.request.path.rstrip('/').rsplit('/', 1)[-1][4:]
+        return rpc if rpc in ('upload-pack', 'receive-pack') else 'other'
+
     @tornado.web.asynchronous
     def post(self):
         gitdir = self.get_gitdir()
 
+        self.authorize(lambda read, write: self._on_auth(gitdir, read, write), gitdir)
+
+    def _on_auth(self, gitdir, read, write):
         # get RPC command
         pathlets = self.request.path.strip('/').split('/')
         rpc = pathlets[-1]
-        if not self.enforce_perms(rpc):
+        if not self.enforce_perms(rpc, (read, write)):
             return
-        rpc = rpc[4:]
+        self.rpc = rpc = rpc[4:]
+
+        headers = {'Content-Type': 'application/x-git-%s-result' % rpc}
+        command = self.get_rpc_command(rpc, gitdir)
+        # a request ending in done gets a pack as response, which is already compressed
+        gzip_output = self.get_gzip_output(['0009done\n', '0009done\n0000'] if rpc == 'upload-pack' else [])
+
+        if self.ref_index is not None and rpc == 'upload-pack' and self._answer_ls_refs(gitdir, headers, gzip_output):
+            return
+
+        cache_key = flight_key = None
+        if self.pack_cache is not None and rpc == 'upload-pack':
+            cache_key = self.pack_cache.get_key(gitdir, self.request)
+        if self.single_flight is not None and rpc == 'upload-pack':
+            flight_key = self.single_flight.get_key(command, self.request, gzip_output)
+
+        if self._answer_shared(command, cache_key, flight_key, headers, gzip_output):
+            return
+
+        self._run_rpc(command, cache_key, flight_key, headers, gzip_output)
+
+    def _run_rpc(self, command, cache_key, flight_key, headers, gzip_output):
+        def start(finish_callback):
+            # an identical request might have been answered resp. started while we were waiting to be scheduled
+            if self._answer_shared(command, cache_key, flight_key, headers, gzip_output):
+                if finish_callback is not None:
+                    finish_callback(None)
+                return
+
+            recorder = flight = None
+            if cache_key is not None:
+                recorder = self.pack_cache.recorder(cache_key)
+            if flight_key is not None:
+                flight = self.single_flight.start(flight_key)
+            if self.maintenance is not None and self.rpc == 'receive-pack':
+                finish_callback = self._after_push(command[-1], finish_callback)
+
+            try:
+                ProcessWrapper(self.request, command, headers,
+                               output_tee=recorder, max_input_size=self.max_request_size, gzip_output=gzip_output,
+                               finish_callback=finish_callback, flight=flight, env=self.get_git_env(),
+                               spawner=self.spawner, throttle=self.throttle, access=self.access)
+            except:
+                # don't leave identical requests waiting forever
+                if recorder is not None:
+                    recorder.finish(None)
+                if flight is not None:
+                    flight.finish()
+                raise
+
+        self.run_process(self.rpc, command[-1], start)
+
+    def _after_push(self, gitdir, finish_callback):
+        """Wrap the finish callback of a receive-pack process to tell maintenance about the push"""
+        def on_finish(retval):
+            if retval == 0:
+                self.maintenance.push_done(gitdir)
+            if finish_callback is not None:
+                finish_callback(retval)
+        return on_finish
+
+    def _answer_ls_refs(self, gitdir, headers, gzip_output):
+        """Answer a protocol v2 ls-refs request from ref_index
+
+        Returns False if the request is something else or git has to answer it.
+        """
+        if get_protocol_version(self.get_git_protocol()) != 2:
+            return False
+        body = get_request_body(self.request, MAX_LS_REFS_REQUEST)
+        if body is None:
+            return False
+        response = self.ref_index.ls_refs(gitdir, body)
+        if response is None:
+            return False
+
+        logger.debug("Answering ls-refs from the ref index")
+        headers = dict(headers)
+        if gzip_output is not None:
+            headers['Vary'] = 'Accept-Encoding'
+            if len(response) >= gzip_output.min_size:
+                compressor = zlib.compressobj(gzip_output.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                size = len(response)
+                response = compressor.compress(response) + compressor.flush()
+                headers['Content-Encoding'] = 'gzip'
+                if self.access is not None:
+                    self.access.compressed(size, len(response))
+        BufferWrapper(self.request, response, headers, access=self.access)
+        return True
 
-        ProcessWrapper(self.request, [self.gitcommand, rpc, '--stateless-rpc', gitdir],
-                       {'Content-Type': 'application/x-git-%s-result' % rpc})
+    def _answer_shared(self, command, cache_key, flight_key, headers, gzip_output):
+        """Answer the request from the pack cache or a process started for an identical request
+
+        Returns False if the request needs its own process.
+        """
+        if cache_key is not None:
+            path = self.pack_cache.get(cache_key)
+            if path is not None:
+                logger.debug("Serving cached response %s", cache_key)
+                FileWrapper(self.request, path, headers, self.file_chunk_size, self.use_sendfile, throttle=self.throttle,
+                            access=self.access)
+                return True
+
+        if flight_key is not None and self.single_flight.join(flight_key, self.request, self.access):
+            return True
+
+        if cache_key is not None and self.pack_cache.is_pending(cache_key):
+            logger.debug("Waiting for identical request to finish")
+
+            def on_response(path):
+                if self.request.connection.stream.closed():
+                    if self.access is not None:
+                        self.access.finish()
+                    return
+                if path is None:
+                    # generating the response failed, try on our own
+                    self._run_rpc(command, None, flight_key, headers, gzip_output)
+                else:
+                    FileWrapper(self.request, path, headers, self.file_chunk_size, self.use_sendfile, throttle=self.throttle,
+                                access=self.access)
+
+            self.pack_cache.wait(cache_key, on_response)
+            return True
+
+        return False
 
 class InfoRefsHandler(BaseHandler):
     """Request handler for info/refs
     
-    Use this handler to handle example.git/info/refs?service= URLs"""
+    Use this handler to handle example.git/info/refs?service= URLs
+
+    Pass a gittornado.cache.AdvertisementCache as advertisement_cache to serve
+    ref advertisements from memory as long as the refs do not change.
+
+    A Git-Protocol header is passed on to git as GIT_PROTOCOL, so clients asking for
+    protocol v2 get its capability advertisement instead of the refs. Pass a
+    gittornado.refs.RefIndex as ref_index to send upload-pack advertisements to
+    other clients without running git."""
+    advertisement_cache = None
+
+    def get_service(self):
+        return 'info-refs'
+
     @tornado.web.asynchronous
     def get(self):
         gitdir = self.get_gitdir()
@@ -131,68 +511,152 @@ class InfoRefsHandler(BaseHandler):
         logger.debug("Query string: %r", self.request.query)
         rpc = urlparse.parse_qs(self.request.query).get('service', [''])[0]
 
-        read, write = self.check_auth()
+        self.authorize(lambda read, write: self._on_auth(gitdir, rpc, read), gitdir)
+
+    def _on_auth(self, gitdir, rpc, read):
         if not read:
-            if self.auth_failed:
-                self.auth_failed(self.request)
-                self.request.finish()
-                return
-            else:
-                raise tornado.web.HTTPError(403, 'You are not allowed to perform this action')
+            self.deny()
+            return
 
         if not rpc:
             # this appears to be a dumb client. send the file
             logger.debug("Dumb client detected")
-            FileWrapper(self.request, os.path.join(gitdir, 'info', 'refs'), dict(dont_cache() + [('Content-Type', 'text/plain; charset=utf-8')]))
+            FileWrapper(self.request, os.path.join(gitdir, 'info', 'refs'), dict(dont_cache() + [('Content-Type', 'text/plain; charset=utf-8')]),
+                        access=self.access)
             return
 
         rpc = rpc[4:]
 
-        prelude = '# service=git-' + rpc
-        prelude = str(hex(len(prelude) + 4)[2:].rjust(4, '0')) + prelude
-        prelude += '0000' # packet flush               
-
-        ProcessWrapper(self.request, [self.gitcommand, rpc, '--stateless-rpc', '--advertise-refs', gitdir],
-                       {'Content-Type': 'application/x-git-%s-advertisement' % rpc,
-                        'Expires': 'Fri, 01 Jan 1980 00:00:00 GMT',
-                        'Pragma': 'no-cache',
-                        'Cache-Control': 'no-cache, max-age=0, must-revalidate'}, prelude)
-
-file_headers = {
-    re.compile('.*(/HEAD)$'):                                   lambda: dict(dont_cache() + [('Content-Type', 'text/plain')]),
-    re.compile('.*(/objects/info/alternates)$'):                lambda: dict(dont_cache() + [('Content-Type', 'text/plain')]),
-    re.compile('.*(/objects/info/http-alternates)$'):           lambda: dict(dont_cache() + [('Content-Type', 'text/plain')]),
-    re.compile('.*(/objects/info/packs)$'):                     lambda: dict(dont_cache() + [('Content-Type', 'text/plain; charset=utf-8')]),
-    re.compile('.*(/objects/info/[^/]+)$'):                     lambda: dict(dont_cache() + [('Content-Type', 'text/plain')]),
-    re.compile('.*(/objects/[0-9a-f]{2}/[0-9a-f]{38})$'):       lambda: dict(cache_forever() + [('Content-Type', 'application/x-git-loose-object')]),
-    re.compile('.*(/objects/pack/pack-[0-9a-f]{40}\\.pack)$'):  lambda: dict(cache_forever() + [('Content-Type', 'application/x-git-packed-objects')]),
-    re.compile('.*(/objects/pack/pack-[0-9a-f]{40}\\.idx)$'):   lambda: dict(cache_forever() + [('Content-Type', 'application/x-git-packed-objects-toc')]),
+        # protocol v2 starts with the capability advertisement of git right away
+        protocol = self.get_git_protocol()
+        prelude = get_advertisement_prelude(rpc) if get_protocol_version(protocol) != 2 else ''
+
+        headers = {'Content-Type': 'application/x-git-%s-advertisement' % rpc,
+                   'Expires': 'Fri, 01 Jan 1980 00:00:00 GMT',
+                   'Pragma': 'no-cache',
+                   'Cache-Control': 'no-cache, max-age=0, must-revalidate'}
+
+        command = [self.gitcommand, rpc, '--stateless-rpc', '--advertise-refs', gitdir]
+        gzip_output = self.get_gzip_output()
+
+        if self.ref_index is not None and rpc == 'upload-pack' and get_protocol_version(protocol) == 0:
+            entry = self.ref_index.advertise(gitdir)
+            if entry is not None:
+                logger.debug("Sending advertisement from the ref index")
+                self._send_advertisement(entry, headers, gzip_output)
+                return
+
+        if self.advertisement_cache is not None:
+            entry = self.advertisement_cache.get(gitdir, rpc, protocol)
+            if entry is not None:
+                logger.debug("Serving cached advertisement")
+                self._send_advertisement(entry, headers, gzip_output)
+                return
+
+        flight_key = None
+        if self.single_flight is not None:
+            flight_key = self.single_flight.get_key(command, self.request, gzip_output)
+            if flight_key is not None and self.single_flight.join(flight_key, self.request, self.access):
+                return
+
+        def start(finish_callback):
+            recorder = flight = None
+            if flight_key is not None:
+                if self.single_flight.join(flight_key, self.request, self.access):
+                    if finish_callback is not None:
+                        finish_callback(None)
+                    return
+                flight = self.single_flight.start(flight_key)
+            if self.advertisement_cache is not None:
+                recorder = self.advertisement_cache.recorder(gitdir, rpc, prelude, protocol)
+
+            ProcessWrapper(self.request, command, headers, prelude, recorder, gzip_output=gzip_output,
+                           finish_callback=finish_callback, flight=flight, env=self.get_git_env(), spawner=self.spawner,
+                           throttle=self.throttle, access=self.access)
+
+        self.run_process(rpc, gitdir, start)
+
+    def _send_advertisement(self, entry, headers, gzip_output):
+        """Send a gittornado.cache.Advertisement"""
+        body, etag = entry.body, entry.etag
+        if gzip_output is not None:
+            headers['Vary'] = 'Accept-Encoding'
+            if entry.size >= gzip_output.min_size:
+                body, etag = entry.get_gzipped(gzip_output.level)
+                headers['Content-Encoding'] = 'gzip'
+                if self.access is not None:
+                    self.access.compressed(entry.size, len(body))
+        BufferWrapper(self.request, body, headers, etag, self.access)
+
+# common prefixes are factored out so a path is classified by trying the alternatives once
+file_matcher = re.compile('.*/(?:(HEAD)|objects/(?:(info/packs)|(info/[^/]+)|([0-9a-f]{2}/[0-9a-f]{38})|'
+                          '(pack/pack-[0-9a-f]{40}\\.pack)|(pack/pack-[0-9a-f]{40}\\.idx)))$')
+
+# group of file_matcher -> (directory, content type, whether the file never changes)
+file_types = {
+    1: ('/',         'text/plain',                           False),
+    2: ('/objects/', 'text/plain; charset=utf-8',            False),
+    3: ('/objects/', 'text/plain',                           False),
+    4: ('/objects/', 'application/x-git-loose-object',       True),
+    5: ('/objects/', 'application/x-git-packed-objects',     True),
+    6: ('/objects/', 'application/x-git-packed-objects-toc', True),
 }
 
+# precomputed headers, immutable files get their Expires header on every request
+file_type_headers = dict((group, (directory, immutable, tuple((cache_forever()[1:] if immutable else dont_cache()) + [('Content-Type', content_type)])))
+                         for group, (directory, content_type, immutable) in file_types.items())
+
+def get_file_headers(path):
+    """Classify a request path, returns the file relative to the repository and its headers or None, None"""
+    m = file_matcher.match(path)
+    if m is None:
+        return None, None
+    directory, immutable, headers = file_type_headers[m.lastindex]
+    headers = dict(headers)
+    if immutable:
+        headers['Expires'] = get_http_date(365 * 24 * 3600)
+    return directory + m.group(m.lastindex), headers
+
+immutable_file = re.compile('.*/objects/(?:([0-9a-f]{2})/([0-9a-f]{38})|pack/(pack-[0-9a-f]{40}\\.(?:pack|idx)))$')
+
+def get_etag(filename):
+    """Derive a strong entity tag from the name of an immutable object or pack file"""
+    m = immutable_file.match(filename)
+    if m is None:
+        return None
+    if m.group(3):
+        return '"%s"' % m.group(3)
+    return '"%s%s"' % (m.group(1), m.group(2))
+
 class FileHandler(BaseHandler):
-    """Request handler for static files"""
+    """Request handler for static files
+
+    Set use_sendfile to transfer files with os.sendfile (or from an mmap if sendfile
+    is not available) and file_chunk_size to tune how much is read/written at once"""
+
+    def get_service(self):
+        return 'file'
+
     @tornado.web.asynchronous
     def get(self):
         gitdir = self.get_gitdir()
 
-        read, write = self.check_auth()
+        self.authorize(lambda read, write: self._on_auth(gitdir, read), gitdir)
+
+    def _on_auth(self, gitdir, read):
         if not read:
-            if self.auth_failed:
-                self.auth_failed(self.request)
-                self.request.finish()
-                return
-            else:
-                raise tornado.web.HTTPError(403, 'You are not allowed to perform this action')
+            self.deny()
+            return
+
+        filename, headers = self.get_file(gitdir)
+        logger.debug('Serving file %s', filename)
 
-        # determine the headers for this file
-        filename, headers = None, None
-        for matcher, get_headers in file_headers.items():
-            m = matcher.match(self.request.path)
-            if m:
-                filename = m.group(1)
-                headers = get_headers()
-                break
+        FileWrapper(self.request, filename, headers, self.file_chunk_size, self.use_sendfile, get_etag(filename), self.throttle,
+                    self.access)
 
+    def get_file(self, gitdir):
+        """Determine the file to send and its headers"""
+        filename, headers = get_file_headers(self.request.path)
         logger.debug("Found %r with headers %r", filename, headers)
 
         # did we find anything?
@@ -204,6 +668,15 @@ class FileHandler(BaseHandler):
         if not filename.startswith(os.path.abspath(gitdir)): # yes, the matches are strict and don't allow directory traversal, but better safe than sorry
             raise tornado.web.HTTPError(404, 'Trying to access file outside of git repository')
 
-        logger.debug('Serving file %s', filename)
+        return filename, headers
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Request handler exposing a gittornado.metrics.Metrics passed as metrics
+    in the Prometheus text format"""
 
-        FileWrapper(self.request, filename, headers)
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.metrics.render())
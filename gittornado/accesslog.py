@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+"""Access log in JSON lines
+
+Every request gets an AccessEntry that the handlers and wrappers fill in while
+serving it: the repository and user, the response status, the exit status of
+git, bytes received and sent, how well the output compressed and when each
+phase was reached, in seconds since the request was parsed. Finished entries are
+handed to a thread writing them out, so a slow disk never blocks the IOLoop.
+"""
+
+import os
+import time
+import json
+import errno
+import datetime
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock, phases are measured with the wall clock there
+monotonic = getattr(time, 'monotonic', time.time)
+
+# phases in the order they are usually reached
+PHASES = ('lookup', 'auth', 'spawn', 'first_stdin', 'first_stdout', 'first_byte', 'finish')
+
+class AccessEntry(object):
+    """What happened while serving one request"""
+
+    repo = None
+    user = None
+    status = None
+    exit_code = None
+    # output of git before and after compressing it, if it was
+    uncompressed_size = None
+    compressed_size = None
+    done = False
+
+    def __init__(self, log, request, service):
+        self.log = log
+        self.request = request
+        self.service = service
+        self.start_time = getattr(request, '_start_time', None) or time.time()
+        self.started = monotonic()
+        # the body is not read yet with Tornado's stream_request_body
+        self.bytes_in = len(request.body) if isinstance(request.body, bytes) else 0
+        self.bytes_out = 0
+        self.phases = {}
+
+    def mark(self, phase):
+        """Note that a phase was reached, only the first time counts"""
+        if phase not in self.phases:
+            self.phases[phase] = monotonic() - self.started
+
+    def write(self, data):
+        """Account for data written to the client, picking the status from the status line"""
+        if self.status is None and data[:5] == 'HTTP/' and data[9:12] != '100':
+            self.status = int(data[9:12])
+            self.mark('first_byte')
+        self.bytes_out += len(data)
+
+    def sent(self, count):
+        """Account for data sent without going through write, e.g. with sendfile"""
+        self.bytes_out += count
+
+    def received(self, count):
+        """Account for request data read from the connection directly"""
+        self.bytes_in += count
+
+    def compressed(self, uncompressed_size, compressed_size):
+        self.uncompressed_size = (self.uncompressed_size or 0) + uncompressed_size
+        self.compressed_size = (self.compressed_size or 0) + compressed_size
+
+    def finish(self):
+        """The response is complete or the client went away, log the entry once"""
+        if self.done:
+            return
+        self.done = True
+        self.mark('finish')
+        self.log.write(self.get_record())
+
+    def get_record(self):
+        request = self.request
+        record = {'time': datetime.datetime.utcfromtimestamp(self.start_time).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                  'remote_ip': request.remote_ip,
+                  'method': request.method,
+                  'uri': request.uri,
+                  'service': self.service,
+                  'repo': self.repo,
+                  'user': self.user,
+                  'status': self.status,
+                  'exit_code': self.exit_code,
+                  'bytes_in': self.bytes_in,
+                  'bytes_out': self.bytes_out,
+                  'gzip_ratio': None,
+                  'timings': dict((phase, round(seconds, 6)) for phase, seconds in self.phases.items()),
+                  }
+        if self.uncompressed_size:
+            record['gzip_ratio'] = round(float(self.compressed_size) / self.uncompressed_size, 4)
+        return record
+
+class AccessLog(object):
+    """Appends access log entries to a file from a thread of its own
+
+    Entries queue up in memory, at most max_pending of them, and are written in
+    batches with one write each, so several processes can share the file. Entries
+    arriving while the queue is full are dropped and counted. The file is reopened
+    when it has been moved away, e.g. by logrotate.
+    """
+
+    fd = None
+    inode = None
+
+    def __init__(self, path, max_pending=10000):
+        self.path = path
+        self.queue = queue.Queue(max_pending)
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.thread = threading.Thread(target=self._run, name='access-log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def entry(self, request, service):
+        """Start the entry of a request"""
+        return AccessEntry(self, request, service)
+
+    def write(self, record):
+        """Queue a record, never blocks"""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write what is queued and stop the thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            # write whatever else came in meanwhile along with it
+            while records[-1] is not None:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for record in records:
+                if record is None:
+                    continue
+                try:
+                    lines.append(json.dumps(record, sort_keys=True) + '\n')
+                except (TypeError, ValueError) as e:
+                    logger.warning("Unable to log %r: %s", record, e)
+
+            if self.dropped != self.reported_dropped:
+                logger.warning("Access log can't keep up, dropped %d entries so far", self.dropped)
+                self.reported_dropped = self.dropped
+
+            if lines:
+                try:
+                    self._append(''.join(lines).encode('utf-8'))
+                except (IOError, OSError) as e:
+                    logger.error("Unable to write access log %s: %s", self.path, e)
+
+            if records[-1] is None:
+                if self.fd is not None:
+                    os.close(self.fd)
+                return
+
+    def _append(self, data):
+        self._reopen()
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def _reopen(self):
+        """Open the file if it isn't or has been moved away"""
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            inode = None
+
+        if self.fd is not None and inode == self.inode:
+            return
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.inode = os.fstat(self.fd).st_ino
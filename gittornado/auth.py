@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import os
+import re
+import hmac
+import time
+import base64
+import hashlib
+import binascii
+import threading
+import ConfigParser
+import multiprocessing.pool
+
+import tornado.ioloop
+import tornado.stack_context
+
+from gittornado.cache import LRUCache
+from gittornado.util import get_basic_auth
+
+try:
+    import crypt
+except ImportError:
+    crypt = None
+
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# the part of request paths following the repository
+_service_path = re.compile('/(?:git-[a-z-]+|info/refs|HEAD|objects/.*)$')
+
+_ITOA64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+def _md5_crypt(password, salt, magic):
+    """The MD5 based crypt of FreeBSD resp. Apache ($apr1$)"""
+    salt = salt[:8]
+    final = hashlib.md5(password + salt + password).digest()
+    ctx = password + magic + salt
+    for length in range(len(password), 0, -16):
+        ctx += final[:min(16, length)]
+    i = len(password)
+    while i:
+        ctx += '\0' if i & 1 else password[:1]
+        i >>= 1
+    final = hashlib.md5(ctx).digest()
+
+    # deliberately slow
+    for i in range(1000):
+        ctx = password if i & 1 else final
+        if i % 3:
+            ctx += salt
+        if i % 7:
+            ctx += password
+        ctx += final if i & 1 else password
+        final = hashlib.md5(ctx).digest()
+
+    final = bytearray(final)
+    encoded = []
+    for a, b, c in ((0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15), (4, 10, 5)):
+        value = final[a] << 16 | final[b] << 8 | final[c]
+        encoded.extend(_ITOA64[(value >> shift) & 0x3f] for shift in (0, 6, 12, 18))
+    encoded.extend(_ITOA64[(final[11] >> shift) & 0x3f] for shift in (0, 6))
+    return magic + salt + '$' + ''.join(encoded)
+
+def _pbkdf2(password, stored):
+    """Django style pbkdf2_<digest>$<iterations>$<salt>$<base64 hash>"""
+    try:
+        algorithm, iterations, salt, expected = stored.split('$')
+        expected = base64.b64decode(expected)
+        iterations = int(iterations)
+    except (TypeError, ValueError, binascii.Error):
+        return None
+    digest = hashlib.pbkdf2_hmac(algorithm[7:], password, salt, iterations)
+    return base64.b64encode(digest), base64.b64encode(expected)
+
+def verify_password(password, stored):
+    """Check password against a stored password
+
+    Understands the formats written by htpasswd ({SHA}, $apr1$, bcrypt with the bcrypt
+    package installed and crypt(3)), {SSHA}, Django style pbkdf2_sha256 and plain text.
+    """
+    if stored.startswith('{SHA}'):
+        computed, stored = base64.b64encode(hashlib.sha1(password).digest()), stored[5:]
+    elif stored.startswith('{SSHA}'):
+        try:
+            decoded = base64.b64decode(stored[6:])
+        except (TypeError, binascii.Error):
+            return False
+        computed, stored = hashlib.sha1(password + decoded[20:]).digest(), decoded[:20]
+    elif stored.startswith('$apr1$') or stored.startswith('$1$'):
+        magic, salt = stored[:stored.index('$', 1) + 1], stored.split('$')[2]
+        computed = _md5_crypt(password, salt, magic)
+    elif stored[:4] in ('$2a$', '$2b$', '$2y$'):
+        if bcrypt is None:
+            logger.error("bcrypt hashes need the bcrypt package")
+            return False
+        computed = bcrypt.hashpw(password, stored)
+    elif stored.startswith('pbkdf2_'):
+        result = _pbkdf2(password, stored)
+        if result is None:
+            return False
+        computed, stored = result
+    elif stored.startswith('$') and crypt is not None:
+        computed = crypt.crypt(password, stored)
+        if computed is None:
+            return False
+    else:
+        computed = password
+
+    return hmac.compare_digest(computed, stored)
+
+class Authenticator(object):
+    """Interface of credential backends used by CachingAuth
+
+    verify is run in a thread pool and may block, permissions is called on the IOLoop
+    for every request and has to be fast.
+    """
+
+    # incremented whenever credentials change, verified credentials of older generations are discarded
+    generation = 0
+
+    def verify(self, user, password):
+        """Check the credentials of a user"""
+        raise NotImplementedError()
+
+    def permissions(self, user, request):
+        """Get (read, write) permissions of a verified user for the request"""
+        raise NotImplementedError()
+
+    def refresh(self):
+        """Called on the IOLoop before credentials are looked up, e.g. to pick up changes"""
+        pass
+
+class FileAuthenticator(Authenticator):
+    """Base of authenticators backed by a file that is reloaded when it changes"""
+
+    def __init__(self, filename, check_interval=1):
+        """
+        :param filename: the file to load
+        :param check_interval: seconds between checking whether the file changed
+        """
+        self.filename = filename
+        self.check_interval = check_interval
+        self.checked = 0
+        self.state = None
+        self.refresh()
+
+    def refresh(self):
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+
+        try:
+            st = os.stat(self.filename)
+        except OSError as e:
+            logger.error("Unable to read %s: %s", self.filename, e)
+            return
+        state = (st.st_mtime, st.st_size, st.st_ino)
+        if state == self.state:
+            return
+
+        logger.info("Loading %s", self.filename)
+        try:
+            self.load()
+        except Exception:
+            logger.exception("Unable to load %s, keeping the previous version", self.filename)
+            return
+        self.state = state
+        self.generation += 1
+
+    def load(self):
+        raise NotImplementedError()
+
+class AccessFile(FileAuthenticator):
+    """The access file of gittornado.server
+
+    The [users] section maps users to their passwords, which may be stored in any
+    format understood by verify_password. The [access] section lists the repositories
+    a user may push to, separated by commas, including namespaces if any (group/repo.git).
+    An entry naming a namespace (group) covers every repository below it. Entries are
+    matched by whole path components, so group doesn't cover group-other/repo.git.
+    Every user may read. User names are case insensitive.
+    """
+
+    users = {}
+    access = {}
+
+    def load(self):
+        # no interpolation, hashes may contain %
+        parser = ConfigParser.RawConfigParser()
+        with open(self.filename) as f:
+            parser.readfp(f)
+
+        users, access = {}, {}
+        if parser.has_section('users'):
+            users = dict(parser.items('users'))
+        if parser.has_section('access'):
+            for user, repos in parser.items('access'):
+                access[user] = set(repo.strip().strip('/') for repo in repos.split(',')) - set([''])
+        self.users, self.access = users, access
+
+    def verify(self, user, password):
+        stored = self.users.get(user.lower())
+        return stored is not None and verify_password(password, stored)
+
+    def permissions(self, user, request):
+        allowed = self.access.get(user.lower(), ())
+        repo = _service_path.sub('', '/' + request.path.strip('/')).strip('/')
+        return True, any(repo == entry or repo.startswith(entry + '/') for entry in allowed)
+
+class Htpasswd(FileAuthenticator):
+    """Users from an htpasswd file, all of them may read and write"""
+
+    users = {}
+
+    def load(self):
+        users = {}
+        with open(self.filename) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#') and ':' in line:
+                    user, stored = line.split(':', 1)
+                    users[user] = stored
+        self.users = users
+
+    def verify(self, user, password):
+        stored = self.users.get(user)
+        return stored is not None and verify_password(password, stored)
+
+    def permissions(self, user, request):
+        return True, True
+
+class _Credentials(object):
+    size = 0
+
+    def __init__(self, user, generation, expires):
+        self.user = user
+        self.generation = generation
+        self.expires = expires
+
+class CachingAuth(object):
+    """Authentication with an Authenticator, remembering verified credentials
+
+    Instances can be passed as auth to the handlers. Credentials are verified in a
+    thread pool so slow password hashes or remote backends don't block the IOLoop,
+    and are remembered for ttl seconds keyed by a hash of the Authorization header.
+    Concurrent requests with the same header wait for one verification.
+    """
+
+    def __init__(self, backend, ttl=300, max_entries=1024, threads=4, anonymous=(True, False)):
+        """
+        :param backend: the Authenticator checking the credentials
+        :param ttl: seconds verified credentials are remembered, 0 to verify every request
+        :param max_entries: maximum number of remembered credentials
+        :param threads: number of threads verifying credentials
+        :param anonymous: (read, write) permissions of requests without valid credentials
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.threads = threads
+        self.anonymous = anonymous
+        self.cache = LRUCache(max_entries=max_entries)
+        # cache key -> callbacks waiting for a verification in progress
+        self.pending = {}
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        """Synchronous check, verifies credentials on the IOLoop if they are not cached"""
+        credentials, key, user = self._lookup(request)
+        if credentials is None:
+            return self.anonymous
+        if user is None:
+            user = self._verified(key, credentials[0], self.backend.verify(*credentials), self.backend.generation)
+        return self._permissions(user, request)
+
+    def check(self, request, callback):
+        """Call callback with the (read, write) permissions of the request and the verified user
+
+        The user is None for requests without valid credentials.
+        """
+        credentials, key, user = self._lookup(request)
+        if credentials is None:
+            return callback(self.anonymous, None)
+        if user is not None:
+            return callback(self._permissions(user, request), user or None)
+
+        on_verified = tornado.stack_context.wrap(lambda user: callback(self._permissions(user, request), user or None))
+        if key in self.pending:
+            self.pending[key].append(on_verified)
+            return
+        self.pending[key] = [on_verified]
+
+        generation = self.backend.generation
+        ioloop = tornado.ioloop.IOLoop.instance()
+        def verify():
+            # runs on a pool thread
+            try:
+                valid = self.backend.verify(*credentials)
+            except Exception:
+                logger.exception("Verifying credentials of %s failed", credentials[0])
+                valid = False
+            ioloop.add_callback(lambda: self._resolve(key, self._verified(key, credentials[0], valid, generation)))
+
+        self._get_pool().apply_async(verify)
+
+    def _get_pool(self):
+        # created lazily so it isn't inherited across fork
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.pool.ThreadPool(self.threads)
+        return self.pool
+
+    def _lookup(self, request):
+        """Get (credentials, cache key, verified user or None)"""
+        credentials = get_basic_auth(request)
+        if credentials is None:
+            return None, None, None
+
+        self.backend.refresh()
+        key = hashlib.sha256(request.headers['Authorization'].strip()).digest()
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry.generation == self.backend.generation and entry.expires > time.time():
+                return credentials, key, entry.user
+            self.cache.remove(key)
+        return credentials, key, None
+
+    def _verified(self, key, user, valid, generation):
+        if not valid:
+            logger.info("Invalid credentials for %s", user)
+            return False
+        if self.ttl and generation == self.backend.generation:
+            self.cache.put(key, _Credentials(user, generation, time.time() + self.ttl))
+        return user
+
+    def _resolve(self, key, user):
+        for callback in self.pending.pop(key, []):
+            callback(user)
+
+    def _permissions(self, user, request):
+        if user is False:
+            return self.anonymous
+        return self.backend.permissions(user, request)
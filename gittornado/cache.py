@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import os
+import os.path
+import zlib
+import hashlib
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+# files besides the loose refs whose changes change refs
+REF_FILES = ('HEAD', 'packed-refs', os.path.join('reftable', 'tables.list'))
+
+def get_ref_state(gitdir):
+    """Compute a cheap fingerprint of the refs of a repository
+
+    Git updates refs by renaming lock files into place, so every change to
+    a loose ref touches the mtime of its directory. Together with HEAD and
+    packed-refs this covers all ways refs can change without reading any of
+    the refs themselves.
+    """
+    state = [_stat_key(os.path.join(gitdir, name)) for name in REF_FILES]
+
+    for dirpath, dirnames, filenames in os.walk(os.path.join(gitdir, 'refs')):
+        dirnames.sort()
+        state.append((dirpath, _stat_key(dirpath)))
+
+    return tuple(state)
+
+def ref_state_changed(gitdir, state):
+    """Check whether refs changed since get_ref_state returned state
+
+    Only the directories found back then are looked at, without listing them
+    again: creating or removing a directory touches the mtime of its parent.
+    """
+    for name, key in zip(REF_FILES, state):
+        if _stat_key(os.path.join(gitdir, name)) != key:
+            return True
+    for dirpath, key in state[len(REF_FILES):]:
+        if _stat_key(dirpath) != key:
+            return True
+    return False
+
+class LRUCache(object):
+    """Mapping bounded by number of entries and total size
+
+    Least recently used entries are evicted first. The size of an entry is
+    determined by the ``size`` attribute of the stored value.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value # mark as most recently used
+        return value
+
+    def put(self, key, value):
+        self.remove(key)
+        self.entries[key] = value
+        self.total_bytes += value.size
+
+        while self.entries and (len(self.entries) > self.max_entries or
+                                (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            oldest = next(iter(self.entries))
+            logger.debug("Evicting %r from cache", oldest)
+            self.remove(oldest)
+
+    def remove(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.total_bytes -= value.size
+        return value
+
+class Advertisement(object):
+    """A cached ref advertisement"""
+
+    def __init__(self, state, body):
+        self.state = state
+        self.body = body
+        self.size = len(body)
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.gzipped = None
+
+    def get_gzipped(self, level):
+        """Get the gzip compressed body and its entity tag"""
+        if self.gzipped is None:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.gzipped = compressor.compress(self.body) + compressor.flush()
+        return self.gzipped, self.etag[:-1] + '-gzip"'
+
+class AdvertisementRecorder(object):
+    """Collects the output of an advertise-refs process for the cache"""
+
+    def __init__(self, cache, key, state, prelude):
+        self.cache = cache
+        self.key = key
+        self.state = state
+        self.chunks = [prelude]
+        self.size = len(prelude)
+
+    def write(self, data):
+        if self.chunks is None:
+            return
+
+        self.size += len(data)
+        if self.size > self.cache.max_entry_size:
+            logger.debug("Advertisement for %r too large to be cached", self.key)
+            self.chunks = None
+        else:
+            self.chunks.append(data)
+
+    def finish(self, retval):
+        if self.chunks is None or retval != 0:
+            return
+
+        logger.debug("Caching advertisement for %r (%d bytes)", self.key, self.size)
+        self.cache.entries.put(self.key, Advertisement(self.state, ''.join(self.chunks)))
+        self.chunks = None
+
+class AdvertisementCache(object):
+    """In-memory cache of ref advertisements keyed by (gitdir, service, protocol)
+
+    Entries are validated against the ref state of the repository on every
+    lookup, so they are invalidated as soon as any ref changes.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, max_entry_size=4 * 1024 * 1024):
+        self.max_entry_size = max_entry_size
+        self.entries = LRUCache(max_entries, max_bytes)
+
+    def get(self, gitdir, service, protocol=None):
+        """Get a valid advertisement or None
+
+        :param protocol: value of GIT_PROTOCOL the advertisement was generated with
+        """
+        key = (gitdir, service, protocol)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        if ref_state_changed(gitdir, entry.state):
+            logger.debug("Refs of %r changed, dropping cached advertisement", key)
+            self.entries.remove(key)
+            return None
+
+        return entry
+
+    def recorder(self, gitdir, service, prelude='', protocol=None):
+        """Get a recorder to be passed as output_tee to ProcessWrapper"""
+        return AdvertisementRecorder(self, (gitdir, service, protocol), get_ref_state(gitdir), prelude)
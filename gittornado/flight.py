@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import collections
+
+from gittornado.metrics import TrackedRequest
+from gittornado.util import get_date_header, hash_request_body, get_git_protocol
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Flight(object):
+    """The response of one git process, shared with clients that sent identical requests
+
+    The client that started the process (the leader) writes its response through the
+    flight, which keeps it around for the followers. Followers can join as long as
+    the response is still complete from the first byte, i.e. until more than
+    join_window bytes have been written or nothing is retained anymore.
+    """
+
+    finished = False
+    close_connection = False
+    leader_gone = False
+
+    # called when followers caught up resp. when nobody is interested in the output anymore
+    drain_callback = None
+    abandon_callback = None
+
+    def __init__(self, group, key):
+        self.group = group
+        self.key = key
+        self.chunks = collections.deque()
+        # offset of the first retained byte resp. after the last written one
+        self.base = 0
+        self.end = 0
+        self.followers = []
+
+    def joinable(self):
+        return not self.finished and not self.leader_gone and self.base == 0 and self.end <= self.group.join_window
+
+    def write(self, data):
+        if data:
+            self.chunks.append(data)
+            self.end += len(data)
+            for follower in self.followers:
+                follower.pump()
+            self._trim()
+
+    def finish(self, close_connection=False):
+        """The leader wrote everything, close_connection if the connection can't be reused"""
+        self.finished = True
+        self.close_connection = close_connection
+        self.group._remove(self)
+        for follower in list(self.followers):
+            follower.pump()
+
+    def leave(self):
+        """The client of the leader went away, returns whether the output is still needed"""
+        self.leader_gone = True
+        self.group._remove(self)
+        return bool(self.followers)
+
+    def blocked(self):
+        """Whether the slowest follower lags too far behind"""
+        if not self.followers:
+            return False
+        return self.end - min(follower.acked for follower in self.followers) > self.group.max_backlog
+
+    def read(self, position):
+        """Get everything from position to the end"""
+        assert position >= self.base
+        skip = position - self.base
+        data = []
+        for chunk in self.chunks:
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            data.append(chunk[skip:] if skip else chunk)
+            skip = 0
+        return ''.join(data)
+
+    def _attach(self, follower):
+        self.followers.append(follower)
+        follower.pump()
+
+    def _detach(self, follower):
+        self.followers.remove(follower)
+        self._trim()
+        if not self.followers and self.leader_gone and not self.finished and self.abandon_callback is not None:
+            logger.debug("All clients of %r went away", self.key)
+            self.abandon_callback()
+        elif self.drain_callback is not None:
+            self.drain_callback()
+
+    def _caught_up(self):
+        self._trim()
+        if self.drain_callback is not None:
+            self.drain_callback()
+
+    def _trim(self):
+        """Drop data every follower has seen, keeping the beginning while followers may still join"""
+        if self.joinable():
+            return
+        elif self.followers:
+            keep = min(follower.position for follower in self.followers)
+        else:
+            keep = self.end
+
+        while self.chunks and self.base + len(self.chunks[0]) <= keep:
+            self.base += len(self.chunks.popleft())
+
+class Follower(object):
+    """Sends the output of a Flight to a client, with its own position and backpressure"""
+
+    writing = False
+    done = False
+
+    def __init__(self, request, flight, access=None):
+        self.request = request
+        self.flight = flight
+        # gittornado.accesslog.AccessEntry of the request
+        self.access = access
+        # bytes handed to the connection resp. actually sent
+        self.position = 0
+        self.acked = 0
+
+        self.request.connection.stream.set_close_callback(self._on_connection_close)
+        flight._attach(self)
+
+    def pump(self):
+        if self.writing or self.done:
+            return
+
+        if self.position < self.flight.end:
+            data = self.flight.read(self.position)
+            self.position += len(data)
+            self.writing = True
+            self._write(data, self._on_flushed)
+        elif self.flight.finished:
+            self._finish()
+
+    def _on_flushed(self):
+        self.writing = False
+        self.acked = self.position
+        self.flight._caught_up()
+        self.pump()
+
+    def _finish(self):
+        self.done = True
+        self.flight._detach(self)
+
+        stream = self.request.connection.stream
+        if stream.closed():
+            return self._report()
+
+        if not self.position:
+            # the leader failed before producing anything
+            msg = 'Shared process did not produce any data'
+            self._write('HTTP/1.1 500 Internal Server Error\r\nDate: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s' % (
+                        get_date_header(), len(msg), msg), stream.close)
+            self._report()
+        elif self.flight.close_connection:
+            self._report()
+            stream.close()
+        else:
+            self.request.finish()
+            if self.access is not None:
+                self.access.finish()
+
+    def _write(self, data, callback):
+        if self.access is not None:
+            self.access.write(data)
+        self.request.write(data, callback)
+
+    def _on_connection_close(self):
+        if not self.done:
+            logger.debug("Follower of %r went away", self.flight.key)
+            self.done = True
+            self.flight._detach(self)
+            self._report()
+
+    def _report(self):
+        if isinstance(self.request, TrackedRequest):
+            self.request.report()
+        if self.access is not None:
+            self.access.finish()
+
+class SingleFlight(object):
+    """Runs only one git process for identical requests in flight at the same time
+
+    Requests are identical if they run the same git command and have the same body.
+    As they get the exact bytes the first client got, the HTTP version and whether
+    gzip compression is acceptable have to match as well.
+    """
+
+    def __init__(self, join_window=1024 * 1024, max_backlog=8 * 1024 * 1024, max_request_size=1024 * 1024):
+        """
+        :param join_window: clients can join a flight until more output than this has been produced
+        :param max_backlog: the process is paused while the slowest client lags behind more than this many bytes
+        :param max_request_size: only requests up to this size (compressed and decompressed) are coalesced
+        """
+        self.join_window = join_window
+        self.max_backlog = max_backlog
+        self.max_request_size = max_request_size
+        self.flights = {}
+
+    def get_key(self, command, request, gzip):
+        """Compute the key identifying identical requests, None if the request can't be shared"""
+        body_hash = hash_request_body(request, self.max_request_size)
+        if body_hash is None:
+            return None
+        return (tuple(command), get_git_protocol(request), body_hash, request.supports_http_1_1(), bool(gzip))
+
+    def join(self, key, request, access=None):
+        """Attach request to a flight in progress, returns False if there is none
+
+        :param access: gittornado.accesslog.AccessEntry of the request
+        """
+        flight = self.flights.get(key)
+        if flight is None or not flight.joinable():
+            return False
+
+        logger.debug("Joining flight %r (%d followers)", key, len(flight.followers))
+        Follower(request, flight, access)
+        return True
+
+    def start(self, key):
+        """Get a new Flight to be passed to ProcessWrapper"""
+        flight = Flight(self, key)
+        self.flights[key] = flight
+        return flight
+
+    def _remove(self, flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
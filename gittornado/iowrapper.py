@@ -18,48 +18,392 @@
 # along with GitTornado.  If not, see http://www.gnu.org/licenses
 
 import subprocess
+import tempfile
 import zlib
 import os
 import os.path
+import sys
+import time
+import fcntl
+import errno
+import mmap
+import datetime
+import collections
 
 import tornado.ioloop
+import tornado.iostream
 
-from gittornado.util import get_date_header
+from gittornado.metrics import TrackedRequest
+from gittornado.spawner import SpawnedProcess
+from gittornado.util import get_date_header, etag_matches, parse_date_header, parse_range_header
 
 import logging
 logger = logging.getLogger(__name__)
 
+# bytes per write when sending from an mmap
+MMAP_CHUNK_SIZE = 1024 * 1024
+# upper bound for the count argument of a single sendfile call
+SENDFILE_MAX_COUNT = 0x7ffff000
+# bytes of compressed request data fed to the decompressor at once
+DECOMPRESS_INPUT_SIZE = 16 * 1024
+# maximum bytes of decompressed request data produced at once
+DECOMPRESS_OUTPUT_SIZE = 64 * 1024
+# number of bytes at the end of the request to remember for GzipOutput.skip_input_suffixes
+INPUT_TAIL_SIZE = 16
+# bytes read from the output of a process at first, reads grow up to the size of the pipe
+# while they keep filling up and shrink again when the process produces less
+MIN_READ_SIZE = 8192
+# size of pipes where it can't be queried
+DEFAULT_PIPE_SIZE = 64 * 1024
+# bytes per write when sending spooled output
+SPOOL_CHUNK_SIZE = 64 * 1024
+# git closes its output right before exiting, its exit status is polled for with
+# intervals growing from the first to the second
+EXIT_STATUS_POLL_INTERVAL = 0.005
+MAX_EXIT_STATUS_POLL_INTERVAL = 0.5
+# fcntl commands of Linux to resize pipes
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+def set_pipe_size(fd, size):
+    """Try to resize the buffer of a pipe, returns its resulting size or None if unknown"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except (IOError, OSError) as e:
+        # more than /proc/sys/fs/pipe-max-size or the user's pipe buffer quota
+        logger.debug('Unable to resize pipe to %d bytes: %s', size, e)
+    try:
+        return fcntl.fcntl(fd, F_GETPIPE_SZ)
+    except (IOError, OSError):
+        return None
+
 class FileWrapper(object):
-    """Wraps a file and communicates with HTTP client"""
+    """Wraps a file and communicates with HTTP client
+
+    Supports three ways of transferring the file: reading chunks of chunk_size
+    bytes (the default), handing the file to the kernel with os.sendfile and,
+    where sendfile is not available, large writes from an mmap of the file.
+    """
+
+    mmap = None
+    socket_fd = None
+    tracked = False
+    throttle = None
+    access = None
+
+    def __init__(self, request, filename, headers={}, chunk_size=8192, sendfile=False, etag=None, throttle=None, access=None):
+        """Wrap a file
 
-    def __init__(self, request, filename, headers={}):
+        Handles conditional requests (If-None-Match, If-Modified-Since) and single
+        byte ranges (Range, If-Range).
+
+        :param request: tornado request object
+        :param filename: file to send
+        :param headers: headers to be included in the response
+        :param chunk_size: number of bytes to read resp. write at once
+        :param sendfile: use os.sendfile or mmap instead of reading chunks
+        :param etag: strong entity tag of the file, only to be given for immutable files
+        :param throttle: gittornado.ratelimit.Throttle to pace sending the file with
+        :param access: gittornado.accesslog.AccessEntry of the request
+        """
         self.request = request
         self.headers = headers.copy()
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self.access = access
+        self.ioloop = tornado.ioloop.IOLoop.instance()
 
         try:
             self.file = open(filename, 'rb')
-            filesize = os.path.getsize(filename)
-        except:
+            st = os.fstat(self.file.fileno())
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise tornado.web.HTTPError(404, 'File not found')
             raise tornado.web.HTTPError(500, 'Unable to open file')
+        filesize = st.st_size
+        mtime = int(st.st_mtime)
 
-        self.headers.update({'Date': get_date_header(), 'Content-Length': str(filesize)})
-        self.request.write('HTTP/1.1 200 OK\r\n' + '\r\n'.join([ k + ': ' + v for k, v in self.headers.items()]) + '\r\n\r\n')
+        self.headers.update({'Date': get_date_header(),
+                             'Last-Modified': get_date_header(datetime.datetime.utcfromtimestamp(mtime)),
+                             'Accept-Ranges': 'bytes'})
+        if etag is not None:
+            self.headers['ETag'] = etag
 
+        if self._not_modified(etag, mtime):
+            logger.debug("Client has current version of %s, sending 304", filename)
+            self.file.close()
+            self._write('HTTP/1.1 304 Not Modified\r\n' + '\r\n'.join([ k + ': ' + v for k, v in self.headers.items()]) + '\r\n\r\n')
+            self._finish()
+            return
+
+        byterange = None
+        if 'Range' in request.headers and self._if_range(etag, mtime):
+            byterange = parse_range_header(request.headers['Range'], filesize)
+
+        if byterange is False:
+            logger.debug("Range %r not satisfiable for %s", request.headers['Range'], filename)
+            self.file.close()
+            self._write('HTTP/1.1 416 Requested Range Not Satisfiable\r\nDate: %s\r\nContent-Range: bytes */%d\r\nContent-Length: 0\r\n\r\n' % (
+                        get_date_header(), filesize))
+            self._finish()
+            return
+
+        if byterange is not None:
+            start, end = byterange
+            logger.debug("Sending bytes %d-%d of %s", start, end, filename)
+            self.offset = start
+            self.remaining = end - start + 1
+            self.file.seek(start)
+            self.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, filesize)
+            status = '206 Partial Content'
+        else:
+            self.offset = 0
+            self.remaining = filesize
+            status = '200 OK'
+
+        self.headers['Content-Length'] = str(self.remaining)
+        header = 'HTTP/1.1 ' + status + '\r\n' + '\r\n'.join([ k + ': ' + v for k, v in self.headers.items()]) + '\r\n\r\n'
+
+        stream = self.request.connection.stream
+        if sendfile and self.remaining > 0:
+            if hasattr(os, 'sendfile') and not isinstance(stream, tornado.iostream.SSLIOStream):
+                # sendfile needs the headers to be on the wire before we take over the socket
+                logger.debug("Sending %s with sendfile", filename)
+                self._write(header, self._start_sendfile)
+                return
+            else:
+                logger.debug("Sending %s from mmap", filename)
+                self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.chunk_size = max(self.chunk_size, MMAP_CHUNK_SIZE)
+
+        if self.access is not None:
+            # the client going away is the only way to learn that a chunked transfer ended early
+            self.request.connection.stream.set_close_callback(self._on_connection_close)
+        self._write(header)
         self.write_chunk()
 
+    def _not_modified(self, etag, mtime):
+        """Check the conditional headers of the request"""
+        if 'If-None-Match' in self.request.headers:
+            # If-None-Match takes precedence over If-Modified-Since
+            return etag is not None and etag_matches(self.request, etag)
+
+        if 'If-Modified-Since' in self.request.headers:
+            since = parse_date_header(self.request.headers['If-Modified-Since'])
+            return since is not None and mtime <= since
+
+        return False
+
+    def _if_range(self, etag, mtime):
+        """Check whether the Range header should be honoured according to If-Range"""
+        if 'If-Range' not in self.request.headers:
+            return True
+
+        validator = self.request.headers['If-Range'].strip()
+        if validator.startswith('"') or validator.startswith('W/'):
+            # only strong entity tags are allowed to be compared here
+            return etag is not None and validator == etag
+
+        return parse_date_header(validator) == mtime
+
     def write_chunk(self):
-        data = self.file.read(8192)
+        if self.request.connection.stream.closed():
+            # the client went away while we were waiting
+            return self._on_connection_close()
+
+        if self.mmap is not None:
+            data = self.mmap[self.offset:self.offset + min(self.remaining, self.chunk_size)]
+        else:
+            data = self.file.read(min(self.remaining, self.chunk_size))
 
         if data == '':
             # EOF
-            self.file.close()
-            self.request.finish()
+            self._close_file()
+            self._finish()
             return
 
+        self.offset += len(data)
+        self.remaining -= len(data)
+
+        callback = self.write_chunk
+        if self.throttle is not None:
+            delay = self.throttle.consume(len(data))
+            if delay and self.remaining > 0:
+                resume_at = time.time() + delay
+                callback = lambda: self.ioloop.add_timeout(resume_at, self.write_chunk)
+
         # write data to client and continue when data has been written
-        self.request.write(data, self.write_chunk)
+        self._write(data, callback)
+
+    def _write(self, data, callback=None):
+        if self.access is not None:
+            self.access.write(data)
+        self.request.write(data, callback)
+
+    def _finish(self):
+        stream = self.request.connection.stream
+        if self.access is not None:
+            stream.set_close_callback(None)
+        if not stream.closed():
+            self.request.finish()
+        if self.access is not None:
+            self.access.finish()
+
+    def _on_connection_close(self):
+        if not self.file.closed:
+            self._close_file()
+        if self.access is not None:
+            self.access.finish()
+
+    def _start_sendfile(self):
+        self.tracked = isinstance(self.request, TrackedRequest)
+        # duplicate the fd since the socket is already registered with the ioloop by the IOStream
+        self.socket_fd = os.dup(self.request.connection.stream.socket.fileno())
+        self.ioloop.add_handler(self.socket_fd, self._handle_socket_event, self.ioloop.WRITE | self.ioloop.ERROR)
+
+    def _handle_socket_event(self, fd, events):
+        """Eventhandler for the client socket in sendfile mode"""
+
+        assert fd == self.socket_fd
+
+        if events & self.ioloop.ERROR:
+            logger.debug('Error on client socket, aborting sendfile')
+            return self._abort_sendfile()
+
+        while self.remaining > 0:
+            try:
+                sent = os.sendfile(fd, self.file.fileno(), self.offset, min(self.remaining, SENDFILE_MAX_COUNT))
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return # socket buffer full, wait for the next write event
+                logger.debug('sendfile failed: %s', e)
+                return self._abort_sendfile()
+
+            if sent == 0:
+                logger.error('File shrunk while sending it')
+                return self._abort_sendfile()
+
+            self.offset += sent
+            self.remaining -= sent
+            if self.tracked:
+                self.request.sent(sent)
+            if self.access is not None:
+                self.access.sent(sent)
+
+            if self.throttle is not None:
+                delay = self.throttle.consume(sent)
+                if delay and self.remaining > 0:
+                    # only listen for errors until we may send again
+                    self.ioloop.update_handler(fd, self.ioloop.ERROR)
+                    self.ioloop.add_timeout(time.time() + delay, self._resume_sendfile)
+                    return
+
+        self._stop_sendfile()
+        self._finish()
+
+    def _resume_sendfile(self):
+        if self.socket_fd is not None:
+            self.ioloop.update_handler(self.socket_fd, self.ioloop.WRITE | self.ioloop.ERROR)
+
+    def _stop_sendfile(self):
+        self.ioloop.remove_handler(self.socket_fd)
+        os.close(self.socket_fd)
+        self.socket_fd = None
+        self._close_file()
+
+    def _abort_sendfile(self):
+        self._stop_sendfile()
+        # the response is incomplete, so the connection can not be used anymore
+        self.request.connection.stream.close()
+        if self.tracked:
+            self.request.report()
+        if self.access is not None:
+            self.access.finish()
+
+    def _close_file(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
+
+class BufferWrapper(object):
+    """Sends an in-memory buffer to the HTTP client
+
+    Answers with 304 Not Modified if the client already has the current version
+    """
+
+    def __init__(self, request, data, headers={}, etag=None, access=None):
+        self.request = request
+        self.headers = headers.copy()
+        self.headers['Date'] = get_date_header()
+
+        if etag is not None:
+            self.headers['ETag'] = etag
 
+        if etag is not None and etag_matches(request, etag):
+            logger.debug("Client has current version, sending 304")
+            response = 'HTTP/1.1 304 Not Modified\r\n' + '\r\n'.join([ k + ': ' + v for k, v in self.headers.items()]) + '\r\n\r\n'
+        else:
+            self.headers['Content-Length'] = str(len(data))
+            response = 'HTTP/1.1 200 OK\r\n' + '\r\n'.join([ k + ': ' + v for k, v in self.headers.items()]) + '\r\n\r\n' + data
+
+        self.request.write(response)
+        self.request.finish()
+        if access is not None:
+            access.write(response)
+            access.finish()
 
+class ChunkQueue(object):
+    """FIFO of data chunks
+
+    Consuming part of a chunk only moves an offset, so neither appending
+    nor consuming copies the queued data.
+    """
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.offset = 0 # number of bytes already consumed of the first chunk
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def peek(self):
+        """Get a view of the unconsumed data of the first chunk"""
+        return memoryview(self.chunks[0])[self.offset:]
+
+    def consume(self, count):
+        """Drop count bytes from the front of the queue"""
+        self.size -= count
+        while count:
+            available = len(self.chunks[0]) - self.offset
+            if count < available:
+                self.offset += count
+                return
+            count -= available
+            self.chunks.popleft()
+            self.offset = 0
+
+class GzipOutput(object):
+    """Settings for gzip compression of the output of a process"""
+
+    def __init__(self, level=6, min_size=1024, skip_input_suffixes=()):
+        """
+        :param level: zlib compression level
+        :param min_size: output smaller than this is sent uncompressed
+        :param skip_input_suffixes: the output is sent uncompressed if the request body
+                                    ends with one of these, e.g. because it will contain a pack
+        """
+        self.level = level
+        self.min_size = min_size
+        self.skip_input_suffixes = tuple(skip_input_suffixes)
 
 class ProcessWrapper(object):
     """Wraps a subprocess and communicates with HTTP client
@@ -72,46 +416,141 @@ class ProcessWrapper(object):
     headers_sent = False
     got_request = False
     sent_chunks = False
-
-    number_of_8k_chunks_sent = 0
+    sent_output = False
+
+    # the stdout pipe is resized to this many bytes if possible, None to leave it alone.
+    # Pipes of a user exceeding /proc/sys/fs/pipe-user-pages-soft in total get tiny
+    # buffers, so this should not be much larger than necessary.
+    pipe_size = 256 * 1024
+    read_size = MIN_READ_SIZE
+    max_read_size = DEFAULT_PIPE_SIZE
+    output_reads = 0
+    output_size = 0
+
+    # HTTP/1.0 responses need a Content-Length, so the output is collected until the process
+    # exited, in memory up to spool_memory_size bytes and in a temporary file beyond that
+    spool_memory_size = 1024 * 1024
+    spool = None
+    spooled = 0
+    sending_spool = False
+    # compresses spooled output while it is sent, the connection is closed at its end
+    spool_compressor = None
 
     gzip_decompressor = None
     gzip_header_seen = False
+    gzip_tail = ''
+
+    # abort with 413 if the (decompressed) request exceeds this many bytes
+    max_input_size = None
+    input_size = 0
+    aborted = False
 
-    process_input_buffer = ''
+    # reading the request is paused when more than input_high_watermark bytes wait
+    # to be written to the process and resumed when less than input_low_watermark wait
+    input_high_watermark = 1024 * 1024
+    input_low_watermark = 256 * 1024
+    input_paused = False
+
+    # reading output of the process is paused when more than output_high_watermark
+    # bytes wait to be sent to the client and resumed when everything has been sent
+    output_high_watermark = 1024 * 1024
+    output_pending = 0
+    output_paused = False
+
+    # output is paced by a gittornado.ratelimit.Throttle, throttled while waiting to send more
+    throttle = None
+    throttled = False
+
+    # gittornado.accesslog.AccessEntry of the request
+    access = None
 
     output_prelude = ''
+    output_tee = None
+
+    # output is held back until we know whether it is worth compressing
+    gzip_output = None
+    gzip_compressor = None
+    held_output = None
+    held_size = 0
+    input_tail = ''
 
-    def __init__(self, request, command, headers, output_prelude=''):
+    finish_callback = None
+    flight = None
+    tracked = None
+
+    def __init__(self, request, command, headers, output_prelude='', output_tee=None, max_input_size=None, gzip_output=None,
+                 finish_callback=None, flight=None, env=None, spawner=None, throttle=None, access=None):
         """Wrap a subprocess
         
         :param request: tornado request object
         :param command: command to be given to subprocess.Popen 
         :param headers: headers to be included on success
         :param output_prelude: data to send before the output of the process
+        :param output_tee: object whose write method gets a copy of the output of the process
+                           and whose finish method gets the return value of the process
+        :param max_input_size: maximum size of the decompressed request body
+        :param gzip_output: GzipOutput if the client accepts gzip compressed responses
+        :param finish_callback: called with the return value of the process once it finished
+        :param flight: gittornado.flight.Flight to share the response with clients that sent the same request
+        :param env: environment of the process, defaults to ours
+        :param spawner: gittornado.spawner.Spawner to start the process with instead of subprocess.Popen
+        :param throttle: gittornado.ratelimit.Throttle to pace the output with
+        :param access: gittornado.accesslog.AccessEntry of the request
         """
         self.request = request
         self.headers = headers
         self.output_prelude = output_prelude
+        self.output_tee = output_tee
+        self.max_input_size = max_input_size
+        self.gzip_output = gzip_output
+        self.finish_callback = finish_callback
+        self.flight = flight
+        self.throttle = throttle
+        self.access = access
+        if gzip_output is not None and request.supports_http_1_1():
+            self.held_output = []
+        if not request.supports_http_1_1():
+            self.spool = tempfile.SpooledTemporaryFile(self.spool_memory_size)
+        self.input_queue = ChunkQueue()
+        # gzipped input that still needs to be decompressed
+        self.compressed_queue = ChunkQueue()
 
         # invoke process
-        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-
-        # check return status
-        if self.process.poll() is not None:
-            raise tornado.web.HTTPError(500, 'subprocess returned prematurely')
+        # the process might already have exited at this point, which is fine since its
+        # output and exit status are picked up by the handlers below
+        if spawner is not None:
+            self.process = spawner.spawn(command, env)
+        else:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        if isinstance(request, TrackedRequest):
+            self.tracked = request
+            self.tracked.process_started()
+        if self.access is not None:
+            self.access.mark('spawn')
 
         # get fds
         self.fd_stdout = self.process.stdout.fileno()
         self.fd_stderr = self.process.stderr.fileno()
         self.fd_stdin = self.process.stdin.fileno()
 
+        # a larger pipe lets git write ahead and us read more at once
+        if self.pipe_size is not None:
+            self.max_read_size = set_pipe_size(self.fd_stdout, self.pipe_size) or DEFAULT_PIPE_SIZE
+
         # register with ioloop
         self.ioloop = tornado.ioloop.IOLoop.instance()
         self.ioloop.add_handler(self.fd_stdout, self._handle_stdout_event, self.ioloop.READ | self.ioloop.ERROR)
         self.ioloop.add_handler(self.fd_stderr, self._handle_stderr_event, self.ioloop.READ | self.ioloop.ERROR)
         self.ioloop.add_handler(self.fd_stdin, self._handle_stdin_event, self.ioloop.WRITE | self.ioloop.ERROR)
 
+        if self.flight is not None:
+            # the slowest follower holds back the output just like our own client
+            self.flight.drain_callback = self._resume_stdout
+            self.flight.abandon_callback = self._kill
+
+        # kill the process if the client goes away
+        self.request.connection.stream.set_close_callback(self._on_connection_close)
+
         # is it gzipped? If yes, we initialize a zlib decompressobj
         if 'gzip' in request.headers.get('Content-Encoding', '').lower(): # HTTP/1.1 RFC says value is case-insensitive
             logger.debug("Gzipped request. Initializing decompressor.")
@@ -119,19 +558,21 @@ class ProcessWrapper(object):
 
         if self.request.method == 'POST':
             # Handle chunked encoding
-            if request.headers.get('Expect', None) == '100-continue' and request.headers.get('Transfer-Encoding', None) == 'chunked':
-                logger.debug('Request uses chunked transfer encoding. Sending 100 Continue.')
+            if request.headers.get('Transfer-Encoding', None) == 'chunked':
+                # tornado does not read chunked bodies, so they are still waiting in the stream
                 self.httpstream = self.request.connection.stream
-                self.request.write("HTTP/1.1 100 (Continue)\r\n\r\n")
+                if request.headers.get('Expect', None) == '100-continue':
+                    logger.debug('Request uses chunked transfer encoding. Sending 100 Continue.')
+                    self.request.write("HTTP/1.1 100 (Continue)\r\n\r\n")
+                else:
+                    logger.debug('Request uses chunked transfer encoding.')
                 self.read_chunks()
             else:
                 logger.debug('Got complete request')
                 if self.gzip_decompressor:
                     assert request.body[:2] == '\x1f\x8b', "gzip header"
-                    self.process_input_buffer = self.gzip_decompressor.decompress(request.body)
-                else:
-                    self.process_input_buffer = request.body
                 self.got_request = True
+                self._feed_input(request.body)
         else:
             logger.debug("Method %s has no input", self.request.method)
             self.got_request = True
@@ -150,7 +591,10 @@ class ProcessWrapper(object):
             logger.debug("Fast-Path detected, returning...")
             return
 
-        while not self.got_request:
+        if self.aborted:
+            return
+
+        while not self.got_request and not self.input_paused:
             self.reading_chunks = True
             self.got_chunk = False
             # chunk starts with length, so read it. This will then subsequently also read the chunk
@@ -186,7 +630,8 @@ class ProcessWrapper(object):
             self.got_request = True
             # enable input write event so the handler can finish things up 
             # when it has written all pending data
-            self.ioloop.update_handler(self.fd_stdin, self.ioloop.WRITE | self.ioloop.ERROR)
+            if not self.process.stdin.closed:
+                self.ioloop.update_handler(self.fd_stdin, self.ioloop.WRITE | self.ioloop.ERROR)
 
     def _chunk_data(self, data):
         """Received chunk data"""
@@ -198,22 +643,79 @@ class ProcessWrapper(object):
                 assert data[:2] == '\x1f\x8b', "gzip header"
                 self.gzip_header_seen = True
 
-            self.process_input_buffer += self.gzip_decompressor.decompress(data[:-2])
-        else:
-            self.process_input_buffer += data[:-2]
-
         self.got_chunk = True
+        if self.tracked is not None:
+            self.tracked.received(len(data) - 2)
+        if self.access is not None:
+            self.access.received(len(data) - 2)
+        self._feed_input(data[:-2])
 
-        if self.process_input_buffer:
-            # since we now have data in the buffer, enable write events again
-            logger.debug('Got data in buffer, interested in writing to process again')
-            self.ioloop.update_handler(self.fd_stdin, self.ioloop.WRITE | self.ioloop.ERROR)
+        if self.aborted:
+            return
+
+        if len(self.input_queue) >= self.input_high_watermark:
+            # git does not keep up, stop reading from the client until it caught up
+            logger.debug('Input buffer full (%d bytes), pausing request', len(self.input_queue))
+            self.input_paused = True
+            return
 
         # do NOT call read_chunks directly. This is to give git a chance to consume input.
         # we don't want to grow the buffer unnecessarily.
         # Additionally, this should mitigate the stack explosion mentioned in read_chunks
         self.ioloop.add_callback(self.read_chunks)
 
+    def _feed_input(self, data):
+        """Queue request data for the process"""
+
+        if self.process.stdin.closed:
+            # git is not interested in further input, just drain the request
+            return
+
+        if self.gzip_decompressor:
+            self.compressed_queue.append(data)
+        else:
+            self._queue_input(data)
+
+        self._pump_input()
+
+        if self.input_queue and not self.aborted:
+            # since we now have data in the buffer, enable write events again
+            logger.debug('Got data in buffer, interested in writing to process again')
+            self.ioloop.update_handler(self.fd_stdin, self.ioloop.WRITE | self.ioloop.ERROR)
+
+    def _pump_input(self):
+        """Decompress pending input until the input queue is full again
+
+        Compressed data is fed to the decompressor in small pieces and its output is
+        limited, so neither the compressed nor the decompressed data is ever copied
+        or expanded as a whole.
+        """
+
+        while self.gzip_tail or self.compressed_queue:
+            if len(self.input_queue) >= self.input_high_watermark or self.aborted:
+                return
+
+            if self.gzip_tail:
+                data = self.gzip_tail
+            else:
+                data = self.compressed_queue.peek()[:DECOMPRESS_INPUT_SIZE].tobytes()
+                self.compressed_queue.consume(len(data))
+
+            try:
+                self._queue_input(self.gzip_decompressor.decompress(data, DECOMPRESS_OUTPUT_SIZE))
+            except zlib.error as e:
+                return self._abort(400, 'Bad Request', 'Unable to decompress request: %s' % e)
+            self.gzip_tail = self.gzip_decompressor.unconsumed_tail
+
+    def _queue_input(self, data):
+        self.input_size += len(data)
+        if self.max_input_size is not None and self.input_size > self.max_input_size:
+            return self._abort(413, 'Request Entity Too Large', 'Request exceeds %d bytes' % self.max_input_size)
+        self.input_queue.append(data)
+
+        if self.gzip_output is not None and data:
+            self.input_tail = (self.input_tail + data[-INPUT_TAIL_SIZE:])[-INPUT_TAIL_SIZE:]
+
     def _handle_stdin_event(self, fd, events):
         """Eventhandler for stdin"""
 
@@ -222,22 +724,32 @@ class ProcessWrapper(object):
         if events & self.ioloop.ERROR:
             # An error at the end is expected since tornado maps HUP to ERROR
             logger.debug('Error on stdin')
-            # ensure pipe is closed
-            if not self.process.stdin.closed:
-                self.process.stdin.close()
-            # remove handler
-            self.ioloop.remove_handler(self.fd_stdin)
-            # if all fds are closed, we can finish
-            return self._graceful_finish()
+            return self._close_stdin()
 
         # got data ready
         logger.debug('stdin ready for write')
-        if self.process_input_buffer:
-            count = os.write(fd, self.process_input_buffer)
-            logger.debug('Wrote first %d bytes of %d total', count, len(self.process_input_buffer))
-            self.process_input_buffer = self.process_input_buffer[count:]
-
-        if not self.process_input_buffer:
+        if self.input_queue:
+            try:
+                count = os.write(fd, self.input_queue.peek())
+            except OSError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                logger.debug('Process closed stdin')
+                return self._close_stdin()
+            logger.debug('Wrote first %d bytes of %d total', count, len(self.input_queue))
+            self.input_queue.consume(count)
+            if self.access is not None:
+                self.access.mark('first_stdin')
+
+        if len(self.input_queue) < self.input_low_watermark:
+            self._pump_input()
+
+            if self.input_paused and not self.compressed_queue and len(self.input_queue) < self.input_low_watermark:
+                logger.debug('Input buffer drained, resuming request')
+                self.input_paused = False
+                self.ioloop.add_callback(self.read_chunks)
+
+        if not self.input_queue:
             # consumed everything in the buffer
             if self.got_request:
                 # we got the request and wrote everything to the process
@@ -253,6 +765,22 @@ class ProcessWrapper(object):
                 logger.debug('Not interested in write events on stdin anymore')
                 self.ioloop.update_handler(fd, self.ioloop.ERROR)
 
+    def _close_stdin(self):
+        # ensure pipe is closed
+        if not self.process.stdin.closed:
+            self.process.stdin.close()
+        # remove handler
+        self.ioloop.remove_handler(self.fd_stdin)
+        # remaining input is not going to be consumed anymore
+        self.input_queue = ChunkQueue()
+        self.compressed_queue = ChunkQueue()
+        self.gzip_tail = ''
+        if self.input_paused:
+            self.input_paused = False
+            self.ioloop.add_callback(self.read_chunks)
+        # if all fds are closed, we can finish
+        return self._graceful_finish()
+
     def _handle_stdout_event(self, fd, events):
         """Eventhandler for stdout"""
 
@@ -266,54 +794,36 @@ class ProcessWrapper(object):
             # HTTP/1.1 in which case we can stream the answer in chunked mode
             # in HTTP/1.0 we need to send a content-length and thus buffer the complete output
             if self.request.supports_http_1_1():
-                if not self.headers_sent:
-                    self.sent_chunks = True
-                    self.headers.update({'Date': get_date_header(), 'Transfer-Encoding': 'chunked'})
-                    data = 'HTTP/1.1 200 OK\r\n' + '\r\n'.join([ k + ': ' + v for k, v in self.headers.items()]) + '\r\n\r\n'
-
-                    if self.output_prelude:
-                        data += hex(len(self.output_prelude))[2:] + "\r\n" # cut off 0x
-                        data += self.output_prelude + "\r\n"
-
-                    self.headers_sent = True
-
-                payload = os.read(fd, 8192)
+                payload = self._read_stdout(fd)
                 if events & self.ioloop.ERROR: # there might be data remaining in the buffer if we got HUP, get it all
-                    remainder = True
-                    while remainder != '': # until EOF
-                        remainder = os.read(fd, 8192)
-                        payload += remainder
+                    pieces = [payload]
+                    while pieces[-1]: # until EOF
+                        pieces.append(self._read_stdout(fd))
+                    payload = ''.join(pieces)
+
+                if self.output_tee is not None:
+                    self.output_tee.write(payload)
 
-                data += hex(len(payload))[2:] + "\r\n" # cut off 0x
-                data += payload + "\r\n"
+                data = self._frame_chunk(payload, events & self.ioloop.ERROR)
 
             else:
+                payload = self._read_stdout(fd)
+                if events & self.ioloop.ERROR:
+                    pieces = [payload]
+                    while pieces[-1]:
+                        pieces.append(self._read_stdout(fd))
+                    payload = ''.join(pieces)
+
+                if self.output_tee is not None:
+                    self.output_tee.write(payload)
                 if not self.headers_sent:
-                    # Use the over-eager blocking read that will get everything until we hit EOF
-                    # this might actually be somewhat dangerous as noted in the subprocess documentation
-                    # and lead to a deadlock. This is only a legacy mode for HTTP/1.0 clients anyway,
-                    # so we might want to remove it entirely anyways
-                    payload = self.process.stdout.read()
-                    self.headers.update({'Date': get_date_header(), 'Content-Length': str(len(payload))})
-                    data = 'HTTP/1.0 200 OK\r\n' + '\r\n'.join([ k + ': ' + v for k, v in self.headers.items()]) + '\r\n\r\n'
-                    self.headers_sent = True
-                    data += self.output_prelude + payload
-                else:
-                    # this is actually somewhat illegal as it messes with content-length but 
-                    # it shouldn't happen anyways, as the read above should have read anything
-                    # python docs say this can happen on ttys...
-                    logger.error("This should not happen")
-                    data = self.process.stdout.read()
-
-            if len(data) == 8200:
-                self.number_of_8k_chunks_sent += 1
-            else:
-                if self.number_of_8k_chunks_sent > 0:
-                    logger.debug('Sent %d * 8192 bytes', self.number_of_8k_chunks_sent)
-                    self.number_of_8k_chunks_sent = 0
+                    # sent with a Content-Length once the process exited
+                    self.spool.write(payload)
+                    self.spooled += len(payload)
+                    self.sent_output = self.sent_output or bool(payload)
 
-                logger.debug('Sending stdout to client %d bytes: %r', len(data), data[:20])
-            self.request.write(data)
+            if data:
+                self._write(data)
 
         # now we can also have an error. This is because tornado maps HUP onto error
         # therefore, no elif here!
@@ -327,6 +837,21 @@ class ProcessWrapper(object):
             # if all fds are closed, we can finish
             return self._graceful_finish()
 
+    def _read_stdout(self, fd):
+        """Read whatever output is available, adapting the size of the next read"""
+        payload = os.read(fd, self.read_size)
+        if len(payload) == self.read_size:
+            # there might be more, take it in one go next time
+            self.read_size = min(self.read_size * 2, self.max_read_size)
+        elif len(payload) < self.read_size // 4 and self.read_size > MIN_READ_SIZE:
+            # large reads allocate the whole buffer first
+            self.read_size //= 2
+        self.output_reads += 1
+        self.output_size += len(payload)
+        if self.access is not None and payload:
+            self.access.mark('first_stdout')
+        return payload
+
     def _handle_stderr_event(self, fd, events):
         """Eventhandler for stderr"""
 
@@ -334,19 +859,19 @@ class ProcessWrapper(object):
 
         if events & self.ioloop.READ:
             # got data ready
-            if not self.headers_sent:
+            if not self.headers_sent and not self.held_size and not self.spooled:
                 payload = self.process.stderr.read()
 
                 data = 'HTTP/1.1 500 Internal Server Error\r\nDate: %s\r\nContent-Length: %d\r\n\r\n' % (get_date_header(), len(payload))
                 self.headers_sent = True
                 data += payload
-            else:
-                # see stdout
-                logger.error("This should not happen (stderr)")
-                data = self.process.stderr.read()
 
-            logger.debug('Sending stderr to client: %r', data)
-            self.request.write(data)
+                logger.debug('Sending stderr to client: %r', data)
+                self._write(data)
+            else:
+                # the response is already under way, so there is no way to report this to the client.
+                # do not use a blocking read here, git might be waiting for us to consume stdout
+                logger.warning("Git wrote to stderr after sending output: %r", os.read(fd, 8192))
 
         if events & self.ioloop.ERROR:
             logger.debug('Error on stderr')
@@ -358,6 +883,155 @@ class ProcessWrapper(object):
             # if all fds are closed, we can finish
             return self._graceful_finish()
 
+    def _want_gzip(self, size, eof):
+        """Decide whether to compress output, None if we can't tell yet"""
+        if self.input_tail.endswith(self.gzip_output.skip_input_suffixes):
+            return False
+        if size >= self.gzip_output.min_size:
+            return True
+        if eof:
+            return False
+        return None
+
+    def _frame_chunk(self, payload, eof=False):
+        """Build the data to send to the client for output of the process in chunked mode"""
+        data = ''
+
+        if not self.headers_sent:
+            if self.held_output is not None:
+                self.held_output.append(payload)
+                self.held_size += len(payload)
+
+                compress = self._want_gzip(self.held_size + len(self.output_prelude), eof)
+                if compress is None:
+                    return ''
+
+                payload = ''.join(self.held_output)
+                self.held_output = None
+                self.headers['Vary'] = 'Accept-Encoding'
+                if compress:
+                    logger.debug('Compressing output')
+                    self.gzip_compressor = zlib.compressobj(self.gzip_output.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    self.headers['Content-Encoding'] = 'gzip'
+
+            self.sent_chunks = True
+            self.sent_output = True
+            self.headers.update({'Date': get_date_header(), 'Transfer-Encoding': 'chunked'})
+            data = 'HTTP/1.1 200 OK\r\n' + '\r\n'.join([ k + ': ' + v for k, v in self.headers.items()]) + '\r\n\r\n'
+
+            if self.output_prelude:
+                if self.gzip_compressor is not None:
+                    payload = self.output_prelude + payload
+                else:
+                    data += hex(len(self.output_prelude))[2:] + "\r\n" # cut off 0x
+                    data += self.output_prelude + "\r\n"
+
+            self.headers_sent = True
+
+        if self.gzip_compressor is not None and payload:
+            # flush every time so side-band progress messages reach the client right away
+            size = len(payload)
+            payload = self.gzip_compressor.compress(payload) + self.gzip_compressor.flush(zlib.Z_SYNC_FLUSH)
+            if self.access is not None:
+                self.access.compressed(size, len(payload))
+
+        if payload:
+            # the payload is copied only once
+            data = ''.join((data, '%x\r\n' % len(payload), payload, '\r\n'))
+
+        return data
+
+    def _abort(self, code, reason, message):
+        """Kill the process and answer with an error"""
+
+        logger.warning('Aborting request: %s', message)
+        self.aborted = True
+        self.input_queue = ChunkQueue()
+        self.compressed_queue = ChunkQueue()
+        self.gzip_tail = ''
+
+        if self.process.poll() is None:
+            self.process.kill()
+
+        # parts of the request might still be unread, so the connection can't be reused
+        stream = self.request.connection.stream
+        if not self.headers_sent:
+            self.headers_sent = True
+            self._send('HTTP/1.1 %d %s\r\nDate: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s' % (
+                       code, reason, get_date_header(), len(message), message), stream.close)
+        else:
+            stream.close()
+
+        if self.tracked is not None:
+            # the connection is closed instead of finishing the request
+            self.tracked.report()
+
+        if self.flight is not None:
+            self.flight.finish(True)
+            self.flight = None
+
+    def _send(self, data, callback=None):
+        """Send data to the client and everybody sharing the response"""
+        if self.flight is not None:
+            self.flight.write(data)
+        if self.access is not None:
+            self.access.write(data)
+        self.request.write(data, callback)
+
+    def _write(self, data):
+        """Send data to the client, pausing stdout if the client does not keep up"""
+        self.output_pending += len(data)
+        self._send(data, self._on_output_flushed)
+
+        if self.throttle is not None:
+            delay = self.throttle.consume(len(data))
+            if delay and not self.throttled:
+                self.throttled = True
+                self.ioloop.add_timeout(time.time() + delay, self._on_throttle_passed)
+
+        if self._output_blocked() and not self.output_paused and not self.process.stdout.closed:
+            logger.debug('Client does not keep up (%d bytes pending), pausing stdout', self.output_pending)
+            self.output_paused = True
+            # removing the handler entirely ensures we also don't get HUP before we read everything
+            self.ioloop.remove_handler(self.fd_stdout)
+
+    def _output_blocked(self):
+        if (self.throttled or self.output_pending > self.output_high_watermark) and not self.request.connection.stream.closed():
+            return True
+        return self.flight is not None and self.flight.blocked()
+
+    def _on_output_flushed(self):
+        """Everything written so far has been sent to the client"""
+        self.output_pending = 0
+        self._resume_stdout()
+
+    def _on_throttle_passed(self):
+        self.throttled = False
+        self._resume_stdout()
+
+    def _resume_stdout(self):
+        if self.sending_spool:
+            return self._pump_spool()
+        if self.output_paused and not self.process.stdout.closed and not self._output_blocked():
+            logger.debug('Resuming stdout')
+            self.output_paused = False
+            self.ioloop.add_handler(self.fd_stdout, self._handle_stdout_event, self.ioloop.READ | self.ioloop.ERROR)
+
+    def _on_connection_close(self):
+        """The client closed the connection"""
+        if self.flight is not None and self.flight.leave():
+            logger.debug('Client closed connection, still sending to other clients')
+        else:
+            self._kill()
+
+        # nobody is going to drain stdout anymore, so let the handlers consume the remaining output
+        self._resume_stdout()
+
+    def _kill(self):
+        if self.process.poll() is None:
+            logger.warning('Client closed connection, killing git')
+            self.process.kill()
+
     def _graceful_finish(self):
         """Detect if process has closed pipes and we can finish"""
 
@@ -365,32 +1039,159 @@ class ProcessWrapper(object):
             return # stdout/stderr still open
 
         if not self.process.stdin.closed:
+            self.ioloop.remove_handler(self.fd_stdin)
             self.process.stdin.close()
 
-        if self.number_of_8k_chunks_sent > 0:
-            logger.debug('Sent %d * 8k chunks', self.number_of_8k_chunks_sent)
+        logger.debug('Read %d bytes of output in %d reads', self.output_size, self.output_reads)
+
+        if self.held_size and not self.headers_sent:
+            # output too small for compression
+            self._write(self._frame_chunk('', True))
 
-        logger.debug("Finishing up. Process poll: %r", self.process.poll())
+        self._wait_for_exit(self._finish)
+
+    def _wait_for_exit(self, callback, interval=EXIT_STATUS_POLL_INTERVAL):
+        """Call callback with the exit status of the process once it is known"""
+        retval = self.process.poll()
+        if retval is not None:
+            callback(retval)
+        elif isinstance(self.process, SpawnedProcess):
+            # the spawner reports the exit status separately, it is on its way
+            self.process.set_exit_callback(callback)
+        else:
+            # waiting would block the IOLoop, and git might not have exited yet
+            self.ioloop.add_timeout(time.time() + interval,
+                                    lambda: self._wait_for_exit(callback, min(interval * 2, MAX_EXIT_STATUS_POLL_INTERVAL)))
+
+    def _finish(self, retval):
+        logger.debug("Finishing up. Process poll: %r", retval)
+        if self.tracked is not None:
+            self.tracked.process_exited(retval)
+
+        if self.output_tee is not None:
+            self.output_tee.finish(retval if self.sent_output else None)
+
+        if self.finish_callback is not None:
+            self.finish_callback(retval)
+
+        if self.access is not None:
+            self.access.exit_code = retval
+
+        closed = self.request.connection.stream.closed()
+        if closed and self.tracked is not None:
+            self.tracked.report()
+        if closed and self.flight is None:
+            logger.debug('Connection already closed')
+            if self.access is not None:
+                self.access.finish()
+            return
+
+        if self.spooled and not self.headers_sent:
+            self._send_spool()
+            return
+        if self.spool is not None:
+            self.spool.close()
 
         if not self.headers_sent:
-            retval = self.process.poll()
             if retval != 0:
                 logger.warning("Empty response. Git return value: " + str(retval))
                 payload = "Did not produce any data. Errorcode: " + str(retval)
                 data = 'HTTP/1.1 500 Internal Server Error\r\nDate: %s\r\nContent-Length: %d\r\n\r\n' % (get_date_header(), len(payload))
                 self.headers_sent = True
                 data += payload
-                self.request.write(data)
+                self._send(data)
             else:
                 data = 'HTTP/1.1 200 Ok\r\nDate: %s\r\nContent-Length: 0\r\n\r\n' % get_date_header()
                 self.headers_sent = True
-                self.request.write(data)
+                self._send(data)
 
         # if we are in chunked mode, send end chunk with length 0
         elif self.sent_chunks:
+            if self.gzip_compressor is not None:
+                payload = self.gzip_compressor.flush()
+                if self.access is not None:
+                    self.access.compressed(0, len(payload))
+                self._send(hex(len(payload))[2:] + "\r\n" + payload + "\r\n")
+
             logger.debug("End chunk")
-            self.request.write("0\r\n")
+            self._send("0\r\n")
             #we could now send some more headers resp. trailers
-            self.request.write("\r\n")
+            self._send("\r\n")
+
+        self._finish_response()
+
+    def _compress_spooled(self, data):
+        compressed = self.spool_compressor.compress(data)
+        if self.access is not None:
+            self.access.compressed(len(data), len(compressed))
+        return compressed
+
+    def _finish_response(self):
+        # compressed responses to HTTP/1.0 clients end with the connection
+        close_connection = self.spool_compressor is not None
+        if self.flight is not None:
+            self.flight.finish(close_connection)
+        if close_connection:
+            if self.tracked is not None:
+                # the connection is closed instead of finishing the request
+                self.tracked.report()
+        elif not self.request.connection.stream.closed():
+            self.request.finish()
+        if self.access is not None:
+            self.access.finish()
+
+    def _send_spool(self):
+        """Send the spooled output of the process to an HTTP/1.0 client"""
+        size = len(self.output_prelude) + self.spooled
+        self.headers_sent = True
+        self.sending_spool = True
+        self.spool.seek(0)
+
+        data = self.output_prelude
+        self.headers.update({'Date': get_date_header(), 'Content-Length': str(size)})
+        if self.gzip_output is not None:
+            self.headers['Vary'] = 'Accept-Encoding'
+            if self._want_gzip(size, True):
+                # compressed in chunks while sending, so the size is not known in advance
+                self.spool_compressor = zlib.compressobj(self.gzip_output.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                data = self._compress_spooled(data)
+                del self.headers['Content-Length']
+                self.headers['Content-Encoding'] = 'gzip'
+                self.headers['Connection'] = 'close'
+
+        self._write('HTTP/1.0 200 OK\r\n' + '\r\n'.join([ k + ': ' + v for k, v in self.headers.items()]) + '\r\n\r\n' + data)
+        self._pump_spool()
+
+    def _pump_spool(self):
+        """Send spooled output until the client does not keep up"""
+        stream = self.request.connection.stream
+        if stream.closed() and self.flight is None:
+            self.sending_spool = False
+            self.spool.close()
+            if self.access is not None:
+                self.access.finish()
+            return
 
-        self.request.finish()
+        while not self._output_blocked():
+            if not stream.closed() and stream.writing():
+                # called back for a write that completed right away, which used up the
+                # callback of the one still in progress, so ask to be called again
+                self.request.write('', self._on_output_flushed)
+                return
+
+            data = self.spool.read(SPOOL_CHUNK_SIZE)
+            if not data:
+                self.sending_spool = False
+                self.spool.close()
+                if self.spool_compressor is not None:
+                    data = self.spool_compressor.flush()
+                    if self.access is not None:
+                        self.access.compressed(0, len(data))
+                    self._send(data, stream.close)
+                self._finish_response()
+                return
+            if self.spool_compressor is not None:
+                data = self._compress_spooled(data)
+                if not data:
+                    continue
+            self._write(data)
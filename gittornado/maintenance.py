@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import os
+import os.path
+import time
+import fcntl
+import errno
+import collections
+
+import tornado.ioloop
+
+from gittornado.spawner import Spawner, SpawnedProcess
+
+import logging
+logger = logging.getLogger(__name__)
+
+# maintenance tasks in the order they run and their git arguments
+TASKS = collections.OrderedDict([
+    ('repack', ['repack', '-a', '-d', '-q', '--write-bitmap-index']),
+    ('multi-pack-index', ['multi-pack-index', 'write', '--bitmap']),
+    ('commit-graph', ['commit-graph', 'write', '--reachable']),
+])
+
+class Job(object):
+    """Maintenance tasks running for one repository"""
+
+    process = None
+    task = None
+    started_at = None
+    timeout = None
+    # tail of the output of the running task
+    output = b''
+    # stdout and stderr of the running task while they are open
+    pipes = ()
+
+    def __init__(self, gitdir, tasks, lock):
+        self.gitdir = gitdir
+        self.tasks = [task for task in TASKS if task in tasks]
+        self.lock = lock
+
+class MaintenanceScheduler(object):
+    """Keeps repositories fast to clone by maintaining them after pushes
+
+    Every push adds a pack, so call push_done after each successful one (RPCHandler
+    does so when this is passed as maintenance). Once enough pushes accumulated, the
+    repository is repacked into a single pack with a reachability bitmap, while a
+    multi-pack-index with a bitmap and a commit-graph are written more often in between.
+
+    At most max_processes git processes run at once, at a lower priority than
+    everything else, and never more than one for the same repository. They are
+    started through spawner, a gittornado.spawner.Spawner, if given. Repositories
+    are locked with flock while they are maintained, so several workers sharing
+    them don't get in each other's way either.
+    """
+
+    # set by gittornado.metrics.Metrics.watch_maintenance
+    metrics = None
+
+    def __init__(self, gitcommand='git', max_processes=1, nice=10, repack_after=100, max_packs=20,
+                 midx_after=10, commit_graph_after=10, timeout=3600, spawner=None):
+        """
+        :param max_processes: maximum number of maintenance processes running at once
+        :param nice: niceness increment of maintenance processes
+        :param repack_after: pushes after which a repository is repacked, None to never repack
+        :param max_packs: number of packs after which a repository is repacked right away, None to ignore it
+        :param midx_after: pushes after which a multi-pack-index is written, None to never write one
+        :param commit_graph_after: pushes after which a commit-graph is written, None to only write one after repacking
+        :param timeout: seconds after which a maintenance process is killed
+        :param spawner: gittornado.spawner.Spawner to start the processes with
+        """
+        self.gitcommand = gitcommand
+        self.max_processes = max_processes
+        self.nice = nice
+        self.thresholds = {'repack': repack_after, 'multi-pack-index': midx_after, 'commit-graph': commit_graph_after}
+        self.max_packs = max_packs
+        self.timeout = timeout
+        # one that isn't started runs git under nice itself
+        self.spawner = spawner if spawner is not None else Spawner()
+
+        # gitdir -> task -> pushes since the task last ran
+        self.pushes = {}
+        # gitdir -> set of tasks waiting to run
+        self.queue = collections.OrderedDict()
+        # gitdir -> running Job
+        self.running = {}
+        self.ioloop = tornado.ioloop.IOLoop.instance()
+
+    def push_done(self, gitdir):
+        """Count a push to a repository and schedule the tasks that became due"""
+        counts = self.pushes.setdefault(gitdir, dict.fromkeys(TASKS, 0))
+        due = set()
+        for task, threshold in self.thresholds.items():
+            counts[task] += 1
+            if threshold is not None and counts[task] >= threshold:
+                due.add(task)
+
+        if 'repack' not in due and self.max_packs is not None and self.thresholds['repack'] is not None:
+            packs = count_packs(gitdir)
+            if packs > self.max_packs:
+                logger.debug("%s has %d packs", gitdir, packs)
+                due.add('repack')
+
+        if due:
+            self.schedule(gitdir, due)
+
+    def schedule(self, gitdir, tasks):
+        """Run tasks for a repository, together with those already waiting for it"""
+        tasks = set(tasks)
+        counts = self.pushes.setdefault(gitdir, dict.fromkeys(TASKS, 0))
+        if 'repack' in tasks:
+            # a single pack has its own bitmap, but the commit-graph needs updating
+            tasks.discard('multi-pack-index')
+            counts['multi-pack-index'] = 0
+            tasks.add('commit-graph')
+
+        for task in tasks:
+            counts[task] = 0
+
+        self.queue.setdefault(gitdir, set()).update(tasks)
+        logger.debug("Scheduled %s for %s", ', '.join(sorted(tasks)), gitdir)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Start waiting jobs as long as there is room"""
+        while len(self.running) < self.max_processes:
+            for gitdir in self.queue:
+                if gitdir not in self.running:
+                    break
+            else:
+                return # nothing waiting or only repositories being maintained already
+
+            tasks = self.queue.pop(gitdir)
+            lock = lock_repository(gitdir)
+            if lock is None:
+                logger.info("Skipping maintenance of %s, it is locked by another process", gitdir)
+                continue
+
+            job = self.running[gitdir] = Job(gitdir, tasks, lock)
+            self._next_task(job)
+
+    def _next_task(self, job):
+        """Start the next task of a job or finish it"""
+        while job.tasks:
+            job.task = job.tasks.pop(0)
+            job.output = b''
+            job.started_at = time.time()
+            logger.info("Running %s for %s", job.task, job.gitdir)
+            try:
+                job.process = self.spawner.spawn([self.gitcommand, '--git-dir', job.gitdir] + TASKS[job.task], nice=self.nice)
+            except OSError as e:
+                logger.error("Unable to run %s for %s: %s", job.task, job.gitdir, e)
+                self._record(job, 'error')
+                continue
+
+            job.process.stdin.close()
+            # the output is closed once git and everything it started exited
+            job.pipes = [job.process.stdout, job.process.stderr]
+            for pipe in job.pipes:
+                self.ioloop.add_handler(pipe.fileno(), lambda fd, events, pipe=pipe: self._handle_output(job, pipe),
+                                        self.ioloop.READ | self.ioloop.ERROR)
+            if self.timeout is not None:
+                job.timeout = self.ioloop.add_timeout(time.time() + self.timeout, lambda: self._kill(job))
+            return
+
+        os.close(job.lock)
+        del self.running[job.gitdir]
+        self._dispatch()
+
+    def _handle_output(self, job, pipe):
+        data = os.read(pipe.fileno(), 4096)
+        if data:
+            job.output = (job.output + data)[-4096:]
+            return
+
+        self.ioloop.remove_handler(pipe.fileno())
+        pipe.close()
+        job.pipes.remove(pipe)
+        if job.pipes:
+            return
+        if job.timeout is not None:
+            self.ioloop.remove_timeout(job.timeout)
+            job.timeout = None
+
+        if isinstance(job.process, SpawnedProcess):
+            job.process.set_exit_callback(lambda retval: self._task_done(job, retval))
+        else:
+            self._task_done(job, job.process.wait())
+
+    def _task_done(self, job, retval):
+        if retval == 0:
+            logger.info("%s for %s finished in %.1fs", job.task, job.gitdir, time.time() - job.started_at)
+            self._record(job, 'success')
+        else:
+            logger.warning("%s for %s failed with %s: %s", job.task, job.gitdir, retval, job.output.strip())
+            self._record(job, 'failure')
+        self._next_task(job)
+
+    def _kill(self, job):
+        logger.warning("%s for %s timed out, killing it", job.task, job.gitdir)
+        job.timeout = None
+        job.process.kill()
+
+    def _record(self, job, result):
+        if self.metrics is not None:
+            self.metrics.maintenance_done(job.task, result, time.time() - job.started_at)
+
+def count_packs(gitdir):
+    """Count the packs of a repository"""
+    try:
+        return len([name for name in os.listdir(os.path.join(gitdir, 'objects', 'pack')) if name.endswith('.pack')])
+    except OSError:
+        return 0
+
+def lock_repository(gitdir):
+    """Lock a repository for maintenance, returns the file descriptor holding the lock or None"""
+    try:
+        fd = os.open(gitdir, os.O_RDONLY)
+    except OSError as e:
+        logger.warning("Unable to open %s: %s", gitdir, e)
+        return None
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        os.close(fd)
+        if e.errno not in (errno.EWOULDBLOCK, errno.EACCES):
+            logger.warning("Unable to lock %s: %s", gitdir, e)
+        return None
+    return fd
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import time
+import bisect
+
+import logging
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histograms in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SPAWN_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=''):
+    labels = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(labels) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value == int(value):
+        return str(int(value))
+    return repr(value)
+
+class Metric(object):
+    """Base of all metrics, children are kept per combination of label values"""
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+
+    def labels(self, *values):
+        """Get the child for the given label values, to be kept around in hot paths"""
+        child = self.children.get(values)
+        if child is None:
+            assert len(values) == len(self.labelnames), "label values"
+            child = self.children[values] = self._new_child()
+        return child
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for values, child in sorted(self.children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, values), _format_value(child.value))]
+
+class _Value(object):
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+class Gauge(Counter):
+    """A value that goes up and down"""
+
+    type = 'gauge'
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def set(self, value):
+        self.children[()].set(value)
+
+class _Buckets(object):
+    __slots__ = ['bounds', 'counts', 'sum', 'count']
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Histogram(Metric):
+    """Distribution of observed values in buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        Metric.__init__(self, name, help, labelnames)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labelnames, values, 'le="%s"' % _format_value(bound)), cumulative))
+        lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labelnames, values), _format_value(child.sum)))
+        lines.append('%s_count%s %d' % (self.name, _format_labels(self.labelnames, values), child.count))
+        return lines
+
+class Registry(object):
+    """Collection of metrics rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+        # called before rendering to update metrics that are sampled
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+class TrackedRequest(object):
+    """Stands in for a tornado request and records the metrics of its response
+
+    Everything but writing and finishing is passed on to the wrapped request.
+    """
+
+    first_byte = None
+    code = None
+    reported = False
+
+    def __init__(self, metrics, request, service):
+        self.request = request
+        self.metrics = metrics
+        self.service = service
+        # the body is not read yet with Tornado's stream_request_body
+        self.bytes_in = len(request.body) if isinstance(request.body, bytes) else 0
+        self.bytes_out = 0
+
+    def __getattr__(self, name):
+        return getattr(self.request, name)
+
+    def __repr__(self):
+        return repr(self.request)
+
+    def write(self, chunk, callback=None):
+        if self.code is None and chunk[:5] == 'HTTP/':
+            code = chunk[9:12]
+            if code != '100':
+                self.code = code
+                self.first_byte = time.time()
+        self.bytes_out += len(chunk)
+        self.request.write(chunk, callback)
+
+    def started(self, code):
+        """Record the start of a response not written through write"""
+        self.code = code
+        self.first_byte = time.time()
+
+    def sent(self, count):
+        """Account for data sent without going through write, e.g. with sendfile"""
+        self.bytes_out += count
+
+    def received(self, count):
+        """Account for request data read from the connection directly"""
+        self.bytes_in += count
+
+    def process_started(self):
+        self.metrics.active_processes.labels(self.service).inc()
+
+    def process_exited(self, retval):
+        self.metrics.active_processes.labels(self.service).dec()
+        # the exit status is None if the spawner went away before reporting it
+        self.metrics.process_exits.labels(self.service, 'unknown' if retval is None else str(retval)).inc()
+
+    def finish(self):
+        self.report()
+        self.request.finish()
+
+    def report(self):
+        """Record the metrics of the request, also to be called if the client went away"""
+        if self.reported:
+            return
+        self.reported = True
+        self.metrics._record(self)
+
+class Metrics(object):
+    """The metrics of gittornado handlers and the git processes they run
+
+    Pass an instance as metrics to the handlers and serve it with MetricsHandler.
+    Services are info-refs, upload-pack, receive-pack and file.
+    """
+
+    def __init__(self, registry=None, buckets=DEFAULT_BUCKETS):
+        self.registry = registry if registry is not None else Registry()
+        r = self.registry.register
+
+        self.requests = r(Counter('gittornado_requests_total', 'Finished requests', ['service', 'code']))
+        self.time_to_first_byte = r(Histogram('gittornado_time_to_first_byte_seconds', 'Time until the response started', ['service'], buckets))
+        self.duration = r(Histogram('gittornado_request_duration_seconds', 'Time until the response was complete', ['service'], buckets))
+        self.bytes_in = r(Counter('gittornado_received_bytes_total', 'Bytes of request bodies', ['service']))
+        self.bytes_out = r(Counter('gittornado_sent_bytes_total', 'Bytes of responses including headers', ['service']))
+        self.active_processes = r(Gauge('gittornado_active_processes', 'Running git processes', ['service']))
+        self.process_exits = r(Counter('gittornado_process_exits_total', 'Exit codes of git processes', ['service', 'code']))
+        self.queued_requests = r(Gauge('gittornado_queued_requests', 'Requests waiting for a git process', ['service']))
+        self.auth_failures = r(Counter('gittornado_auth_failures_total', 'Requests rejected for lack of permissions', ['service']))
+        self.rate_limited_requests = r(Counter('gittornado_rate_limited_total', 'Requests rejected for exceeding their rate limit', ['service']))
+        self.maintenance_tasks = r(Counter('gittornado_maintenance_tasks_total', 'Finished maintenance tasks', ['task', 'result']))
+        self.maintenance_duration = r(Histogram('gittornado_maintenance_duration_seconds', 'Time maintenance tasks took', ['task'], buckets))
+        self.maintenance_running = r(Gauge('gittornado_maintenance_running', 'Repositories being maintained'))
+        self.maintenance_queued = r(Gauge('gittornado_maintenance_queued', 'Repositories waiting for maintenance'))
+        self.spawn_duration = r(Histogram('gittornado_spawn_duration_seconds', 'Time it took to start git processes', ['method'], SPAWN_BUCKETS))
+
+    def track(self, request, service):
+        """Get a stand-in for request that records its metrics"""
+        return TrackedRequest(self, request, service)
+
+    def auth_failed(self, service):
+        self.auth_failures.labels(service).inc()
+
+    def rate_limited(self, service):
+        self.rate_limited_requests.labels(service).inc()
+
+    def watch_scheduler(self, scheduler):
+        """Report the queue depth of a gittornado.scheduler.ProcessScheduler"""
+        def collect():
+            for service, pool in scheduler.pools.items():
+                self.queued_requests.labels(service or 'other').set(pool.waiting)
+        self.registry.collectors.append(collect)
+
+    def watch_maintenance(self, maintenance):
+        """Report the activity of a gittornado.maintenance.MaintenanceScheduler"""
+        maintenance.metrics = self
+        def collect():
+            self.maintenance_running.set(len(maintenance.running))
+            self.maintenance_queued.set(len(maintenance.queue))
+        self.registry.collectors.append(collect)
+
+    def maintenance_done(self, task, result, seconds):
+        self.maintenance_tasks.labels(task, result).inc()
+        self.maintenance_duration.labels(task).observe(seconds)
+
+    def watch_spawner(self, spawner):
+        """Record how long a gittornado.spawner.Spawner takes to start processes"""
+        spawner.metrics = self
+
+    def process_spawned(self, method, seconds):
+        self.spawn_duration.labels(method).observe(seconds)
+
+    def render(self):
+        return self.registry.render()
+
+    def _record(self, tracked):
+        service = tracked.service
+        now = time.time()
+        start = tracked.request._start_time
+
+        self.requests.labels(service, tracked.code or 'aborted').inc()
+        if tracked.first_byte is not None:
+            self.time_to_first_byte.labels(service).observe(tracked.first_byte - start)
+        self.duration.labels(service).observe(now - start)
+        self.bytes_in.labels(service).inc(tracked.bytes_in)
+        self.bytes_out.labels(service).inc(tracked.bytes_out)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import os
+import os.path
+import errno
+import hashlib
+import tempfile
+import collections
+
+import tornado.stack_context
+
+from gittornado.cache import get_ref_state
+from gittornado.util import hash_request_body, get_git_protocol
+
+import logging
+logger = logging.getLogger(__name__)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class PackRecorder(object):
+    """Writes the output of an upload-pack process to the cache"""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+
+        fd, self.tmpname = tempfile.mkstemp(prefix='tmp-%d-' % os.getpid(), dir=cache.directory)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        if self.file is None:
+            return
+
+        self.size += len(data)
+        if self.size > self.cache.max_entry_size:
+            logger.debug("Response for %s too large to be cached", self.key)
+            self._discard()
+        else:
+            self.file.write(data)
+
+    def finish(self, retval):
+        if self.file is None or retval != 0:
+            self._discard()
+            return self.cache._resolve(self.key, None)
+
+        self.file.close()
+        self.file = None
+        os.rename(self.tmpname, self.cache.get_path(self.key))
+        self.cache._rescan()
+        self.cache._resolve(self.key, self.cache.get_path(self.key))
+
+    def _discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.unlink(self.tmpname)
+
+class PackCache(object):
+    """Disk cache of upload-pack responses
+
+    Responses are keyed by repository, ref state and a hash of the decompressed
+    request body, so only byte-identical negotiations against unchanged refs share
+    a response. The cache is bounded by the total size of the stored responses and
+    evicts the least recently used ones first.
+
+    While a response is being generated, identical requests wait for it instead of
+    starting their own git process. Workers may share the directory: the size of
+    everything stored there is accounted for whenever a response is added, but
+    requests only wait for responses generated by their own process.
+    """
+
+    def __init__(self, directory, max_bytes=4 * 1024 * 1024 * 1024, max_entry_size=None, max_request_size=1024 * 1024):
+        """
+        :param directory: where to store the responses
+        :param max_bytes: maximum total size of all responses
+        :param max_entry_size: maximum size of a single response, defaults to a quarter of max_bytes
+        :param max_request_size: only requests up to this size (compressed and decompressed) are cached
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_entry_size if max_entry_size is not None else max_bytes // 4
+        self.max_request_size = max_request_size
+
+        # key -> size in least recently used order
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        # key -> callbacks waiting for a response that is being generated
+        self.pending = {}
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._load()
+
+    def _load(self):
+        """Pick up responses stored by a previous run"""
+        for name in os.listdir(self.directory):
+            # left behind by a process that was killed while writing,
+            # unless another worker is still writing it
+            if name.startswith('tmp-') and not _process_alive(int(name.split('-')[1])):
+                os.unlink(os.path.join(self.directory, name))
+        self._rescan()
+
+        logger.debug("Found %d cached responses (%d bytes)", len(self.entries), self.total_bytes)
+
+    def _rescan(self):
+        """Account for the responses on disk, including those stored and evicted by other workers
+
+        get touches the responses it returns, so their mtimes are the shared order of use.
+        """
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith('tmp-'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue # evicted by another worker meanwhile
+            found.append((st.st_mtime, name, st.st_size))
+
+        self.entries = collections.OrderedDict((name, size) for mtime, name, size in sorted(found))
+        self.total_bytes = sum(self.entries.values())
+        self._evict()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get_key(self, gitdir, request):
+        """Compute the cache key for an upload-pack request, None if it can't be cached"""
+        body_hash = hash_request_body(request, self.max_request_size)
+        if body_hash is None:
+            return None
+
+        return hashlib.sha1('\0'.join([gitdir, get_git_protocol(request) or '', repr(get_ref_state(gitdir)), body_hash])).hexdigest()
+
+    def get(self, key):
+        """Get the path of the cached response or None"""
+        size = self.entries.pop(key, None)
+        if size is None:
+            return None
+
+        self.entries[key] = size # mark as most recently used
+        path = self.get_path(key)
+        try:
+            os.utime(path, None) # keep the order across restarts
+        except OSError:
+            logger.warning("Cached response %s vanished", key)
+            del self.entries[key]
+            self.total_bytes -= size
+            return None
+        return path
+
+    def is_pending(self, key):
+        return key in self.pending
+
+    def wait(self, key, callback):
+        """Call callback with the path of the response once it was generated, or None if that failed"""
+        self.pending[key].append(tornado.stack_context.wrap(callback))
+
+    def recorder(self, key):
+        """Get a recorder to be passed as output_tee to ProcessWrapper"""
+        self.pending[key] = []
+        return PackRecorder(self, key)
+
+    def _resolve(self, key, path):
+        for callback in self.pending.pop(key, []):
+            callback(path)
+
+    def _evict(self):
+        while self.entries and self.total_bytes > self.max_bytes:
+            key, size = self.entries.popitem(last=False)
+            logger.debug("Evicting cached response %s (%d bytes)", key, size)
+            self.total_bytes -= size
+            try:
+                os.unlink(self.get_path(key))
+            except OSError:
+                pass
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+"""Cache of the packs generated for upload-pack
+
+git upload-pack runs uploadpack.packObjectsHook instead of git pack-objects if
+it is set, with the command line of pack-objects appended. This module is such a
+hook: it stores the output of pack-objects on disk, keyed by the repository, the
+arguments and the objects asked for on stdin, and sends the stored pack the next
+time the same objects are asked for, no matter how the client negotiated them.
+
+It is run as a script, without importing the rest of gittornado, since git starts
+it for every fetch. Run gittornado-packcache to inspect and prune the cache.
+"""
+
+import os
+import sys
+import time
+import fcntl
+import errno
+import hashlib
+import tempfile
+import argparse
+import subprocess
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# arguments of pack-objects that only change what is written to stderr
+PROGRESS_ARGS = ('--progress', '--all-progress', '--all-progress-implied', '-q')
+
+COPY_SIZE = 64 * 1024
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+class PackObjectsCache(object):
+    """Disk store of pack-objects output, bounded by the total size of the packs
+
+    Every pack is a file named by its key. Packs are written to a temporary file
+    and renamed into place once pack-objects succeeded, and a pack is generated
+    by only one process at a time: others asking for it wait for the lock of its
+    key and then read it. Reading a pack updates its mtime, so eviction removes
+    the least recently used packs first.
+    """
+
+    def __init__(self, directory, max_bytes=4 * 1024 * 1024 * 1024, max_entry_size=None):
+        """
+        :param directory: where to store the packs
+        :param max_bytes: maximum total size of all packs
+        :param max_entry_size: maximum size of a single pack, defaults to a quarter of max_bytes
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_entry_size if max_entry_size is not None else max_bytes // 4
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def get_hook(self):
+        """Command line to set uploadpack.packObjectsHook to, git runs it with a shell"""
+        args = [sys.executable, os.path.abspath(__file__),
+                '--cache-dir', self.directory, '--max-bytes', str(self.max_bytes),
+                '--max-entry-size', str(self.max_entry_size)]
+        return ' '.join(quote(arg) for arg in args)
+
+    def get_config(self):
+        """Arguments making git upload-pack use this cache"""
+        return ['-c', 'uploadpack.packObjectsHook=' + self.get_hook()]
+
+    def get_key(self, gitdir, args, data):
+        """Compute the key of the output of pack-objects run with args and data on stdin in gitdir"""
+        args = [arg for arg in args if arg not in PROGRESS_ARGS]
+        digest = hashlib.sha1()
+        for part in [os.path.realpath(gitdir)] + args:
+            digest.update(part.encode('utf-8') if not isinstance(part, bytes) else part)
+            digest.update(b'\0')
+        digest.update(data)
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + '.pack')
+
+    def open(self, key):
+        """Open a stored pack and mark it as recently used, None if there is none"""
+        try:
+            f = open(self.get_path(key), 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            os.utime(self.get_path(key), None)
+        except OSError:
+            pass # evicted in the meantime, but we have it open
+        return f
+
+    def lock(self, key):
+        """Wait for the lock of a key, returns the descriptor holding it
+
+        Lock files are removed by whoever holds them, so the lock is only ours
+        if the file we locked is still the one in the directory.
+        """
+        path = os.path.join(self.directory, key + '.lock')
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+            os.close(fd)
+
+    def unlock(self, key, fd):
+        try:
+            os.unlink(os.path.join(self.directory, key + '.lock'))
+        except OSError:
+            pass
+        os.close(fd)
+
+    def writer(self):
+        """Get a temporary file to write a pack to, call store or discard when done"""
+        fd, name = tempfile.mkstemp(prefix='tmp-%d-' % os.getpid(), dir=self.directory)
+        return os.fdopen(fd, 'wb'), name
+
+    def store(self, key, name):
+        """Move a written pack into place and make room for it"""
+        os.rename(name, self.get_path(key))
+        self.evict(self.max_bytes)
+
+    def discard(self, name):
+        try:
+            os.unlink(name)
+        except OSError:
+            pass
+
+    def entries(self):
+        """List the stored packs as (key, size, mtime), least recently used first"""
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pack'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue # evicted in the meantime
+            found.append((st.st_mtime, name[:-5], st.st_size))
+        return [(key, size, mtime) for mtime, key, size in sorted(found)]
+
+    def evict(self, max_bytes, max_age=None):
+        """Remove packs until they take up at most max_bytes and none was unused for max_age seconds
+
+        Returns the number of packs and bytes removed.
+        """
+        entries = self.entries()
+        total = sum(size for key, size, mtime in entries)
+        oldest = time.time() - max_age if max_age is not None else None
+        removed = removed_bytes = 0
+        for key, size, mtime in entries:
+            if total <= max_bytes and (oldest is None or mtime >= oldest):
+                break
+            try:
+                os.unlink(self.get_path(key))
+            except OSError:
+                continue # somebody else was faster
+            total -= size
+            removed += 1
+            removed_bytes += size
+        return removed, removed_bytes
+
+    def clean(self):
+        """Remove temporary files of processes that died while writing, returns how many"""
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('tmp-') and not _process_alive(int(name.split('-')[1])):
+                self.discard(os.path.join(self.directory, name))
+                removed += 1
+        return removed
+
+def _send(f, out):
+    """Copy a stored pack to out, returns False if the reader went away"""
+    with f:
+        for data in iter(lambda: f.read(COPY_SIZE), b''):
+            try:
+                _write_all(out, data)
+            except OSError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                return False
+    return True
+
+def _generate(cache, key, command, data, out):
+    """Run pack-objects, send its output to out and store it, returns its exit status"""
+    f, name = cache.writer()
+    size = 0
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except OSError:
+        f.close()
+        cache.discard(name)
+        raise
+
+    # pack-objects only writes after it read all of its input, which is small
+    try:
+        process.stdin.write(data)
+        process.stdin.close()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+
+    for chunk in iter(lambda: os.read(process.stdout.fileno(), COPY_SIZE), b''):
+        try:
+            _write_all(out, chunk)
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # upload-pack went away, nobody is going to read the rest
+            process.kill()
+            break
+
+        size += len(chunk)
+        if f is not None and size > cache.max_entry_size:
+            f.close()
+            f = None
+        elif f is not None:
+            f.write(chunk)
+
+    process.stdout.close()
+    retval = process.wait()
+
+    if f is not None:
+        f.close()
+        if retval == 0:
+            cache.store(key, name)
+            return retval
+    cache.discard(name)
+    return retval
+
+def run_hook(argv, stdin=0, stdout=1):
+    """Run as uploadpack.packObjectsHook: [options] git pack-objects [arguments]"""
+    if 'git' not in argv:
+        sys.stderr.write('usage: packhook.py [options] git pack-objects [arguments]\n')
+        return 2
+    split = argv.index('git')
+    command = argv[split:]
+
+    parser = argparse.ArgumentParser(prog='packhook.py')
+    parser.add_argument('--cache-dir', required=True)
+    parser.add_argument('--max-bytes', type=int, default=4 * 1024 * 1024 * 1024)
+    parser.add_argument('--max-entry-size', type=int)
+    options = parser.parse_args(argv[:split])
+
+    chunks = []
+    for chunk in iter(lambda: os.read(stdin, COPY_SIZE), b''):
+        chunks.append(chunk)
+    data = b''.join(chunks)
+
+    cache = PackObjectsCache(options.cache_dir, options.max_bytes, options.max_entry_size)
+    key = cache.get_key(os.getcwd(), command[1:], data)
+
+    f = cache.open(key)
+    if f is not None:
+        return 0 if _send(f, stdout) else 1
+
+    fd = cache.lock(key)
+    try:
+        # it might have been generated while we were waiting for the lock
+        f = cache.open(key)
+        if f is not None:
+            return 0 if _send(f, stdout) else 1
+        return _generate(cache, key, command, data, stdout)
+    finally:
+        cache.unlock(key, fd)
+
+def _format_size(size):
+    if size < 1024:
+        return '%d B' % size
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024.0
+        if size < 1024 or unit == 'GiB':
+            return '%.1f %s' % (size, unit)
+
+def main():
+    """Inspect and prune a pack-objects cache"""
+    parser = argparse.ArgumentParser(description='Inspect and prune the pack-objects cache of gittornado')
+    parser.add_argument('cache_dir', help='directory of the cache')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.add_parser('stats', help='show the number and total size of stored packs')
+    subparsers.add_parser('list', help='list the stored packs, least recently used first')
+    prune = subparsers.add_parser('prune', help='remove packs and files left behind by killed processes')
+    prune.add_argument('--max-bytes', type=int, help='remove the least recently used packs until they take up at most this many bytes')
+    prune.add_argument('--max-age', type=int, help='remove packs not used for this many seconds')
+    prune.add_argument('--all', action='store_true', help='remove all packs')
+    options = parser.parse_args()
+
+    if not os.path.isdir(options.cache_dir):
+        parser.error('%s is not a directory' % options.cache_dir)
+    cache = PackObjectsCache(options.cache_dir)
+    entries = cache.entries()
+
+    if options.action == 'list':
+        now = time.time()
+        for key, size, mtime in entries:
+            print('%s  %10s  used %ds ago' % (key, _format_size(size), now - mtime))
+
+    elif options.action == 'prune':
+        max_bytes = 0 if options.all else options.max_bytes
+        if max_bytes is None:
+            max_bytes = sum(size for key, size, mtime in entries)
+        removed, removed_bytes = cache.evict(max_bytes, options.max_age)
+        print('Removed %d packs (%s) and %d temporary files' % (removed, _format_size(removed_bytes), cache.clean()))
+
+    else:
+        total = sum(size for key, size, mtime in entries)
+        print('%d packs, %s' % (len(entries), _format_size(total)))
+        if entries:
+            print('Least recently used %ds ago' % (time.time() - entries[0][2]))
+
+if __name__ == '__main__':
+    sys.exit(run_hook(sys.argv[1:]))
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import time
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+class TokenBucket(object):
+    """Tokens trickling in at rate per second, up to burst of them
+
+    Taking more tokens than there are puts the bucket into debt, which the caller
+    pays off by waiting, so a large write doesn't have to be split up.
+    """
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = now if now is not None else time.time()
+
+    def take(self, amount, now):
+        """Take amount tokens, returns the seconds until the bucket is out of debt"""
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def give(self, amount):
+        """Put tokens back that were taken for nothing"""
+        self.tokens = min(self.burst, self.tokens + amount)
+
+class Throttle(object):
+    """The bandwidth buckets a response is sent through"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def consume(self, count):
+        """Account for count bytes sent, returns how many seconds to wait before sending more"""
+        now = time.time()
+        delay = 0
+        for bucket in self.buckets:
+            delay = max(delay, bucket.take(count, now))
+        return delay
+
+class RateLimiter(object):
+    """Limits the requests and bandwidth of users, client addresses and repositories
+
+    Every limit is a tuple of a rate per second and a burst size, requests resp.
+    bytes, or None to not limit that. Requests exceeding their rate are delayed
+    until they are within it again, or answered with 429 if that would take more
+    than max_delay seconds. Responses exceeding their bandwidth are paced by
+    waiting between writes. Users, addresses and repositories share a bucket for
+    all their requests, and the max_buckets most recently used buckets are kept.
+    """
+
+    def __init__(self, user_requests=None, ip_requests=None, repo_requests=None,
+                 user_bandwidth=None, ip_bandwidth=None, repo_bandwidth=None,
+                 max_delay=30, max_buckets=10000):
+        self.request_limits = {'user': user_requests, 'ip': ip_requests, 'repo': repo_requests}
+        self.bandwidth_limits = {'user': user_bandwidth, 'ip': ip_bandwidth, 'repo': repo_bandwidth}
+        self.max_delay = max_delay
+        self.max_buckets = max_buckets
+
+        # (kind, limit, key) -> TokenBucket, least recently used first
+        self.buckets = collections.OrderedDict()
+
+    def admit(self, user, ip, gitdir):
+        """Count a request, returns whether to serve it and the seconds to delay it resp. to retry after
+
+        :param user: name of the authenticated user or None
+        """
+        buckets = self._get_buckets('requests', self.request_limits, user, ip, gitdir)
+        if not buckets:
+            return True, 0
+
+        now = time.time()
+        delay = max([bucket.take(1, now) for bucket in buckets])
+        if self.max_delay is not None and delay > self.max_delay:
+            # a rejected request doesn't count
+            for bucket in buckets:
+                bucket.give(1)
+            logger.info("Rejecting request of %s from %s for %s, it would have to wait %.1fs", user, ip, gitdir, delay)
+            return False, delay
+
+        if delay:
+            logger.debug("Delaying request of %s from %s for %s by %.1fs", user, ip, gitdir, delay)
+        return True, delay
+
+    def get_throttle(self, user, ip, gitdir):
+        """Get the Throttle for a response or None if its bandwidth is not limited"""
+        buckets = self._get_buckets('bandwidth', self.bandwidth_limits, user, ip, gitdir)
+        if not buckets:
+            return None
+        return Throttle(buckets)
+
+    def _get_buckets(self, limit, limits, user, ip, gitdir):
+        buckets = []
+        for kind, key in (('user', user), ('ip', ip), ('repo', gitdir)):
+            if limits[kind] is None or key is None:
+                continue
+
+            name = (kind, limit, key)
+            bucket = self.buckets.pop(name, None)
+            if bucket is None:
+                bucket = TokenBucket(*limits[kind])
+                while len(self.buckets) >= self.max_buckets:
+                    self.buckets.popitem(last=False)
+            self.buckets[name] = bucket
+            buckets.append(bucket)
+        return buckets
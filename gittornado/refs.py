@@ -0,0 +1,718 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import os
+import os.path
+import zlib
+import errno
+import bisect
+import select
+import threading
+import subprocess
+import multiprocessing.pool
+
+import tornado.ioloop
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from gittornado import get_advertisement_prelude
+from gittornado.cache import LRUCache, Advertisement, _stat_key
+from gittornado.util import pkt_line
+
+import logging
+logger = logging.getLogger(__name__)
+
+# git ignores the prefixes of ls-refs requests with this many of them
+MAX_PREFIXES = 65536
+
+# special packets returned by parse_pkt_lines
+FLUSH = 0
+DELIM = 1
+
+# peeled object id of a ref that has yet to be looked up
+PEEL_UNKNOWN = object()
+
+def parse_pkt_lines(data):
+    """Split data into pkt-lines, flush and delimiter packets are returned as FLUSH and DELIM
+
+    Returns None if data is not a sequence of complete pkt-lines."""
+    lines = []
+    offset = 0
+    while offset < len(data):
+        header = data[offset:offset + 4]
+        if len(header) < 4 or header.strip('0123456789abcdefABCDEF'):
+            return None
+        length = int(header, 16)
+        if length in (FLUSH, DELIM):
+            lines.append(length)
+            length = 4
+        elif length < 4 or offset + length > len(data):
+            return None
+        else:
+            lines.append(data[offset + 4:offset + length])
+        offset += length
+    return lines
+
+def popen(command):
+    """Start a process with pipes for stdin, stdout and stderr"""
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+
+def communicate(process, data=''):
+    """Write data to a process and read its output until it closes it, returns stdout
+
+    Like subprocess.Popen.communicate, but also for processes of a gittornado.spawner.Spawner.
+    """
+    stdout, stderr = process.stdout.fileno(), process.stderr.fileno()
+    output = {stdout: [], stderr: []}
+    reading = set(output)
+    writing = process.stdin.fileno() if data else None
+    if writing is None:
+        process.stdin.close()
+
+    offset = 0
+    try:
+        while reading or writing is not None:
+            readable, writable, _ = select.select(list(reading), [writing] if writing is not None else [], [])
+            if writable:
+                try:
+                    # a writable pipe takes PIPE_BUF bytes without blocking
+                    offset += os.write(writing, data[offset:offset + select.PIPE_BUF])
+                except OSError as e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                    offset = len(data)
+                if offset >= len(data):
+                    process.stdin.close()
+                    writing = None
+            for fd in readable:
+                chunk = os.read(fd, 65536)
+                if chunk:
+                    output[fd].append(chunk)
+                else:
+                    reading.discard(fd)
+    finally:
+        for f in (process.stdin, process.stdout, process.stderr):
+            f.close()
+        if isinstance(process, subprocess.Popen):
+            process.wait()
+
+    if output[stderr]:
+        logger.warning("Git wrote to stderr: %r", ''.join(output[stderr])[:1024])
+    return ''.join(output[stdout])
+
+def _read(f, size):
+    """Read size bytes from a pipe, less only at its end"""
+    data = []
+    while size > 0:
+        chunk = f.read(size)
+        if not chunk:
+            break
+        data.append(chunk)
+        size -= len(chunk)
+    return ''.join(data)
+
+def parse_ls_refs(body):
+    """Parse a protocol v2 ls-refs request
+
+    Returns a dict of the arguments for RefTable.ls_refs or None if the request is
+    something else or uses features only git itself knows about.
+    """
+    lines = parse_pkt_lines(body)
+    if not lines or lines[-1] != FLUSH or FLUSH in lines[:-1]:
+        return None
+    lines = [line[:-1] if line not in (FLUSH, DELIM) and line.endswith('\n') else line for line in lines[:-1]]
+    if lines[0] != 'command=ls-refs':
+        return None
+
+    args = {'prefixes': [], 'peel': False, 'symrefs': False, 'unborn': False}
+    in_args = False
+    for line in lines[1:]:
+        if line == DELIM:
+            if in_args:
+                return None
+            in_args = True
+        elif not in_args:
+            if line != 'object-format=sha1' and not line.startswith('agent=') and not line.startswith('session-id='):
+                logger.debug("Unknown capability in ls-refs request: %r", line)
+                return None
+        elif line in ('peel', 'symrefs', 'unborn'):
+            args[line] = True
+        elif line.startswith('ref-prefix '):
+            args['prefixes'].append(line[11:])
+        else:
+            logger.debug("Unknown argument in ls-refs request: %r", line)
+            return None
+    return args
+
+class RefTable(object):
+    """Refs of a repository, sorted by name
+
+    The refs are read from packed-refs and the loose refs below refs/ without running
+    git. refresh only reads packed-refs again if it changed and only the loose refs in
+    directories whose mtime changed, then updates the sorted arrays in place. It may
+    take a while and run git, so RefIndex calls it on a thread of its own. outdated
+    tells cheaply whether it has to be called.
+
+    Object ids of tags are peeled with the peeled lines of packed-refs. Other tags are
+    peeled by reading their loose objects or, if they are packed, with git cat-file.
+    """
+
+    # tables are only limited in number, see RefIndex
+    size = 0
+
+    def __init__(self, gitdir, gitcommand='git', spawn=popen):
+        """
+        :param spawn: starts a process like popen, called from the thread refreshing the table
+        """
+        self.gitdir = gitdir
+        self.gitcommand = gitcommand
+        self.spawn = spawn
+
+        # sorted names of the refs, their object ids and the object ids they peel to or None
+        self.names, self.shas, self.peeled = [], [], []
+        # name -> target of symbolic refs
+        self.symrefs = {}
+        # (object id or None if unborn, target or None if detached) of HEAD
+        self.head = (None, None)
+        # whether refs are hidden by configuration, which only git knows how to apply
+        self.hidden = False
+        # whether the unborn argument of ls-refs is honored (lsrefs.unborn)
+        self.allow_unborn = True
+        # capabilities advertised by upload-pack, except symref
+        self.capabilities = None
+        # incremented on every change
+        self.generation = 0
+        self.advertisement = None
+
+        self.packed = {} # name -> (object id, peeled object id)
+        self.packed_key = None
+        self.loose = {} # name -> (stat key, content)
+        self.loose_dirs = {} # path -> (stat key, names of the refs in it)
+        self.loose_symrefs = set()
+        self.head_key = None
+        self.config_key = None
+        self.peels = {} # object id -> peeled object id or None, for loose refs
+
+    def find(self, name):
+        """Get the index of a ref or None"""
+        i = bisect.bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            return i
+        return None
+
+    def select(self, prefixes):
+        """Get the indexes of the refs starting with one of prefixes, in order"""
+        if not prefixes or len(prefixes) >= MAX_PREFIXES:
+            return range(len(self.names))
+
+        selected = []
+        last = None
+        for prefix in sorted(set(prefixes)):
+            if last is not None and prefix.startswith(last):
+                continue # already covered
+            last = prefix
+            i = bisect.bisect_left(self.names, prefix)
+            while i < len(self.names) and self.names[i].startswith(prefix):
+                selected.append(i)
+                i += 1
+        return selected
+
+    def outdated(self):
+        """Whether the refs or the configuration might have changed since the last refresh, only stats files"""
+        if (_stat_key(os.path.join(self.gitdir, 'config')) != self.config_key or
+            _stat_key(os.path.join(self.gitdir, 'packed-refs')) != self.packed_key or
+            (_stat_key(os.path.join(self.gitdir, 'HEAD')), _stat_key(os.path.join(self.gitdir, 'shallow'))) != self.head_key):
+            return True
+
+        # git renames ref files into place, so changes of loose refs touch their directory
+        seen = 0
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.gitdir, 'refs')):
+            known = self.loose_dirs.get(dirpath)
+            if known is None or known[0] != _stat_key(dirpath):
+                return True
+            seen += 1
+        return seen != len(self.loose_dirs)
+
+    def refresh(self):
+        """Pick up changes of the refs and configuration, returns whether there were any"""
+        config_key = _stat_key(os.path.join(self.gitdir, 'config'))
+        if config_key != self.config_key:
+            self.config_key = config_key
+            self._read_config()
+            self.capabilities = None
+            self.advertisement = None
+        if self.capabilities is None:
+            try:
+                self.capabilities = self._read_capabilities()
+            except (IOError, OSError, ValueError) as e:
+                # git sends the advertisement until the next change
+                logger.warning("Unable to get capabilities of upload-pack for %s: %s", self.gitdir, e)
+
+        changed = set()
+        packed_key = _stat_key(os.path.join(self.gitdir, 'packed-refs'))
+        if packed_key != self.packed_key:
+            self.packed_key = packed_key
+            self._read_packed()
+            # loose refs take precedence, apply them again
+            changed.update(self.loose)
+        self._refresh_loose(changed)
+
+        head_key = (_stat_key(os.path.join(self.gitdir, 'HEAD')), _stat_key(os.path.join(self.gitdir, 'shallow')))
+        if not changed and head_key == self.head_key:
+            return False
+        self.head_key = head_key
+
+        # symbolic refs follow their targets
+        changed.update(self.loose_symrefs)
+        self._update(changed)
+
+        with open(os.path.join(self.gitdir, 'HEAD')) as f:
+            head = f.read().strip()
+        if head.startswith('ref: '):
+            resolved = self._resolve('HEAD', head)
+            self.head = resolved[:2] if resolved is not None else (None, head[5:])
+        else:
+            self.head = (head, None)
+
+        self.generation += 1
+        self.advertisement = None
+        return True
+
+    def _read_config(self):
+        self.hidden, self.allow_unborn = False, True
+        config = self.spawn([self.gitcommand, '--git-dir', self.gitdir, 'config', '--get-regexp',
+                             '^(transfer|uploadpack)\\.hiderefs$|^lsrefs\\.unborn$'])
+        for line in communicate(config).splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'lsrefs.unborn':
+                self.allow_unborn = value != 'ignore'
+            else:
+                self.hidden = True
+
+    def _read_packed(self):
+        """Read packed-refs and rebuild the arrays from it, loose refs have to be applied afterwards"""
+        self.packed = {}
+        names, shas, peeled = [], [], []
+        traits = []
+        try:
+            f = open(os.path.join(self.gitdir, 'packed-refs'))
+        except IOError:
+            f = None
+
+        if f is not None:
+            with f:
+                for line in f:
+                    if line.startswith('^'):
+                        if names:
+                            peeled[-1] = line[1:41]
+                    elif line.startswith('# pack-refs with:'):
+                        traits = line.split()[3:]
+                    elif not line.startswith('#'):
+                        names.append(line[41:].rstrip('\n'))
+                        shas.append(line[:40])
+                        peeled.append(None)
+
+        # fully-peeled records the peeled id of every tag, peeled only of those below refs/tags/
+        if 'fully-peeled' not in traits:
+            unknown = [i for i, name in enumerate(names) if peeled[i] is None and ('peeled' not in traits or not name.startswith('refs/tags/'))]
+            peels = self._peel(set(shas[i] for i in unknown))
+            for i in unknown:
+                peeled[i] = peels[shas[i]]
+
+        if 'sorted' not in traits:
+            order = sorted(range(len(names)), key=names.__getitem__)
+            names, shas, peeled = [names[i] for i in order], [shas[i] for i in order], [peeled[i] for i in order]
+
+        self.packed = dict(zip(names, zip(shas, peeled)))
+        self.names, self.shas, self.peeled = names, shas, peeled
+        self.symrefs = {}
+        logger.debug("Read %d packed refs of %s", len(names), self.gitdir)
+
+    def _refresh_loose(self, changed):
+        """Read loose refs in changed directories, adding the names of changed refs to changed"""
+        base = os.path.join(self.gitdir, 'refs')
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(base):
+            seen.add(dirpath)
+            key = _stat_key(dirpath)
+            known = self.loose_dirs.get(dirpath)
+            if known is not None and known[0] == key:
+                continue
+
+            prefix = 'refs/' + os.path.relpath(dirpath, base).replace(os.sep, '/') + '/' if dirpath != base else 'refs/'
+            names = set()
+            for filename in filenames:
+                if filename.endswith('.lock'):
+                    continue
+                name = prefix + filename
+                path = os.path.join(dirpath, filename)
+                file_key = _stat_key(path)
+                entry = self.loose.get(name)
+                if entry is None or entry[0] != file_key:
+                    try:
+                        with open(path) as f:
+                            content = f.read().strip()
+                    except IOError:
+                        continue # deleted in the meantime
+                    self.loose[name] = (file_key, content)
+                    if content.startswith('ref: '):
+                        self.loose_symrefs.add(name)
+                    else:
+                        self.loose_symrefs.discard(name)
+                    changed.add(name)
+                names.add(name)
+
+            for name in known[1] - names if known is not None else ():
+                self._remove_loose(name)
+                changed.add(name)
+            self.loose_dirs[dirpath] = (key, names)
+
+        for dirpath in [dirpath for dirpath in self.loose_dirs if dirpath not in seen]:
+            for name in self.loose_dirs.pop(dirpath)[1]:
+                self._remove_loose(name)
+                changed.add(name)
+
+    def _remove_loose(self, name):
+        self.loose.pop(name, None)
+        self.loose_symrefs.discard(name)
+
+    def _resolve(self, name, content=None):
+        """Get (object id, target if symbolic, peeled object id) of a ref or None if it is missing or broken"""
+        target = None
+        for depth in range(5):
+            if content is None:
+                entry = self.loose.get(name)
+                content = entry[1] if entry is not None else None
+            if content is not None and content.startswith('ref: '):
+                name = target = content[5:]
+                content = None
+                continue
+
+            if content is not None:
+                if len(content) != 40 or content.strip('0123456789abcdef'):
+                    return None
+                return content, target, self.peels.get(content, PEEL_UNKNOWN)
+            if name in self.packed:
+                sha, peeled = self.packed[name]
+                return sha, target, peeled
+            return None
+        return None
+
+    def _update(self, changed):
+        refs = dict((name, self._resolve(name)) for name in changed)
+
+        unknown = set(ref[0] for ref in refs.values() if ref is not None and ref[2] is PEEL_UNKNOWN)
+        if unknown:
+            if len(self.peels) > 2 * len(self.names) + 1024:
+                self.peels.clear()
+            self.peels.update(self._peel(unknown))
+            refs = dict((name, ref if ref is None or ref[2] is not PEEL_UNKNOWN else (ref[0], ref[1], self.peels[ref[0]]))
+                        for name, ref in refs.items())
+
+        if len(refs) > len(self.names) // 4 + 64:
+            # merging sorted runs is cheaper than many inserts into the arrays
+            merged = [ref for ref in zip(self.names, self.shas, self.peeled) if ref[0] not in refs]
+            merged.extend(sorted((name, ref[0], ref[2]) for name, ref in refs.items() if ref is not None))
+            merged.sort()
+            self.names = [ref[0] for ref in merged]
+            self.shas = [ref[1] for ref in merged]
+            self.peeled = [ref[2] for ref in merged]
+        else:
+            for name, ref in refs.items():
+                i = bisect.bisect_left(self.names, name)
+                exists = i < len(self.names) and self.names[i] == name
+                if ref is None:
+                    if exists:
+                        del self.names[i], self.shas[i], self.peeled[i]
+                elif exists:
+                    self.shas[i], self.peeled[i] = ref[0], ref[2]
+                else:
+                    self.names.insert(i, name)
+                    self.shas.insert(i, ref[0])
+                    self.peeled.insert(i, ref[2])
+
+        for name, ref in refs.items():
+            if ref is not None and ref[1] is not None:
+                self.symrefs[name] = ref[1]
+            else:
+                self.symrefs.pop(name, None)
+        logger.debug("Updated %d refs of %s", len(refs), self.gitdir)
+
+    def _peel(self, shas):
+        """Get a dict of the object ids shas peel to, None for objects that aren't tags"""
+        peels = {}
+        rest = []
+        for sha in shas:
+            peeled = self._peel_loose(sha)
+            if peeled is PEEL_UNKNOWN:
+                rest.append(sha)
+            else:
+                peels[sha] = peeled
+
+        if rest:
+            cat_file = self.spawn([self.gitcommand, '--git-dir', self.gitdir, 'cat-file', '--batch-check=%(objectname)'])
+            output = communicate(cat_file, ''.join('%s^{}\n' % sha for sha in rest)).splitlines()
+            if len(output) != len(rest):
+                raise OSError('git cat-file failed')
+            for sha, peeled in zip(rest, output):
+                peels[sha] = peeled if len(peeled) == 40 and peeled != sha else None
+        return peels
+
+    def _peel_loose(self, sha):
+        """Peel an object by reading loose objects, returns PEEL_UNKNOWN if one of them is packed"""
+        current = sha
+        for depth in range(10):
+            try:
+                with open(os.path.join(self.gitdir, 'objects', current[:2], current[2:]), 'rb') as f:
+                    header = zlib.decompressobj().decompress(f.read(512), 128)
+            except (IOError, zlib.error):
+                return PEEL_UNKNOWN
+            if not header.startswith('tag '):
+                return current if current != sha else None
+            # the body of a tag starts with "object <id>"
+            body = header[header.find('\0') + 1:]
+            if not body.startswith('object ') or len(body) < 47:
+                return PEEL_UNKNOWN
+            current = body[7:47]
+        return PEEL_UNKNOWN
+
+    def _read_capabilities(self):
+        """Get the capabilities upload-pack advertises, except symref
+
+        They depend on the version and configuration of git, so they are taken
+        from the first line of an advertisement of git itself.
+        """
+        process = self.spawn([self.gitcommand, 'upload-pack', '--stateless-rpc', '--advertise-refs', self.gitdir])
+        try:
+            process.stdin.close()
+            header = _read(process.stdout, 4)
+            line = _read(process.stdout, int(header, 16) - 4) if len(header) == 4 else ''
+        finally:
+            # git gets EPIPE writing the rest of the advertisement
+            process.stdout.close()
+            process.stderr.close()
+            if isinstance(process, subprocess.Popen):
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+
+        if '\0' not in line:
+            raise OSError('unexpected advertisement of git upload-pack')
+        return [capability for capability in line.split('\0', 1)[1].rstrip('\n').split(' ')
+                if not capability.startswith('symref=')]
+
+    def advertise(self):
+        """Get the protocol v0 ref advertisement of upload-pack, including the prelude
+
+        Returns a gittornado.cache.Advertisement, which is reused until the refs change,
+        or None if the capabilities of upload-pack are not known.
+        """
+        if self.advertisement is not None:
+            return self.advertisement
+
+        lines = [get_advertisement_prelude('upload-pack')]
+        sha, target = self.head
+        if sha is not None or self.names:
+            if self.capabilities is None:
+                return None
+            capabilities = list(self.capabilities)
+            if sha is not None and target is not None:
+                # git puts it before filter, object-format and agent
+                i = 0
+                while i < len(capabilities) and not capabilities[i].startswith(('filter', 'session-id=', 'object-format=', 'agent=')):
+                    i += 1
+                capabilities.insert(i, 'symref=HEAD:' + target)
+            capabilities = ' '.join(capabilities)
+
+            # the capabilities follow the first ref
+            if sha is not None:
+                lines.append(pkt_line('%s HEAD\0%s\n' % (sha, capabilities)))
+                i = self.find(target) if target is not None else None
+                if i is not None and self.peeled[i] is not None:
+                    lines.append(pkt_line('%s HEAD^{}\n' % self.peeled[i]))
+            else:
+                lines.append(pkt_line('%s %s\0%s\n' % (self.shas[0], self.names[0], capabilities)))
+                if self.peeled[0] is not None:
+                    lines.append(pkt_line('%s %s^{}\n' % (self.peeled[0], self.names[0])))
+
+        names, shas, peeled = self.names, self.shas, self.peeled
+        for i in range(0 if sha is not None else 1, len(names)):
+            lines.append(pkt_line(shas[i] + ' ' + names[i] + '\n'))
+            if peeled[i] is not None:
+                lines.append(pkt_line(peeled[i] + ' ' + names[i] + '^{}\n'))
+
+        # shallow repositories list their boundary commits
+        try:
+            with open(os.path.join(self.gitdir, 'shallow')) as f:
+                lines.extend(pkt_line('shallow %s\n' % line.strip()) for line in f if line.strip())
+        except IOError:
+            pass
+        lines.append('0000')
+
+        self.advertisement = Advertisement(self.generation, ''.join(lines))
+        return self.advertisement
+
+    def ls_refs(self, prefixes=(), peel=False, symrefs=False, unborn=False):
+        """Format the response to a protocol v2 ls-refs request like git does"""
+        lines = []
+
+        sha, target = self.head
+        if not prefixes or len(prefixes) >= MAX_PREFIXES or any('HEAD'.startswith(prefix) for prefix in prefixes):
+            if sha is not None:
+                line = '%s HEAD' % sha
+                if symrefs and target is not None:
+                    line += ' symref-target:' + target
+                i = self.find(target) if target is not None else None
+                if peel and i is not None and self.peeled[i] is not None:
+                    line += ' peeled:' + self.peeled[i]
+                lines.append(pkt_line(line + '\n'))
+            elif unborn and self.allow_unborn and symrefs and target is not None:
+                lines.append(pkt_line('unborn HEAD symref-target:%s\n' % target))
+
+        names, shas, peeled, symref_targets = self.names, self.shas, self.peeled, self.symrefs
+        for i in self.select(prefixes):
+            line = shas[i] + ' ' + names[i]
+            if symrefs and names[i] in symref_targets:
+                line += ' symref-target:' + symref_targets[names[i]]
+            if peel and peeled[i] is not None:
+                line += ' peeled:' + peeled[i]
+            lines.append(pkt_line(line + '\n'))
+
+        lines.append('0000')
+        return ''.join(lines)
+
+class RefIndex(object):
+    """Ref tables of recently used repositories
+
+    Pass it as ref_index to RPCHandler to answer protocol v2 ls-refs requests and
+    to InfoRefsHandler to send protocol v0 advertisements of upload-pack without
+    running git. Every use checks whether the table is up to date, which only
+    costs a stat of the files and directories holding refs. Tables are loaded and
+    refreshed on a thread pool, so reading a large packed-refs doesn't block the
+    IOLoop; git answers requests for the repository meanwhile.
+    """
+
+    def __init__(self, gitcommand='git', max_repos=256, threads=2, spawner=None):
+        """
+        :param gitcommand: the git executable
+        :param max_repos: maximum number of repositories whose refs are kept
+        :param threads: number of threads refreshing tables
+        :param spawner: gittornado.spawner.Spawner to start git with, asked on the IOLoop
+        """
+        self.gitcommand = gitcommand
+        self.threads = threads
+        self.spawner = spawner
+        self.ioloop = None
+        self.tables = LRUCache(max_repos)
+        # repositories whose table is being refreshed
+        self.refreshing = set()
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get(self, gitdir):
+        """Get the RefTable of a repository if it is up to date, None if git has to answer"""
+        if gitdir in self.refreshing:
+            return None
+
+        table = self.tables.get(gitdir)
+        if table is not None:
+            try:
+                if not table.outdated():
+                    return table
+            except (IOError, OSError) as e:
+                logger.warning("Unable to check refs of %s: %s", gitdir, e)
+                self.tables.remove(gitdir)
+                return None
+        else:
+            table = RefTable(gitdir, self.gitcommand, self._spawn)
+
+        self._refresh(gitdir, table)
+        return None
+
+    def _refresh(self, gitdir, table):
+        """Refresh a table on the thread pool, it is not used until that is done"""
+        self.refreshing.add(gitdir)
+        ioloop = self.ioloop = tornado.ioloop.IOLoop.instance()
+        def refresh():
+            # runs on a pool thread
+            try:
+                table.refresh()
+                error = None
+            except (IOError, OSError, ValueError) as e:
+                error = e
+            except Exception as e:
+                logger.exception("Refreshing the refs of %s failed", gitdir)
+                error = e
+            ioloop.add_callback(lambda: self._refreshed(gitdir, table, error))
+
+        self._get_pool().apply_async(refresh)
+
+    def _refreshed(self, gitdir, table, error):
+        self.refreshing.discard(gitdir)
+        if error is not None:
+            logger.warning("Unable to read refs of %s: %s", gitdir, error)
+            self.tables.remove(gitdir)
+        else:
+            self.tables.put(gitdir, table)
+
+    def _spawn(self, command):
+        """Start git for a pool thread, the spawner is only used on the IOLoop"""
+        if self.spawner is None:
+            return popen(command)
+
+        result = queue.Queue()
+        def spawn():
+            try:
+                result.put((self.spawner.spawn(command), None))
+            except Exception as e:
+                result.put((None, e))
+        self.ioloop.add_callback(spawn)
+
+        process, error = result.get()
+        if error is not None:
+            raise error
+        return process
+
+    def _get_pool(self):
+        # created lazily so it isn't inherited across fork
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.pool.ThreadPool(self.threads)
+        return self.pool
+
+    def ls_refs(self, gitdir, body):
+        """Answer a protocol v2 ls-refs request, returns None if git has to"""
+        args = parse_ls_refs(body)
+        if args is None:
+            return None
+
+        table = self.get(gitdir)
+        if table is None or table.hidden:
+            return None
+        return table.ls_refs(**args)
+
+    def advertise(self, gitdir):
+        """Get the protocol v0 advertisement of upload-pack as gittornado.cache.Advertisement, None if git has to send it"""
+        table = self.get(gitdir)
+        if table is None or table.hidden:
+            return None
+        return table.advertise()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import os
+import os.path
+import time
+import collections
+
+import tornado
+import tornado.ioloop
+
+import logging
+logger = logging.getLogger(__name__)
+
+def is_repository(path):
+    """Whether path looks like a bare git repository"""
+    return os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects'))
+
+class RepositoryRegistry(object):
+    """Index of the repositories below a base directory, usable as gitlookup
+
+    Repositories may be nested in namespaces (directories that are not repositories
+    themselves), e.g. group/sub/repo.git, up to max_depth levels deep. Lookups only
+    consult the index; a name that is not in it is looked up on the filesystem at most
+    once every negative_ttl seconds, so new repositories are found right away.
+
+    Creating or deleting a repository changes the mtime of its namespace, so rescan
+    only lists namespaces whose mtime changed. Call start to rescan periodically.
+    """
+
+    def __init__(self, base, max_depth=3, rescan_interval=30, negative_ttl=5, max_negative=10000):
+        """
+        :param base: directory containing the repositories
+        :param max_depth: maximum number of path components of a repository name
+        :param rescan_interval: seconds between rescans once started
+        :param negative_ttl: seconds a name that is not a repository is remembered as such
+        :param max_negative: maximum number of names remembered as not being a repository
+        """
+        self.base = os.path.abspath(base)
+        self.max_depth = max_depth
+        self.rescan_interval = rescan_interval
+        self.negative_ttl = negative_ttl
+        self.max_negative = max_negative
+
+        # name -> path of the repository
+        self.repos = {}
+        # name -> mtime of namespaces, '' is base
+        self.namespaces = {}
+        # name -> (expiry, whether it is a directory) of names that are not repositories
+        self.negative = collections.OrderedDict()
+
+        self.scan()
+
+    def __call__(self, request):
+        return self.lookup(request.path)
+
+    def lookup(self, path):
+        """Get the repository a request path refers to or None"""
+        parts = path.strip('/').split('/')
+        # the last part is never part of the repository name
+        candidates = ['/'.join(parts[:i]) for i in range(1, min(len(parts), self.max_depth + 1))]
+
+        for name in candidates:
+            gitdir = self.repos.get(name)
+            if gitdir is not None:
+                return gitdir
+
+        now = time.time()
+        for name in candidates:
+            if name in self.namespaces:
+                continue
+            entry = self.negative.get(name)
+            if entry is None or entry[0] <= now:
+                entry = self._check(name, now)
+                if entry is None:
+                    return self.repos[name]
+            if not entry[1]:
+                return None # nothing further down either
+        return None
+
+    def _check(self, name, now):
+        """Look for a repository missing from the index on the filesystem, returns its negative entry if there is none"""
+        if any(part in ('', '.', '..') for part in name.split('/')):
+            return (now + self.negative_ttl, False)
+
+        path = os.path.join(self.base, name)
+        if is_repository(path):
+            logger.info("Found new repository %s", name)
+            self.repos[name] = path
+            self.negative.pop(name, None)
+            return None
+
+        entry = self.negative[name] = (now + self.negative_ttl, os.path.isdir(path))
+        while len(self.negative) > self.max_negative:
+            self.negative.popitem(last=False)
+        return entry
+
+    def scan(self):
+        """Build the index from scratch"""
+        start = time.time()
+        self.repos, self.namespaces = {}, {}
+        self.negative.clear()
+        self._scan_namespace('')
+        logger.info("Found %d repositories in %d namespaces in %.2fs", len(self.repos), len(self.namespaces), time.time() - start)
+
+    def rescan(self):
+        """Update the index for namespaces that changed"""
+        for name, mtime in list(self.namespaces.items()):
+            if name not in self.namespaces:
+                continue # removed together with its parent
+            try:
+                current = os.stat(os.path.join(self.base, name)).st_mtime
+            except OSError:
+                current = None
+            if current is None:
+                logger.debug("Namespace %r vanished", name)
+                self._forget(name)
+            elif current != mtime:
+                logger.debug("Namespace %r changed", name)
+                path = os.path.join(self.base, name)
+                if name and is_repository(path):
+                    # e.g. git init in a directory created before
+                    self._forget(name)
+                    self.repos[name] = path
+                else:
+                    self._scan_namespace(name)
+
+    def start(self, ioloop=None):
+        """Rescan every rescan_interval seconds"""
+        if tornado.version_info < (5, 0):
+            callback = tornado.ioloop.PeriodicCallback(self.rescan, self.rescan_interval * 1000,
+                                                       io_loop=ioloop or tornado.ioloop.IOLoop.instance())
+            callback.start()
+            return callback
+
+        # Tornado 5 dropped io_loop, callbacks run on the loop that is current when starting them
+        callback = tornado.ioloop.PeriodicCallback(self.rescan, self.rescan_interval * 1000)
+        if ioloop is None:
+            callback.start()
+        else:
+            ioloop.add_callback(callback.start)
+        return callback
+
+    def _scan_namespace(self, name):
+        """List a namespace, adding new entries and dropping vanished ones
+
+        Namespaces that are already known are not descended into, they are
+        checked on their own."""
+        path = os.path.join(self.base, name) if name else self.base
+        try:
+            # stat before listing, so changes while listing are picked up next time
+            self.namespaces[name] = os.stat(path).st_mtime
+            entries = os.listdir(path)
+        except OSError as e:
+            logger.warning("Unable to scan %s: %s", path, e)
+            return
+
+        prefix = name + '/' if name else ''
+        depth = prefix.count('/') + 1
+        children = set()
+        for entry in entries:
+            child = prefix + entry
+            child_path = os.path.join(path, entry)
+            children.add(child)
+            if child in self.repos or child in self.namespaces:
+                continue
+            if is_repository(child_path):
+                self.repos[child] = child_path
+                self.negative.pop(child, None)
+            elif depth < self.max_depth and os.path.isdir(child_path):
+                self._scan_namespace(child)
+
+        def vanished(key):
+            return key.startswith(prefix) and '/' not in key[len(prefix):] and key not in children
+        for repo in [repo for repo in self.repos if vanished(repo)]:
+            logger.info("Repository %s vanished", repo)
+            del self.repos[repo]
+        for namespace in [namespace for namespace in self.namespaces if namespace and vanished(namespace)]:
+            self._forget(namespace)
+
+    def _forget(self, name):
+        """Remove a namespace and everything in it from the index"""
+        prefix = name + '/'
+        for repo in [repo for repo in self.repos if repo.startswith(prefix)]:
+            del self.repos[repo]
+        for namespace in [namespace for namespace in self.namespaces if namespace.startswith(prefix)]:
+            del self.namespaces[namespace]
+        self.namespaces.pop(name, None)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import time
+import collections
+
+import tornado.ioloop
+import tornado.stack_context
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Pool(object):
+    """Limits for one class of git processes"""
+
+    def __init__(self, max_processes=16, max_per_repository=None):
+        """
+        :param max_processes: number of processes allowed to run at the same time
+        :param max_per_repository: number of processes allowed to run at the same time for a single repository
+        """
+        self.max_processes = max_processes
+        self.max_per_repository = max_per_repository
+
+        self.running = 0
+        self.running_per_repository = collections.defaultdict(int)
+        # waiting tickets per client, clients are served round-robin in the order of this dict
+        self.queues = collections.OrderedDict()
+        self.waiting = 0
+
+    def has_room(self, gitdir):
+        if self.running >= self.max_processes:
+            return False
+        if self.max_per_repository is not None and self.running_per_repository.get(gitdir, 0) >= self.max_per_repository:
+            return False
+        return True
+
+class Ticket(object):
+    """A place in the queue of a pool resp. a running process"""
+
+    timeout = None
+    running = False
+    done = False
+
+    def __init__(self, scheduler, pool, gitdir, client, callback, timeout_callback):
+        self.scheduler = scheduler
+        self.pool = pool
+        self.gitdir = gitdir
+        self.client = client
+        # callbacks run in the context of the request that scheduled them
+        self.callback = tornado.stack_context.wrap(callback)
+        self.timeout_callback = tornado.stack_context.wrap(timeout_callback)
+        self.queued_at = time.time()
+
+    def release(self):
+        """The process has finished resp. the request is not interested in a slot anymore"""
+        if self.done:
+            return
+        self.done = True
+
+        if self.timeout is not None:
+            self.scheduler.ioloop.remove_timeout(self.timeout)
+            self.timeout = None
+
+        if self.running:
+            self.pool.running -= 1
+            self.pool.running_per_repository[self.gitdir] -= 1
+            if not self.pool.running_per_repository[self.gitdir]:
+                del self.pool.running_per_repository[self.gitdir]
+        else:
+            self.scheduler._dequeue(self)
+
+        self.scheduler._dispatch(self.pool)
+
+    cancel = release
+
+    def _expire(self):
+        self.timeout = None
+        if self.done or self.running:
+            return
+
+        logger.warning("Request of %s for %s waited %.1fs in queue, giving up", self.client, self.gitdir, time.time() - self.queued_at)
+        self.release()
+        self.timeout_callback()
+
+class ProcessScheduler(object):
+    """Limits the number of git processes running concurrently
+
+    Every service (upload-pack, receive-pack) gets its own Pool, so pushes never wait
+    behind clones. Requests exceeding the limits of a pool are queued per client and
+    clients are served round-robin, so a single client can't starve everybody else.
+    Requests waiting longer than queue_timeout seconds are given up.
+    """
+
+    def __init__(self, pools=None, queue_timeout=30, retry_after=10):
+        """
+        :param pools: dict mapping services to Pools, the pool for None is used for other services
+        :param queue_timeout: seconds a request may wait for a process slot
+        :param retry_after: seconds clients are asked to wait before retrying after a queue timeout
+        """
+        if pools is None:
+            pools = {'upload-pack': Pool(16, 4),
+                     'receive-pack': Pool(4, 1)}
+        self.pools = pools
+        if None not in self.pools:
+            self.pools[None] = Pool()
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.ioloop = tornado.ioloop.IOLoop.instance()
+
+    def get_pool(self, service):
+        return self.pools.get(service, self.pools[None])
+
+    def schedule(self, service, gitdir, client, callback, timeout_callback):
+        """Run callback as soon as a process for service may be started
+
+        :param service: git service, e.g. upload-pack
+        :param gitdir: the repository the process will work on
+        :param client: identifier of the client for fair queueing
+        :param callback: called with the Ticket, whose release method must be called once the process finished
+        :param timeout_callback: called if the request waited for more than queue_timeout seconds
+        :returns: the Ticket
+        """
+        pool = self.get_pool(service)
+        ticket = Ticket(self, pool, gitdir, client, callback, timeout_callback)
+
+        if not pool.waiting and pool.has_room(gitdir):
+            self._start(ticket)
+            return ticket
+
+        logger.debug("Queueing request of %s for %s (%d waiting)", client, gitdir, pool.waiting)
+        pool.queues.setdefault(client, collections.deque()).append(ticket)
+        pool.waiting += 1
+        if self.queue_timeout is not None:
+            ticket.timeout = self.ioloop.add_timeout(time.time() + self.queue_timeout, ticket._expire)
+
+        # waiting requests might have been held back by the per-repository limit only
+        self._dispatch(pool)
+        return ticket
+
+    def _start(self, ticket):
+        pool = ticket.pool
+        pool.running += 1
+        pool.running_per_repository[ticket.gitdir] += 1
+        ticket.running = True
+
+        if ticket.timeout is not None:
+            self.ioloop.remove_timeout(ticket.timeout)
+            ticket.timeout = None
+
+        try:
+            ticket.callback(ticket)
+        except:
+            ticket.release()
+            raise
+
+    def _dequeue(self, ticket):
+        pool = ticket.pool
+        queue = pool.queues.get(ticket.client)
+        if queue is None or ticket not in queue:
+            return
+
+        queue.remove(ticket)
+        pool.waiting -= 1
+        if not queue:
+            del pool.queues[ticket.client]
+
+    def _dispatch(self, pool):
+        """Start waiting requests as long as there is room"""
+        while pool.waiting and pool.running < pool.max_processes:
+            for client, queue in pool.queues.items():
+                if pool.has_room(queue[0].gitdir):
+                    break
+            else:
+                return # all waiting requests are held back by the per-repository limit
+
+            ticket = queue.popleft()
+            pool.waiting -= 1
+            # move the client to the end of the round-robin order
+            del pool.queues[client]
+            if queue:
+                pool.queues[client] = queue
+
+            logger.debug("Starting queued request of %s for %s after %.3fs", client, ticket.gitdir, time.time() - ticket.queued_at)
+            self._start(ticket)
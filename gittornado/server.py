@@ -17,46 +17,25 @@
 # You should have received a copy of the GNU General Public License
 # along with GitTornado.  If not, see http://www.gnu.org/licenses
 
-import os.path
 import logging
-import ConfigParser
 
 import tornado.ioloop, tornado.httpserver
 from tornado.options import define, options, parse_command_line
-from gittornado import RPCHandler, InfoRefsHandler, FileHandler
-
-accessfile = ConfigParser.ConfigParser()
-
-def auth(request):
-    pathlets = request.path.strip('/').split('/')
-
-    author = request.headers.get('Authorization', None)
-    if author is None:
-        return True, False
-
-    if author.strip().lower()[:5] != 'basic':
-        return True, False
-
-    userpw_base64 = author.strip()[5:].strip()
-
-    user, pw = userpw_base64.decode('base64').split(':', 1)
-
-    if accessfile.has_option('users', user):
-        if accessfile.get('users', user) == pw:
-            if accessfile.has_option('access', user):
-                return True, pathlets[0] in accessfile.get('access', user).split(',')
-
-    return True, False
-
-def gitlookup(request):
-    pathlets = request.path.strip('/').split('/')
-
-    path = os.path.abspath(os.path.join(options.gitbase, pathlets[0]))
-    if not path.startswith(os.path.abspath(options.gitbase)):
-        return None
-
-    if os.path.exists(path):
-        return path
+from gittornado import RPCHandler, InfoRefsHandler, FileHandler, MetricsHandler
+from gittornado.cache import AdvertisementCache
+from gittornado.scheduler import ProcessScheduler, Pool
+from gittornado.packcache import PackCache
+from gittornado.packhook import PackObjectsCache
+from gittornado.flight import SingleFlight
+from gittornado.metrics import Metrics
+from gittornado.workers import Supervisor, DrainingHTTPServer, is_worker, serve_worker
+from gittornado.auth import CachingAuth, AccessFile
+from gittornado.registry import RepositoryRegistry
+from gittornado.refs import RefIndex
+from gittornado.maintenance import MaintenanceScheduler
+from gittornado.spawner import Spawner
+from gittornado.ratelimit import RateLimiter
+from gittornado.accesslog import AccessLog
 
 def auth_failed(request):
     msg = 'Authorization needed to access this repository'
@@ -66,26 +45,159 @@ def auth_failed(request):
 def main():
     define('port', default=8080, type=int, help="Port to listen on")
     define('gitbase', default='.', type=str, help="Base directory where bare git directories are stored")
-    define('accessfile', type=str, help="File with access permissions")
+    define('repo_depth', default=3, type=int, help="Maximum depth of repositories in namespaces below gitbase")
+    define('repo_rescan_interval', default=30, type=int, help="Seconds between checking gitbase for created and deleted repositories")
+    define('accessfile', type=str, help="File with access permissions, reloaded when it changes")
+    define('auth_cache_ttl', default=300, type=int, help="Seconds verified credentials are remembered (0 to verify every request)")
+    define('auth_threads', default=4, type=int, help="Number of threads verifying credentials")
     define('realm', default='my git repos', type=str, help="Basic auth realm")
+    define('sendfile', default=False, type=bool, help="Send static files with sendfile resp. mmap")
+    define('file_chunk_size', default=8192, type=int, help="Number of bytes to read at once when sending static files")
+    define('max_request_size', default=0, type=int, help="Maximum size of decompressed RPC requests in bytes (0 for no limit)")
+    define('gzip', default=False, type=bool, help="Compress ref advertisements and RPC responses for clients accepting gzip")
+    define('gzip_level', default=6, type=int, help="zlib compression level for responses")
+    define('gzip_min_size', default=1024, type=int, help="Minimum size of responses to be compressed")
+    define('max_processes', default=0, type=int, help="Maximum number of concurrent upload-pack processes (0 for no limit)")
+    define('max_processes_per_repo', default=0, type=int, help="Maximum number of concurrent upload-pack processes per repository (0 for no limit)")
+    define('max_push_processes', default=4, type=int, help="Maximum number of concurrent receive-pack processes if max_processes is set")
+    define('queue_timeout', default=30, type=int, help="Seconds a request may wait for a git process before getting a 503")
+    define('pack_cache_dir', type=str, help="Directory to cache upload-pack responses in, shared by workers")
+    define('pack_cache_size', default=4096, type=int, help="Maximum size of the upload-pack response cache in MiB, for all workers together")
+    define('pack_objects_cache_dir', type=str, help="Directory for upload-pack to cache generated packs in")
+    define('pack_objects_cache_size', default=4096, type=int, help="Maximum size of the pack cache of upload-pack in MiB")
+    define('single_flight', default=False, type=bool, help="Run only one git process for identical concurrent requests")
+    define('access_log', type=str, help="File to append an access log in JSON lines to")
+    define('metrics', default=False, type=bool, help="Serve metrics in the Prometheus text format at /metrics")
+    define('ref_index', default=False, type=bool, help="Answer ls-refs requests and send upload-pack advertisements from refs kept in memory")
+    define('advertisement_cache', default=1024, type=int, help="Number of ref advertisements to cache in memory (0 to disable)")
+    define('maintenance', default=False, type=bool, help="Repack repositories and write bitmaps and commit-graphs after pushes")
+    define('maintenance_processes', default=1, type=int, help="Maximum number of concurrent maintenance processes")
+    define('repack_after', default=100, type=int, help="Pushes after which a repository is repacked (0 to never repack)")
+    define('max_packs', default=20, type=int, help="Number of packs after which a repository is repacked on the next push (0 for no limit)")
+    define('midx_after', default=10, type=int, help="Pushes after which a multi-pack-index is written (0 to never write one)")
+    define('commit_graph_after', default=10, type=int, help="Pushes after which a commit-graph is written (0 to only write it when repacking)")
+    define('user_requests', default=0, type=float, help="Requests per second a user may make (0 for no limit)")
+    define('ip_requests', default=0, type=float, help="Requests per second a client address may make (0 for no limit)")
+    define('repo_requests', default=0, type=float, help="Requests per second a repository may get (0 for no limit)")
+    define('request_burst', default=20, type=int, help="Requests exceeding the request rates that are allowed at once")
+    define('max_request_delay', default=30, type=int, help="Seconds a request may be delayed by the request rates before getting a 429")
+    define('user_bandwidth', default=0, type=int, help="KiB per second sent to a user (0 for no limit)")
+    define('ip_bandwidth', default=0, type=int, help="KiB per second sent to a client address (0 for no limit)")
+    define('repo_bandwidth', default=0, type=int, help="KiB per second sent from a repository (0 for no limit)")
+    define('bandwidth_burst', default=4096, type=int, help="KiB that may be sent at once exceeding the bandwidths")
+    define('spawner', default=False, type=bool, help="Start git processes from a helper process instead of forking the server")
+    define('workers', default=1, type=int, help="Number of worker processes, limits and caches apply per worker")
+    define('reuse_port', default=False, type=bool, help="Let every worker listen on its own socket with SO_REUSEPORT")
+    define('heartbeat_timeout', default=30, type=int, help="Seconds after which a worker not responding is killed")
+    define('drain_timeout', default=0, type=int, help="Seconds a stopping worker waits for requests in progress (0 for no limit)")
+    define('streaming', default=False, type=bool, help="Use the handlers for Tornado 4.2 and later streaming request bodies into git")
 
     parse_command_line()
 
-    if options.accessfile:
-        accessfile.read(options.accessfile)
-
-    conf = {'auth': auth,
-            'gitlookup': gitlookup,
-            'auth_failed': auth_failed
+    if options.streaming and options.workers > 1:
+        raise SystemExit("--streaming can't be combined with --workers")
+
+    if options.workers > 1 and not is_worker():
+        Supervisor(options.workers, options.port, reuse_port=options.reuse_port,
+                   heartbeat_timeout=options.heartbeat_timeout).run()
+        return
+
+    registry = RepositoryRegistry(options.gitbase, max_depth=options.repo_depth,
+                                  rescan_interval=options.repo_rescan_interval)
+    registry.start()
+
+    conf = {'gitlookup': registry,
+            'auth_failed': auth_failed,
+            'use_sendfile': options.sendfile,
+            'file_chunk_size': options.file_chunk_size,
+            'max_request_size': options.max_request_size or None,
+            'gzip_output': options.gzip,
+            'gzip_level': options.gzip_level,
+            'gzip_min_size': options.gzip_min_size,
             }
 
-    app = tornado.web.Application([
-                           ('/.*/git-.*', RPCHandler, conf),
-                           ('/.*/info/refs', InfoRefsHandler, conf),
-                           ('/.*/HEAD', FileHandler, conf),
-                           ('/.*/objects/.*', FileHandler, conf),
+    if options.accessfile:
+        conf['auth'] = CachingAuth(AccessFile(options.accessfile), ttl=options.auth_cache_ttl, threads=options.auth_threads)
+    else:
+        conf['public_readble'] = True
+
+    if options.max_processes > 0:
+        conf['scheduler'] = ProcessScheduler({'upload-pack': Pool(options.max_processes, options.max_processes_per_repo or None),
+                                              'receive-pack': Pool(options.max_push_processes, 1)},
+                                             queue_timeout=options.queue_timeout)
+
+    if options.pack_cache_dir:
+        conf['pack_cache'] = PackCache(options.pack_cache_dir, options.pack_cache_size * 1024 * 1024)
+
+    if options.pack_objects_cache_dir:
+        conf['pack_objects_cache'] = PackObjectsCache(options.pack_objects_cache_dir, options.pack_objects_cache_size * 1024 * 1024)
+
+    if options.single_flight:
+        conf['single_flight'] = SingleFlight()
+
+    if options.advertisement_cache > 0:
+        conf['advertisement_cache'] = AdvertisementCache(max_entries=options.advertisement_cache)
+
+    if options.spawner:
+        conf['spawner'] = Spawner()
+        conf['spawner'].start()
+
+    if options.maintenance:
+        conf['maintenance'] = MaintenanceScheduler(max_processes=options.maintenance_processes,
+                                                   repack_after=options.repack_after or None,
+                                                   max_packs=options.max_packs or None,
+                                                   midx_after=options.midx_after or None,
+                                                   commit_graph_after=options.commit_graph_after or None,
+                                                   spawner=conf.get('spawner'))
+
+    limits = {}
+    for name in ('user_requests', 'ip_requests', 'repo_requests'):
+        if getattr(options, name) > 0:
+            limits[name] = (getattr(options, name), options.request_burst)
+    for name in ('user_bandwidth', 'ip_bandwidth', 'repo_bandwidth'):
+        if getattr(options, name) > 0:
+            limits[name] = (getattr(options, name) * 1024, options.bandwidth_burst * 1024)
+    if limits:
+        conf['rate_limiter'] = RateLimiter(max_delay=options.max_request_delay, **limits)
+
+    if options.access_log:
+        conf['access_log'] = AccessLog(options.access_log)
+
+    if options.ref_index:
+        conf['ref_index'] = RefIndex(spawner=conf.get('spawner'))
+
+    routes = []
+    if options.metrics:
+        conf['metrics'] = Metrics()
+        if 'scheduler' in conf:
+            conf['metrics'].watch_scheduler(conf['scheduler'])
+        if 'maintenance' in conf:
+            conf['metrics'].watch_maintenance(conf['maintenance'])
+        if 'spawner' in conf:
+            conf['metrics'].watch_spawner(conf['spawner'])
+        routes.append(('/metrics', MetricsHandler, {'metrics': conf['metrics']}))
+
+    rpc_handler, info_refs_handler, file_handler = RPCHandler, InfoRefsHandler, FileHandler
+    if options.streaming:
+        from gittornado.streaming import StreamingRPCHandler, StreamingInfoRefsHandler, StreamingFileHandler
+        rpc_handler, info_refs_handler, file_handler = StreamingRPCHandler, StreamingInfoRefsHandler, StreamingFileHandler
+        conf['realm'] = options.realm
+        for name in ('pack_cache', 'single_flight', 'ref_index'):
+            if conf.pop(name, None) is not None:
+                logging.warning("%s is not supported with --streaming", name)
+
+    app = tornado.web.Application(routes + [
+                           ('/.*/git-.*', rpc_handler, conf),
+                           ('/.*/info/refs', info_refs_handler, conf),
+                           ('/.*/HEAD', file_handler, conf),
+                           ('/.*/objects/.*', file_handler, conf),
                            ])
 
+    if is_worker():
+        serve_worker(DrainingHTTPServer(app), options.port, reuse_port=options.reuse_port,
+                     drain_timeout=options.drain_timeout or None)
+        return
+
     server = tornado.httpserver.HTTPServer(app)
     server.listen(options.port)
     tornado.ioloop.IOLoop.instance().start()
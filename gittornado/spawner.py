@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+"""Start git processes from a helper process
+
+Forking a server with a large heap takes a while, and subprocess.Popen does so
+on the IOLoop. The helper is a fresh interpreter that does nothing but start
+processes: it gets the ends of the pipes over a unix socket, starts the process
+and reports its pid and later its exit status back.
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import subprocess
+
+import tornado.ioloop
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from multiprocessing.reduction import sendfds, recvfds
+except ImportError:
+    # Python 2 can only pass one descriptor at a time
+    import _multiprocessing
+
+    def sendfds(sock, fds):
+        for fd in fds:
+            _multiprocessing.sendfd(sock.fileno(), fd)
+
+    def recvfds(sock, size):
+        return [_multiprocessing.recvfd(sock.fileno()) for i in range(size)]
+
+import logging
+logger = logging.getLogger(__name__)
+
+# environment variables passed on to git, besides those starting with GIT_
+ENV_KEYS = ('PATH', 'HOME', 'USER', 'LOGNAME', 'LANG', 'LANGUAGE', 'LC_ALL', 'LC_CTYPE', 'LC_MESSAGES', 'TMPDIR', 'TZ')
+
+# exit status reported for processes that could not be started, like a shell would
+NOT_STARTED = 127
+
+# Python 2 closes every possible descriptor one by one, which takes milliseconds with a
+# high limit. The descriptors of the helper are all close-on-exec there instead.
+CLOSE_FDS = sys.version_info[0] >= 3
+
+def _set_close_exec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+class SpawnedProcess(object):
+    """A process started by the helper, with the parts of the subprocess.Popen interface we use"""
+
+    pid = None
+    returncode = None
+    # the helper went away before reporting the exit status
+    lost = False
+    exit_callback = None
+
+    def __init__(self, spawner, id, stdin, stdout, stderr):
+        self.spawner = spawner
+        self.id = id
+        self.stdin = os.fdopen(stdin, 'wb', 0)
+        self.stdout = os.fdopen(stdout, 'rb', 0)
+        self.stderr = os.fdopen(stderr, 'rb', 0)
+        self.spawned_at = time.time()
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        # the helper knows whether the pid still belongs to our process
+        if self.returncode is None and not self.lost:
+            try:
+                self.spawner._send(('kill', self.id))
+            except socket.error as e:
+                logger.warning("Unable to kill process %d: %s", self.id, e)
+
+    def set_exit_callback(self, callback):
+        """Call callback with the exit status once it is known, None if it never will be"""
+        if self.returncode is not None or self.lost:
+            callback(self.returncode)
+        else:
+            self.exit_callback = callback
+
+    def _exited(self, returncode):
+        self.returncode = returncode
+        if self.exit_callback is not None:
+            callback, self.exit_callback = self.exit_callback, None
+            callback(returncode)
+
+class Spawner(object):
+    """Starts processes without forking the server
+
+    Call start before the server gets busy, every process using it needs its own
+    helper. If the helper can't be started or dies, processes are started with
+    subprocess.Popen instead. Processes only get the environment variables in
+    env_keys and those starting with GIT_, and no descriptors besides their pipes.
+    """
+
+    # set by gittornado.metrics.Metrics.watch_spawner
+    metrics = None
+
+    sock = None
+    helper = None
+    # the process the helper belongs to
+    owner = None
+
+    def __init__(self, env_keys=ENV_KEYS):
+        self.env_keys = env_keys
+        # id -> SpawnedProcess waiting to be started resp. to exit
+        self.processes = {}
+        self.next_id = 0
+        self.ioloop = None
+
+    def start(self):
+        """Start the helper process"""
+        self.ioloop = tornado.ioloop.IOLoop.instance()
+
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        _set_close_exec(ours.fileno())
+        try:
+            # the helper gets its end of the socket as stdin
+            self.helper = subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdin=theirs, close_fds=True)
+        except OSError as e:
+            logger.error("Unable to start the spawner, starting processes directly: %s", e)
+            ours.close()
+            return
+        finally:
+            theirs.close()
+
+        self.sock = ours
+        self.owner = os.getpid()
+        self.ioloop.add_handler(self.sock.fileno(), self._handle_message, self.ioloop.READ | self.ioloop.ERROR)
+        logger.debug("Started spawner with pid %d", self.helper.pid)
+
+    def spawn(self, command, env=None, nice=0):
+        """Start a process with pipes for stdin, stdout and stderr, returns a subprocess.Popen look-alike
+
+        :param env: environment of the process, defaults to ours; both are cut down to the allowed variables
+        :param nice: niceness increment of the process
+        """
+        env = self.get_env(env)
+        if self.sock is None or self.owner != os.getpid():
+            return self._popen(command, env, nice)
+
+        pipes = [os.pipe() for i in range(3)]
+        for fd in sum(pipes, ()):
+            _set_close_exec(fd)
+        (stdin, stdin_w), (stdout_r, stdout), (stderr_r, stderr) = pipes
+
+        self.next_id += 1
+        try:
+            self._send(('spawn', self.next_id, command, env, nice), (stdin, stdout, stderr))
+        except (socket.error, OSError) as e:
+            for fd in (stdin_w, stdout_r, stderr_r):
+                os.close(fd)
+            logger.error("Lost the spawner: %s", e)
+            self._lost()
+            return self._popen(command, env, nice)
+        finally:
+            for fd in (stdin, stdout, stderr):
+                os.close(fd)
+
+        process = self.processes[self.next_id] = SpawnedProcess(self, self.next_id, stdin_w, stdout_r, stderr_r)
+        return process
+
+    def get_env(self, env=None):
+        """Cut an environment down to the variables passed on to processes"""
+        if env is None:
+            env = os.environ
+        return dict((key, value) for key, value in env.items() if key in self.env_keys or key.startswith('GIT_'))
+
+    def _popen(self, command, env, nice=0):
+        if nice:
+            # preexec_fn isn't safe in a process running threads
+            command = ['nice', '-n', str(nice)] + list(command)
+        started = time.time()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   close_fds=True, env=env)
+        self._record('popen', time.time() - started)
+        return process
+
+    def _send(self, message, fds=()):
+        self.sock.send(pickle.dumps(message, 2))
+        if fds:
+            sendfds(self.sock, fds)
+
+    def _handle_message(self, fd, events):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            logger.error("Lost the spawner: %s", e)
+            data = None
+
+        if not data:
+            if data is not None:
+                logger.error("Lost the spawner, it exited with %r", self.helper.poll())
+            self._lost()
+            return
+
+        message = pickle.loads(data)
+        process = self.processes.get(message[1])
+        if process is None:
+            return
+        if message[0] == 'started':
+            process.pid = message[2]
+            self._record('spawner', time.time() - process.spawned_at)
+        elif message[0] == 'failed':
+            logger.error("Unable to start %r: %s", message[2], message[3])
+        elif message[0] == 'exited':
+            del self.processes[message[1]]
+            process._exited(message[2])
+
+    def _record(self, method, seconds):
+        if self.metrics is not None:
+            self.metrics.process_spawned(method, seconds)
+
+    def _lost(self):
+        """The helper went away, start processes directly from now on"""
+        self.ioloop.remove_handler(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+
+        processes, self.processes = self.processes, {}
+        for process in processes.values():
+            process.lost = True
+            process._exited(None)
+
+def serve(sock):
+    """Start processes as requested through sock until it is closed"""
+    _set_close_exec(sock.fileno())
+    # SIGCHLD wakes up select through the pipe
+    wakeup, wakeup_w = os.pipe()
+    for fd in (wakeup, wakeup_w):
+        _set_close_exec(fd)
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    # id -> Popen of running processes, kept so subprocess doesn't reap them behind our back
+    running = {}
+
+    def send(message):
+        sock.send(pickle.dumps(message, 2))
+
+    while True:
+        try:
+            readable = select.select([sock, wakeup], [], [])[0]
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            continue
+
+        if wakeup in readable:
+            try:
+                while os.read(wakeup, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            for id, process in list(running.items()):
+                if process.poll() is not None:
+                    del running[id]
+                    send(('exited', id, process.returncode))
+
+        if sock in readable:
+            data = sock.recv(65536)
+            if not data:
+                return
+
+            message = pickle.loads(data)
+            if message[0] == 'spawn':
+                id, command, env, nice = message[1:]
+                fds = recvfds(sock, 3)
+                for fd in fds:
+                    _set_close_exec(fd)
+                try:
+                    process = subprocess.Popen(command, stdin=fds[0], stdout=fds[1], stderr=fds[2], close_fds=CLOSE_FDS, env=env,
+                                               preexec_fn=(lambda: os.nice(nice)) if nice else None)
+                except OSError as e:
+                    send(('failed', id, command, str(e)))
+                    send(('exited', id, NOT_STARTED))
+                else:
+                    running[id] = process
+                    send(('started', id, process.pid))
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+            elif message[0] == 'kill':
+                process = running.get(message[1])
+                if process is not None and process.poll() is None:
+                    process.kill()
+
+if __name__ == '__main__':
+    try:
+        serve(socket.fromfd(0, socket.AF_UNIX, socket.SOCK_SEQPACKET))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,587 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+"""Request handlers for Tornado 4.2 and later
+
+The handlers in this module stream request bodies into git as they arrive and
+git's output back out through RequestHandler.flush, waiting for every write to
+complete before reading more. Output git produces while the request body is still
+arriving is read right away and held until the body is complete. They leave HTTP framing to Tornado and run git
+with tornado.process.Subprocess, which installs a SIGCHLD handler, so they must
+not be mixed with the classic handlers in one process.
+
+Responses are never shared, so pack_cache and single_flight are not used, and
+ls-refs requests are always answered by git, so ref_index isn't either.
+"""
+
+import os
+import zlib
+import datetime
+
+import tornado
+import tornado.web
+import tornado.gen
+import tornado.iostream
+import tornado.concurrent
+import tornado.process
+
+from gittornado import RPCHandler, InfoRefsHandler, FileHandler, dont_cache, get_etag, get_advertisement_prelude
+from gittornado.iowrapper import DECOMPRESS_OUTPUT_SIZE, INPUT_TAIL_SIZE
+from gittornado.metrics import TrackedRequest
+from gittornado.spawner import SpawnedProcess
+from gittornado.util import parse_date_header, get_protocol_version
+
+import logging
+logger = logging.getLogger(__name__)
+
+if tornado.version_info < (4, 2):
+    raise ImportError('gittornado.streaming requires Tornado 4.2 or later')
+
+# bytes read from git resp. a file before waiting for the client to take them
+READ_SIZE = 64 * 1024
+
+def _detach(pipe):
+    """Get a descriptor of its own for a pipe, for an IOStream to close"""
+    fd = os.dup(pipe.fileno())
+    pipe.close()
+    return fd
+
+class SpawnedSubprocess(object):
+    """The parts of tornado.process.Subprocess we use, for processes of a gittornado.spawner.Spawner"""
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.stdin = tornado.iostream.PipeIOStream(_detach(proc.stdin))
+        self.stdout = tornado.iostream.PipeIOStream(_detach(proc.stdout))
+        self.stderr = tornado.iostream.PipeIOStream(_detach(proc.stderr))
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    @tornado.gen.coroutine
+    def wait_for_exit(self, raise_error=True):
+        if isinstance(self.proc, SpawnedProcess):
+            future = tornado.concurrent.Future()
+            self.proc.set_exit_callback(future.set_result)
+            retval = yield future
+        else:
+            # the spawner went away and it was started with subprocess.Popen
+            while self.proc.poll() is None:
+                yield tornado.gen.sleep(0.1)
+            retval = self.proc.returncode
+        raise tornado.gen.Return(retval)
+
+class StreamingMixin(object):
+    """Process handling shared by the streaming handlers
+
+    Set realm to answer requests lacking permissions with 401 and a Basic
+    authentication challenge instead of 403.
+    """
+
+    realm = None
+
+    process = None
+    ticket = None
+    client_gone = False
+
+    def deny(self):
+        if self.metrics is not None:
+            self.metrics.auth_failed(self.get_service())
+        if self.realm is None:
+            raise tornado.web.HTTPError(403, 'You are not allowed to perform this action')
+
+        self.set_status(401)
+        self.set_header('WWW-Authenticate', 'Basic realm="%s"' % self.realm)
+        self.set_header('Content-Type', 'text/plain')
+        self.finish('Authorization needed to access this repository')
+        return False
+
+    def authorized(self, gitdir=None):
+        """Get the read and write permissions of the client, resolves to a tuple
+
+        Given the repository, resolves to None if the rate limiter turned the request away."""
+        future = tornado.concurrent.Future()
+        self.authorize(lambda read, write: future.set_result((read, write)))
+        if gitdir is None or self.rate_limiter is None:
+            return future
+        return self._limit_rate(gitdir, future)
+
+    @tornado.gen.coroutine
+    def _limit_rate(self, gitdir, perms):
+        read, write = yield perms
+        delay = self.limit_rate(gitdir, read, write)
+        if delay is None:
+            raise tornado.gen.Return(None)
+        if delay:
+            yield tornado.gen.sleep(delay)
+            if self.client_gone:
+                raise tornado.gen.Return(None)
+        raise tornado.gen.Return((read, write))
+
+    def too_many_requests(self, retry_after):
+        self.set_status(429, 'Too Many Requests')
+        self.set_header('Retry-After', str(retry_after))
+        self.set_header('Content-Type', 'text/plain')
+        self.finish('Too many requests, please try again later')
+
+    def wait_for_slot(self, service, gitdir):
+        """Wait until the scheduler allows to run a git process, resolves to False if we may not"""
+        future = tornado.concurrent.Future()
+        if self.scheduler is None:
+            future.set_result(True)
+            return future
+
+        def on_start(ticket):
+            self.ticket = ticket
+            if self.client_gone:
+                logger.debug("Client went away while waiting")
+                ticket.release()
+            future.set_result(not self.client_gone)
+
+        def on_timeout():
+            self.set_status(503)
+            self.set_header('Retry-After', str(self.scheduler.retry_after))
+            self.set_header('Content-Type', 'text/plain')
+            self.finish('Too many requests, please try again later')
+            future.set_result(False)
+
+        self.ticket = self.scheduler.schedule(service, gitdir, self.get_client_id(), on_start, on_timeout)
+        return future
+
+    def spawn(self, command):
+        if self.spawner is not None:
+            self.process = SpawnedSubprocess(self.spawner.spawn(command, self.get_git_env()))
+        else:
+            self.process = tornado.process.Subprocess(command, stdin=tornado.process.Subprocess.STREAM,
+                                                      stdout=tornado.process.Subprocess.STREAM,
+                                                      stderr=tornado.process.Subprocess.STREAM,
+                                                      env=self.get_git_env())
+        if isinstance(self.request, TrackedRequest):
+            self.request.process_started()
+        if self.access is not None:
+            self.access.mark('spawn')
+
+        # git must not block on a full stderr pipe while we wait for stdout
+        self.stderr = self.process.stderr.read_until_close()
+
+    @tornado.gen.coroutine
+    def stream_output(self, headers, prelude='', gzip_output=None, input_tail='', tee=None, body_done=None):
+        """Send the output of the process, returns its exit status
+
+        Pass a future as body_done if the process is started before the request body is read.
+        Output is read right away but held back until it resolves to the input tail, or to
+        None if the request was answered otherwise and the output is not needed.
+        """
+        compressor = None
+        held = [prelude] if prelude else []
+        held_size = len(prelude)
+        started = False
+        aborted = False
+
+        while True:
+            try:
+                data = yield self.process.stdout.read_bytes(READ_SIZE, partial=True)
+            except tornado.iostream.StreamClosedError:
+                data = None
+
+            if data and tee is not None:
+                tee.write(data)
+            if data and self.access is not None:
+                self.access.mark('first_stdout')
+
+            if not started:
+                if data:
+                    held.append(data)
+                    held_size += len(data)
+
+                # git answers while it still reads the request, it must not block on a full stdout pipe
+                if body_done is not None:
+                    if data is not None and not body_done.done():
+                        continue
+                    input_tail = yield body_done
+                    body_done = None
+                    if input_tail is None:
+                        aborted = True
+                        break
+
+                # wait for enough output to decide whether compressing it is worth it
+                if gzip_output is not None and data and held_size < gzip_output.min_size:
+                    continue
+                if data is None and not held_size:
+                    break # no output at all
+
+                started = True
+                for name, value in headers.items():
+                    self.set_header(name, value)
+                if gzip_output is not None:
+                    self.set_header('Vary', 'Accept-Encoding')
+                    if held_size >= gzip_output.min_size and not input_tail.endswith(gzip_output.skip_input_suffixes):
+                        logger.debug('Compressing output')
+                        compressor = zlib.compressobj(gzip_output.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                        self.set_header('Content-Encoding', 'gzip')
+                data = ''.join(held)
+                held = None
+
+            if data is None:
+                break
+
+            if compressor is not None:
+                # flush every time so side-band progress messages reach the client right away
+                size = len(data)
+                data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                if self.access is not None:
+                    self.access.compressed(size, len(data))
+            yield self.send(data)
+
+        if compressor is not None:
+            data = compressor.flush()
+            if self.access is not None:
+                self.access.compressed(0, len(data))
+            yield self.send(data)
+
+        retval = yield self.reap()
+        stderr = yield self.stderr
+        if stderr:
+            logger.warning("Git wrote to stderr: %r", stderr[:1024])
+
+        if tee is not None:
+            tee.finish(retval if started else None)
+
+        if not started and not self.client_gone and not aborted:
+            if retval != 0:
+                self.set_status(500)
+                self.write(stderr or "Did not produce any data. Errorcode: " + str(retval))
+            else:
+                for name, value in headers.items():
+                    self.set_header(name, value)
+
+        raise tornado.gen.Return(retval)
+
+    @tornado.gen.coroutine
+    def reap(self):
+        """Wait for the process to exit and give up its slot, returns the exit status"""
+        retval = yield self.process.wait_for_exit(raise_error=False)
+        logger.debug("Git exited with %r", retval)
+        if isinstance(self.request, TrackedRequest):
+            self.request.process_exited(retval)
+        if self.access is not None:
+            self.access.exit_code = retval
+        if self.ticket is not None:
+            self.ticket.release()
+        raise tornado.gen.Return(retval)
+
+    @tornado.gen.coroutine
+    def send(self, data):
+        """Write data and wait for the client to take it"""
+        if self.client_gone:
+            return
+        if isinstance(self.request, TrackedRequest):
+            if self.request.code is None:
+                self.request.started(str(self.get_status()))
+            self.request.sent(len(data))
+        if self.access is not None:
+            self._access_sent(data)
+        self.write(data)
+        try:
+            yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            self.on_connection_close()
+            return
+        if self.throttle is not None:
+            delay = self.throttle.consume(len(data))
+            if delay:
+                yield tornado.gen.sleep(delay)
+
+    def finish(self, chunk=None):
+        if isinstance(self.request, TrackedRequest) and self.request.code is None:
+            self.request.started(str(self.get_status()))
+        if self.client_gone:
+            return
+        if self.access is not None:
+            self._access_sent(chunk or '')
+        try:
+            return tornado.web.RequestHandler.finish(self, chunk)
+        finally:
+            if self.access is not None:
+                self.access.finish()
+
+    def _access_sent(self, data):
+        if self.access.status is None:
+            self.access.status = self.get_status()
+            self.access.mark('first_byte')
+        self.access.sent(len(data))
+
+    def on_connection_close(self):
+        if self.client_gone:
+            return
+        self.client_gone = True
+
+        if self.ticket is not None and not self.ticket.running:
+            # don't keep the place in the queue
+            self.ticket.cancel()
+        # not polling, Tornado has to reap the process itself to notice it exited
+        if self.process is not None and self.process.returncode is None:
+            logger.warning('Client closed connection, killing git')
+            self.process.proc.kill()
+        if isinstance(self.request, TrackedRequest):
+            self.request.report()
+        if self.access is not None:
+            self.access.finish()
+        # fails the body future of streamed requests
+        tornado.web.RequestHandler.on_connection_close(self)
+
+@tornado.web.stream_request_body
+class StreamingRPCHandler(StreamingMixin, RPCHandler):
+    """Request handler for RPC calls, see RPCHandler"""
+
+    input_size = 0
+    input_tail = ''
+    input_error = None
+    decompressor = None
+    started = False
+    # resolves to the input tail once the request body was written to git
+    body_done = None
+    output = None
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        self.gitdir = self.get_gitdir()
+
+        # get RPC command
+        pathlets = self.request.path.strip('/').split('/')
+        rpc = pathlets[-1]
+        perms = yield self.authorized(self.gitdir)
+        if perms is None or not self.enforce_perms(rpc, perms):
+            return
+        self.rpc = rpc[4:]
+
+        if 'gzip' in self.request.headers.get('Content-Encoding', '').lower():
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        # the body is not read before we are done here, so waiting clients don't use any memory
+        self.started = yield self.wait_for_slot(self.rpc, self.gitdir)
+        if self.started:
+            self.spawn(self.get_rpc_command(self.rpc, self.gitdir))
+
+            # a request ending in done gets a pack as response, which is already compressed
+            gzip_output = self.get_gzip_output(['0009done\n', '0009done\n0000'] if self.rpc == 'upload-pack' else [])
+            self.body_done = tornado.concurrent.Future()
+            self.output = self.stream_output({'Content-Type': 'application/x-git-%s-result' % self.rpc},
+                                             gzip_output=gzip_output, body_done=self.body_done)
+
+    @tornado.gen.coroutine
+    def data_received(self, chunk):
+        if isinstance(self.request, TrackedRequest):
+            self.request.received(len(chunk))
+        if self.access is not None:
+            self.access.received(len(chunk))
+        if self.input_error is not None or not self.started:
+            return # drain the request
+
+        if self.decompressor is None:
+            yield self._write_input(chunk)
+            return
+
+        # limit the output of the decompressor so a small chunk can't expand into huge writes
+        try:
+            data = self.decompressor.decompress(chunk, DECOMPRESS_OUTPUT_SIZE)
+            while True:
+                yield self._write_input(data)
+                if self.input_error is not None or not self.decompressor.unconsumed_tail:
+                    return
+                data = self.decompressor.decompress(self.decompressor.unconsumed_tail, DECOMPRESS_OUTPUT_SIZE)
+        except zlib.error as e:
+            self._input_failed(400, 'Unable to decompress request: %s' % e)
+
+    @tornado.gen.coroutine
+    def _write_input(self, data):
+        self.input_size += len(data)
+        if self.max_request_size is not None and self.input_size > self.max_request_size:
+            self._input_failed(413, 'Request exceeds %d bytes' % self.max_request_size)
+            return
+        self.input_tail = (self.input_tail + data[-INPUT_TAIL_SIZE:])[-INPUT_TAIL_SIZE:]
+
+        try:
+            yield self.process.stdin.write(data)
+        except tornado.iostream.StreamClosedError:
+            logger.debug('Process closed stdin')
+            return
+        if self.access is not None and data:
+            self.access.mark('first_stdin')
+
+    def _input_failed(self, code, message):
+        logger.warning('Aborting request: %s', message)
+        self.input_error = (code, message)
+        self.process.proc.kill()
+        # stream_output reaps the process
+        self._body_done(None)
+
+        # Tornado closes the connection since the request was not read completely
+        self.set_status(code)
+        self.finish(message)
+
+    @tornado.gen.coroutine
+    def post(self):
+        if not self.started or self.input_error is not None:
+            return # already answered
+
+        self.process.stdin.close()
+        self._body_done(self.input_tail)
+
+        retval = yield self.output
+        if self.maintenance is not None and self.rpc == 'receive-pack' and retval == 0:
+            self.maintenance.push_done(self.gitdir)
+        self.finish()
+
+    def _body_done(self, input_tail):
+        if self.body_done is not None and not self.body_done.done():
+            self.body_done.set_result(input_tail)
+
+    def on_connection_close(self):
+        self._body_done(None)
+        StreamingMixin.on_connection_close(self)
+
+class StreamingInfoRefsHandler(StreamingMixin, InfoRefsHandler):
+    """Request handler for info/refs, see InfoRefsHandler"""
+
+    @tornado.gen.coroutine
+    def get(self):
+        gitdir = self.get_gitdir()
+
+        rpc = self.get_argument('service', '')
+
+        perms = yield self.authorized(gitdir)
+        if perms is None:
+            return
+        if not perms[0]:
+            self.deny()
+            return
+
+        if not rpc:
+            # this appears to be a dumb client. send the file
+            logger.debug("Dumb client detected")
+            for name, value in dont_cache():
+                self.set_header(name, value)
+            self.set_header('Content-Type', 'text/plain; charset=utf-8')
+            try:
+                with open(os.path.join(gitdir, 'info', 'refs'), 'rb') as f:
+                    self.finish(f.read())
+            except IOError:
+                raise tornado.web.HTTPError(404, 'File not found')
+            return
+
+        rpc = rpc[4:]
+
+        # protocol v2 starts with the capability advertisement of git right away
+        protocol = self.get_git_protocol()
+        prelude = get_advertisement_prelude(rpc) if get_protocol_version(protocol) != 2 else ''
+        headers = dict(dont_cache() + [('Content-Type', 'application/x-git-%s-advertisement' % rpc)])
+        gzip_output = self.get_gzip_output()
+
+        recorder = None
+        if self.advertisement_cache is not None:
+            entry = self.advertisement_cache.get(gitdir, rpc, protocol)
+            if entry is not None:
+                logger.debug("Serving cached advertisement")
+                body, etag = entry.body, entry.etag
+                if gzip_output is not None:
+                    self.set_header('Vary', 'Accept-Encoding')
+                    if entry.size >= gzip_output.min_size:
+                        body, etag = entry.get_gzipped(gzip_output.level)
+                        self.set_header('Content-Encoding', 'gzip')
+                for name, value in headers.items():
+                    self.set_header(name, value)
+                self.set_header('ETag', etag)
+                if self.check_etag_header():
+                    self.set_status(304)
+                    self.finish()
+                else:
+                    self.finish(body)
+                return
+            recorder = self.advertisement_cache.recorder(gitdir, rpc, prelude, protocol)
+
+        if not (yield self.wait_for_slot(rpc, gitdir)):
+            return
+
+        self.spawn([self.gitcommand, rpc, '--stateless-rpc', '--advertise-refs', gitdir])
+        self.process.stdin.close()
+        yield self.stream_output(headers, prelude, gzip_output, tee=recorder)
+        self.finish()
+
+    def compute_etag(self):
+        # only cached advertisements have an entity tag
+        return None
+
+class StreamingFileHandler(StreamingMixin, FileHandler):
+    """Request handler for static files, see FileHandler
+
+    Supports conditional requests, but not ranges."""
+
+    @tornado.gen.coroutine
+    def get(self):
+        gitdir = self.get_gitdir()
+
+        perms = yield self.authorized(gitdir)
+        if perms is None:
+            return
+        if not perms[0]:
+            self.deny()
+            return
+
+        filename, headers = self.get_file(gitdir)
+        logger.debug('Serving file %s', filename)
+
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            raise tornado.web.HTTPError(404, 'File not found')
+
+        with f:
+            st = os.fstat(f.fileno())
+            for name, value in headers.items():
+                self.set_header(name, value)
+            modified = datetime.datetime.utcfromtimestamp(int(st.st_mtime))
+            self.set_header('Last-Modified', modified)
+            etag = get_etag(filename)
+            if etag is not None:
+                self.set_header('ETag', etag)
+
+            if self.check_etag_header() or (etag is None and self._not_modified_since(int(st.st_mtime))):
+                self.set_status(304)
+                self.finish()
+                return
+
+            self.set_header('Content-Length', str(st.st_size))
+            while True:
+                data = f.read(max(self.file_chunk_size, READ_SIZE))
+                if not data:
+                    break
+                yield self.send(data)
+
+        self.finish()
+
+    def _not_modified_since(self, mtime):
+        if 'If-Modified-Since' not in self.request.headers:
+            return False
+        since = parse_date_header(self.request.headers['If-Modified-Since'])
+        return since is not None and mtime <= since
+
+    def compute_etag(self):
+        return None
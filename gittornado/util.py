@@ -17,12 +17,176 @@
 # You should have received a copy of the GNU General Public License
 # along with GitTornado.  If not, see http://www.gnu.org/licenses
 
+import re
+import zlib
+import time
+import base64
+import hashlib
 import datetime
 import calendar
 import email.utils
 
+# offset -> (second, formatted date)
+_http_dates = {}
+
+def get_http_date(offset=0):
+    """Format the current time plus offset seconds for a header, formatted once per second"""
+    now = int(time.time())
+    cached = _http_dates.get(offset)
+    if cached is None or cached[0] != now:
+        cached = _http_dates[offset] = (now, email.utils.formatdate(now + offset, localtime=False, usegmt=True))
+    return cached[1]
+
 def get_date_header(dt=None):
+    """Format dt (naive UTC) resp. the current time for a header"""
     if dt is None:
-        dt = datetime.datetime.now()
+        return get_http_date()
     t = calendar.timegm(dt.utctimetuple())
     return email.utils.formatdate(t, localtime=False, usegmt=True)
+
+def etag_matches(request, etag):
+    """Check whether the If-None-Match header of a request matches etag"""
+    header = request.headers.get('If-None-Match', None)
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in header.split(',')]
+
+def parse_date_header(value):
+    """Parse an HTTP date into a unix timestamp or None if it is invalid"""
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+def parse_range_header(value, size):
+    """Parse the Range header of a request for an entity of size bytes
+
+    Only single byte ranges are supported.
+
+    :returns: None if the header should be ignored, (start, end) with end being inclusive
+              or False if the range is not satisfiable
+    """
+    value = value.strip()
+    if not value.startswith('bytes='):
+        return None
+
+    spec = value[6:].strip()
+    if ',' in spec or '-' not in spec:
+        return None # multiple ranges or invalid, ignoring Range is always allowed
+
+    if size == 0:
+        return False # no range of an empty entity is satisfiable
+
+    start, end = [part.strip() for part in spec.split('-', 1)]
+    try:
+        if not start:
+            # suffix range: last n bytes
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+
+    if start >= size:
+        return False
+    if end < start:
+        return None
+
+    return start, min(end, size - 1)
+
+def accepts_gzip(request):
+    """Check whether the client accepts gzip content encoding"""
+    for coding in request.headers.get('Accept-Encoding', '').lower().split(','):
+        params = [param.strip() for param in coding.split(';')]
+        if params[0] in ('gzip', 'x-gzip', '*'):
+            return 'q=0' not in params and 'q=0.0' not in params
+    return False
+
+def get_basic_auth(request):
+    """Get (user, password) from the Authorization header or None"""
+    author = request.headers.get('Authorization', None)
+    if author is None:
+        return None
+
+    author = author.strip()
+    if author[:5].lower() != 'basic':
+        return None
+
+    try:
+        user, pw = base64.b64decode(author[5:].strip()).split(':', 1)
+    except (TypeError, ValueError):
+        return None
+
+    return user, pw
+
+def get_request_body(request, max_size):
+    """Get the (decompressed) body of a request
+
+    Returns None if the body is not available, e.g. because it uses chunked transfer
+    encoding, exceeds max_size bytes or can't be decompressed.
+    """
+    if request.headers.get('Transfer-Encoding', None) == 'chunked' or len(request.body) > max_size:
+        return None
+
+    if 'gzip' not in request.headers.get('Content-Encoding', '').lower():
+        return request.body
+
+    # decompress in pieces, the body is of limited size but the decompressed data might not be
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = request.body
+    offset, size, pending = 0, 0, ''
+    chunks = []
+    try:
+        while pending or offset < len(body):
+            if not pending:
+                pending = body[offset:offset + 16 * 1024]
+                offset += len(pending)
+            data = decompressor.decompress(pending, 64 * 1024)
+            pending = decompressor.unconsumed_tail
+
+            size += len(data)
+            if size > max_size:
+                return None
+            chunks.append(data)
+    except zlib.error:
+        return None
+
+    return ''.join(chunks)
+
+def hash_request_body(request, max_size):
+    """Compute the sha1 of the (decompressed) body of a request, see get_request_body"""
+    body = get_request_body(request, max_size)
+    if body is None:
+        return None
+    return hashlib.sha1(body).hexdigest()
+
+def pkt_line(data):
+    """Frame data as a pkt-line"""
+    return '%04x%s' % (len(data) + 4, data)
+
+# key[=value] parameters separated by colons, nothing that could confuse git or a shell
+git_protocol_matcher = re.compile('^[A-Za-z0-9._-]+(?:=[A-Za-z0-9._-]*)?(?::[A-Za-z0-9._-]+(?:=[A-Za-z0-9._-]*)?)*$')
+
+def get_git_protocol(request):
+    """Get the Git-Protocol header of a request if it is safe to pass to git as GIT_PROTOCOL or None"""
+    value = request.headers.get('Git-Protocol', None)
+    if value is None:
+        return None
+    value = value.strip()
+    if len(value) > 256 or not git_protocol_matcher.match(value):
+        return None
+    return value
+
+def get_protocol_version(protocol):
+    """Get the protocol version requested by a GIT_PROTOCOL value, 0 if there is none"""
+    version = 0
+    for param in (protocol or '').split(':'):
+        if param in ('version=1', 'version=2'):
+            version = max(version, int(param[8:]))
+    return version
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import subprocess
+
+import tornado.ioloop
+import tornado.httpserver
+
+import logging
+logger = logging.getLogger(__name__)
+
+# tells a process started by the Supervisor that it is a worker, e.g. "3:2,4:10;5"
+# for listening sockets on fds 3 (AF_INET) and 4 (AF_INET6) and heartbeats on fd 5
+WORKER_ENV = 'GITTORNADO_WORKER'
+
+# seconds between two heartbeats of a worker
+HEARTBEAT_INTERVAL = 1
+
+def bind_sockets(port, address=None, reuse_port=False, backlog=128):
+    """Create listening sockets for all addresses of address resp. all interfaces
+
+    With reuse_port, SO_REUSEPORT is set so every worker can bind its own sockets and
+    the kernel distributes connections among them.
+    """
+    sockets = []
+    if address == '':
+        address = None
+
+    for family, socktype, proto, canonname, sockaddr in set(socket.getaddrinfo(address, port, socket.AF_UNSPEC, socket.SOCK_STREAM,
+                                                                                0, socket.AI_PASSIVE)):
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6 and hasattr(socket, 'IPPROTO_IPV6'):
+            # the AF_INET socket takes care of IPv4
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+def _set_close_exec(fd):
+    # keep git processes started by workers from inheriting our sockets and pipes
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+class DrainingHTTPServer(tornado.httpserver.HTTPServer):
+    """HTTPServer that can shut down without interrupting requests in progress"""
+
+    def __init__(self, *args, **kwargs):
+        tornado.httpserver.HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = set()
+
+    def handle_stream(self, stream, address):
+        self.connections.add(tornado.httpserver.HTTPConnection(stream, address, self.request_callback,
+                                                               self.no_keep_alive, self.xheaders))
+
+    def busy_connections(self):
+        """Forget closed connections and count those with a request in progress"""
+        busy = 0
+        for connection in list(self.connections):
+            if connection.stream.closed():
+                self.connections.remove(connection)
+            elif connection._request is not None:
+                busy += 1
+        return busy
+
+    def drain(self, callback, timeout=None):
+        """Stop accepting connections and call callback once all requests finished
+
+        Idle keep-alive connections are closed. After timeout seconds, remaining
+        requests are given up.
+        """
+        self.stop()
+        ioloop = tornado.ioloop.IOLoop.instance()
+        deadline = time.time() + timeout if timeout else None
+
+        def check():
+            busy = self.busy_connections()
+            if busy and (deadline is None or time.time() < deadline):
+                logger.debug("Waiting for %d requests to finish", busy)
+                ioloop.add_timeout(time.time() + 0.5, check)
+                return
+
+            if busy:
+                logger.warning("Giving up %d requests", busy)
+            for connection in list(self.connections):
+                connection.stream.close()
+            callback()
+
+        check()
+
+def is_worker():
+    return WORKER_ENV in os.environ
+
+def serve_worker(server, port, address=None, reuse_port=False, drain_timeout=None):
+    """Run server as a worker of a Supervisor
+
+    Listens on the sockets passed by the supervisor (or its own sockets with
+    reuse_port), sends heartbeats and shuts down gracefully on SIGTERM.
+    """
+    listen, heartbeat_fd = os.environ.pop(WORKER_ENV).split(';')
+    heartbeat_fd = int(heartbeat_fd)
+    _set_nonblocking(heartbeat_fd)
+    _set_close_exec(heartbeat_fd)
+
+    if reuse_port:
+        sockets = bind_sockets(port, address, True)
+    else:
+        sockets = []
+        for entry in listen.split(','):
+            fd, family = [int(x) for x in entry.split(':')]
+            sockets.append(socket.fromfd(fd, family, socket.SOCK_STREAM))
+            os.close(fd)
+
+    for sock in sockets:
+        sock.setblocking(0)
+        _set_close_exec(sock.fileno())
+    server.add_sockets(sockets)
+
+    ioloop = tornado.ioloop.IOLoop.instance()
+    state = {'stopping': False}
+
+    def stop():
+        if state['stopping']:
+            return
+        state['stopping'] = True
+        logger.info("Worker %d shutting down", os.getpid())
+        server.drain(ioloop.stop, drain_timeout)
+
+    def beat():
+        try:
+            os.write(heartbeat_fd, b'.')
+        except OSError as e:
+            if e.errno == errno.EPIPE:
+                logger.warning("Supervisor went away")
+                stop()
+            elif e.errno != errno.EAGAIN:
+                raise
+
+    # the supervisor takes care of interrupts from the terminal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: ioloop.add_callback(stop))
+
+    beat() # tells the supervisor we are ready
+    tornado.ioloop.PeriodicCallback(beat, HEARTBEAT_INTERVAL * 1000).start()
+    ioloop.start()
+
+class WorkerProcess(object):
+    """A worker as seen by the supervisor"""
+
+    ready = False
+    retiring = None # time the worker was replaced
+    terminated = False
+    pipe_closed = False
+
+    def __init__(self, process, heartbeat_fd):
+        self.process = process
+        self.heartbeat_fd = heartbeat_fd
+        self.started = self.last_seen = time.time()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def signal(self, signum):
+        try:
+            os.kill(self.process.pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+class Supervisor(object):
+    """Runs a number of workers serving the same port
+
+    Workers are started by running the current command line again, so a reload
+    picks up new code and configuration. They either share the listening sockets
+    of the supervisor or, with reuse_port, bind their own with SO_REUSEPORT.
+
+    Workers that exit or stop sending heartbeats are replaced. On SIGHUP, all
+    workers are replaced: new workers are started and once they are ready, the old
+    ones stop accepting connections and exit after their requests finished.
+    SIGTERM and SIGINT shut down all workers the same way, a second one kills them.
+    """
+
+    stopping = False
+    reload_requested = False
+
+    def __init__(self, num_workers, port, address=None, reuse_port=False, heartbeat_timeout=30, command=None):
+        """
+        :param num_workers: number of workers to keep running
+        :param port: port to listen on
+        :param address: address to listen on, all interfaces by default
+        :param reuse_port: let workers bind their own sockets with SO_REUSEPORT
+        :param heartbeat_timeout: kill workers not sending a heartbeat for this many seconds
+        :param command: command to start a worker, defaults to the current command line
+        """
+        self.num_workers = num_workers
+        self.port = port
+        self.address = address
+        self.reuse_port = reuse_port
+        self.heartbeat_timeout = heartbeat_timeout
+        self.command = command if command is not None else [sys.executable] + sys.argv
+        self.workers = []
+        self.sockets = []
+        # delay starting workers if they keep dying right away
+        self.restart_delay = 0
+        self.next_start = 0
+
+    def run(self):
+        if self.reuse_port:
+            # fail early if the port is taken, workers bind their own sockets
+            for sock in bind_sockets(self.port, self.address, True):
+                sock.close()
+        else:
+            self.sockets = bind_sockets(self.port, self.address)
+
+        signal.signal(signal.SIGHUP, self._on_reload_signal)
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+        signal.signal(signal.SIGINT, self._on_stop_signal)
+        # only there to interrupt select
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        logger.info("Starting %d workers", self.num_workers)
+        while True:
+            self._reap()
+
+            if self.stopping:
+                if not self.workers:
+                    break
+            else:
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self._reload()
+                self._start_missing()
+                self._retire_replaced()
+
+            self._check_heartbeats()
+            self._wait_for_heartbeats()
+
+        logger.info("All workers exited")
+
+    def _on_reload_signal(self, signum, frame):
+        self.reload_requested = True
+
+    def _on_stop_signal(self, signum, frame):
+        if self.stopping:
+            logger.warning("Killing workers")
+            for worker in self.workers:
+                worker.signal(signal.SIGKILL)
+            return
+
+        logger.info("Shutting down workers")
+        self.stopping = True
+        for worker in self.workers:
+            worker.terminated = True
+            worker.signal(signal.SIGTERM)
+
+    def _spawn(self):
+        read_fd, write_fd = os.pipe()
+        _set_nonblocking(read_fd)
+
+        listen = ','.join('%d:%d' % (sock.fileno(), sock.family) for sock in self.sockets)
+        fds = [sock.fileno() for sock in self.sockets] + [write_fd]
+        env = dict(os.environ)
+        env[WORKER_ENV] = '%s;%d' % (listen, write_fd)
+
+        kwargs = {}
+        if hasattr(os, 'set_inheritable'):
+            for fd in fds:
+                os.set_inheritable(fd, True)
+            kwargs['pass_fds'] = fds
+        else:
+            kwargs['close_fds'] = False
+
+        try:
+            process = subprocess.Popen(self.command, env=env, **kwargs)
+        finally:
+            os.close(write_fd)
+
+        worker = WorkerProcess(process, read_fd)
+        self.workers.append(worker)
+        logger.info("Started worker %d", worker.pid)
+
+    def _start_missing(self):
+        active = [worker for worker in self.workers if not worker.retiring]
+        if len(active) < self.num_workers and time.time() >= self.next_start:
+            for i in range(self.num_workers - len(active)):
+                self._spawn()
+
+    def _reload(self):
+        logger.info("Reloading workers")
+        now = time.time()
+        for worker in self.workers:
+            if not worker.retiring:
+                worker.retiring = now
+
+    def _retire_replaced(self):
+        """Shut down old workers once their replacements are ready"""
+        ready = len([worker for worker in self.workers if worker.ready and not worker.retiring])
+        for worker in self.workers:
+            if worker.retiring and not worker.terminated:
+                if ready >= self.num_workers or time.time() - worker.retiring > self.heartbeat_timeout:
+                    logger.info("Shutting down worker %d", worker.pid)
+                    worker.terminated = True
+                    worker.signal(signal.SIGTERM)
+
+    def _reap(self):
+        for worker in list(self.workers):
+            retval = worker.process.poll()
+            if retval is None:
+                continue
+
+            self.workers.remove(worker)
+            os.close(worker.heartbeat_fd)
+
+            if worker.terminated:
+                logger.info("Worker %d exited", worker.pid)
+                continue
+
+            logger.warning("Worker %d exited unexpectedly with %r", worker.pid, retval)
+            if time.time() - worker.started < 1:
+                self.restart_delay = min(max(self.restart_delay * 2, 1), 30)
+                self.next_start = time.time() + self.restart_delay
+                logger.warning("Delaying restart for %ds", self.restart_delay)
+            else:
+                self.restart_delay = 0
+
+    def _check_heartbeats(self):
+        now = time.time()
+        for worker in self.workers:
+            if now - worker.last_seen > self.heartbeat_timeout:
+                logger.error("Worker %d did not send a heartbeat for %ds, killing it", worker.pid, now - worker.last_seen)
+                worker.signal(signal.SIGKILL)
+                # don't kill it over and over again until it is reaped
+                worker.last_seen = now
+
+    def _wait_for_heartbeats(self):
+        fds = dict((worker.heartbeat_fd, worker) for worker in self.workers if not worker.pipe_closed)
+        try:
+            readable = select.select(list(fds.keys()), [], [], HEARTBEAT_INTERVAL)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in readable:
+            worker = fds[fd]
+            try:
+                data = os.read(fd, 4096)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+            if data:
+                worker.ready = True
+                worker.last_seen = time.time()
+            else:
+                # the worker closed the pipe, it is about to exit
+                worker.pipe_closed = True
+                worker.last_seen = time.time() + self.heartbeat_timeout
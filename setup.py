@@ -31,8 +31,9 @@ setup(name='GitTornado',
       author_email='mensi@mensi.ch',
       long_description="""GitTornado is an implementation of the git HTTP-based protocol.""",
       packages=find_packages(),
-      zip_safe=True,
-      entry_points={'console_scripts': ['gittornado = gittornado.server:main']},
+      zip_safe=False,
+      entry_points={'console_scripts': ['gittornado = gittornado.server:main',
+                                        'gittornado-packcache = gittornado.packhook:main']},
       classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Environment :: Web Environment',
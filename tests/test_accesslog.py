@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+
+import base64
+import unittest
+
+import tornado.web
+import tornado.ioloop
+import tornado.testing
+
+from gittornado import RPCHandler, InfoRefsHandler
+from gittornado.accesslog import AccessEntry
+from gittornado.ratelimit import RateLimiter
+from gittornado.scheduler import ProcessScheduler, Pool
+
+class MemoryLog(object):
+    def __init__(self):
+        self.records = []
+
+    def entry(self, request, service):
+        return AccessEntry(self, request, service)
+
+    def write(self, record):
+        self.records.append(record)
+
+class VerifyingAuth(object):
+    """Lets alice write, everybody else read"""
+
+    def check(self, request, callback):
+        if request.headers.get('Authorization') == 'Basic ' + base64.b64encode('alice:secret'):
+            callback((True, True), 'alice')
+        else:
+            callback((True, False), None)
+
+def auth_failed(request):
+    request.write('HTTP/1.1 401 Unauthorized\r\nContent-Length: 0\r\nWWW-Authenticate: Basic realm="git"\r\n\r\n')
+
+class AccessLogTest(tornado.testing.AsyncHTTPTestCase):
+    """Every request gets its entry, however it is answered"""
+
+    def setUp(self):
+        self.log = MemoryLog()
+        self.conf = {'gitlookup': lambda request: None if 'missing' in request.path else '/nonexistent/repo.git',
+                     'access_log': self.log, 'auth': VerifyingAuth(), 'auth_failed': auth_failed}
+        tornado.testing.AsyncHTTPTestCase.setUp(self)
+
+    def get_new_ioloop(self):
+        # the scheduler runs on the global IOLoop
+        return tornado.ioloop.IOLoop.instance()
+
+    def get_app(self):
+        return tornado.web.Application([('/.*/git-.*', RPCHandler, self.conf),
+                                        ('/.*/info/refs', InfoRefsHandler, self.conf)])
+
+    def post(self, path, user=None):
+        headers = {'Content-Type': 'application/x-git-upload-pack-request'}
+        if user is not None:
+            headers['Authorization'] = 'Basic ' + base64.b64encode(user)
+        return self.fetch(path, method='POST', body='0000', headers=headers)
+
+    def get_record(self):
+        self.assertEqual(len(self.log.records), 1)
+        return self.log.records[0]
+
+    def test_not_found(self):
+        self.assertEqual(self.fetch('/missing.git/info/refs?service=git-upload-pack').code, 404)
+        self.assertEqual(self.get_record()['status'], 404)
+
+    def test_denied(self):
+        self.assertEqual(self.post('/repo.git/git-receive-pack', 'alice:guessed').code, 401)
+        record = self.get_record()
+        self.assertEqual(record['status'], 401)
+        # the name in the header was not verified
+        self.assertEqual(record['user'], None)
+
+    def test_too_many_requests(self):
+        self.conf['rate_limiter'] = RateLimiter(user_requests=(1, 0), max_delay=0)
+        self.assertEqual(self.post('/repo.git/git-receive-pack', 'alice:secret').code, 429)
+        record = self.get_record()
+        self.assertEqual(record['status'], 429)
+        self.assertEqual(record['user'], 'alice')
+        self.assertTrue(record['bytes_out'] > 0)
+
+    def test_queue_timeout(self):
+        self.conf['scheduler'] = ProcessScheduler({'upload-pack': Pool(0)}, queue_timeout=0.05)
+        self.assertEqual(self.post('/repo.git/git-upload-pack').code, 503)
+        record = self.get_record()
+        self.assertEqual(record['status'], 503)
+        self.assertEqual(record['repo'], '/nonexistent/repo.git')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import os
+import base64
+import hashlib
+import tempfile
+import unittest
+
+import tornado.ioloop
+import tornado.testing
+
+from gittornado.auth import verify_password, AccessFile, CachingAuth, crypt
+
+class FakeRequest(object):
+    def __init__(self, path):
+        self.path = path
+        self.headers = {}
+
+class VerifyPasswordTest(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertTrue(verify_password('secret', 'secret'))
+        self.assertFalse(verify_password('secret', 'Secret'))
+
+    def test_sha(self):
+        stored = '{SHA}' + base64.b64encode(hashlib.sha1('secret').digest())
+        self.assertTrue(verify_password('secret', stored))
+        self.assertFalse(verify_password('wrong', stored))
+
+    def test_ssha(self):
+        stored = '{SSHA}' + base64.b64encode(hashlib.sha1('secret' + 'salt').digest() + 'salt')
+        self.assertTrue(verify_password('secret', stored))
+        self.assertFalse(verify_password('wrong', stored))
+        self.assertFalse(verify_password('secret', '{SSHA}not base64!'))
+
+    def test_md5_crypt(self):
+        self.assertTrue(verify_password('secret', '$apr1$abcdefgh$h9FWgUz3n9YxylKLlR5SQ/'))
+        self.assertFalse(verify_password('wrong', '$apr1$abcdefgh$h9FWgUz3n9YxylKLlR5SQ/'))
+        self.assertTrue(verify_password('secret', '$1$abcdefgh$cHJi5PXp/ki/ktXzqlk6I1'))
+        self.assertFalse(verify_password('wrong', '$1$abcdefgh$cHJi5PXp/ki/ktXzqlk6I1'))
+
+    def test_pbkdf2(self):
+        stored = 'pbkdf2_sha256$1000$salt$qN+JnzxPIE2WfgrWPAkph8EAVeuwF7PZ0ordIY1Peq0='
+        self.assertTrue(verify_password('secret', stored))
+        self.assertFalse(verify_password('wrong', stored))
+        self.assertFalse(verify_password('secret', 'pbkdf2_sha256$many$salt$hash'))
+
+    @unittest.skipIf(crypt is None, 'needs the crypt module')
+    def test_crypt(self):
+        stored = crypt.crypt('secret', '$6$saltsalt')
+        if not stored or not stored.startswith('$6$'):
+            self.skipTest('crypt(3) does not support SHA-512')
+        self.assertTrue(verify_password('secret', stored))
+        self.assertFalse(verify_password('wrong', stored))
+
+class AccessFileTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('[users]\nalice = secret\nbob = {SHA}%s\n\n' % base64.b64encode(hashlib.sha1('pw').digest()))
+            f.write('[access]\nalice = repo.git, group/, other.git/info\nbob = group/sub/repo.git\n')
+        self.access = AccessFile(self.filename)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def can_write(self, user, path):
+        return self.access.permissions(user, FakeRequest(path))[1]
+
+    def test_verify(self):
+        self.assertTrue(self.access.verify('alice', 'secret'))
+        self.assertTrue(self.access.verify('Bob', 'pw'))
+        self.assertFalse(self.access.verify('bob', 'secret'))
+        self.assertFalse(self.access.verify('carol', 'secret'))
+
+    def test_repository(self):
+        self.assertTrue(self.can_write('alice', '/repo.git/git-receive-pack'))
+        self.assertTrue(self.can_write('alice', '/repo.git/info/refs'))
+        self.assertFalse(self.can_write('alice', '/repo.git2/git-receive-pack'))
+        self.assertFalse(self.can_write('alice', '/other/repo.git/git-receive-pack'))
+
+    def test_namespace(self):
+        self.assertTrue(self.can_write('alice', '/group/repo.git/git-receive-pack'))
+        self.assertTrue(self.can_write('alice', '/group/sub/repo.git/git-receive-pack'))
+        self.assertFalse(self.can_write('alice', '/group-other/repo.git/git-receive-pack'))
+        self.assertTrue(self.can_write('bob', '/group/sub/repo.git/git-receive-pack'))
+        self.assertFalse(self.can_write('bob', '/group/repo.git/git-receive-pack'))
+
+    def test_paths_inside_repositories_grant_nothing(self):
+        self.assertFalse(self.can_write('alice', '/other.git/git-receive-pack'))
+        self.assertFalse(self.can_write('alice', '/other.git/info/refs'))
+
+    def test_everybody_reads(self):
+        self.assertEqual(self.access.permissions('carol', FakeRequest('/repo.git/info/refs')), (True, False))
+
+class CachingAuthTest(tornado.testing.AsyncTestCase):
+
+    def get_new_ioloop(self):
+        # credentials are verified on a pool thread reporting back to the global IOLoop
+        return tornado.ioloop.IOLoop.instance()
+
+    def setUp(self):
+        super(CachingAuthTest, self).setUp()
+        fd, self.filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('[users]\nalice = secret\n\n[access]\nalice = repo.git\n')
+        self.auth = CachingAuth(AccessFile(self.filename), threads=1)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+        super(CachingAuthTest, self).tearDown()
+
+    def check(self, credentials=None):
+        request = FakeRequest('/repo.git/git-receive-pack')
+        if credentials is not None:
+            request.headers['Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        self.auth.check(request, lambda perms, user: self.stop((perms, user)))
+        return self.wait()
+
+    def test_verified_user(self):
+        self.assertEqual(self.check('alice:secret'), ((True, True), 'alice'))
+        # remembered
+        self.assertEqual(self.check('alice:secret'), ((True, True), 'alice'))
+
+    def test_invalid_credentials_have_no_user(self):
+        self.assertEqual(self.check('alice:wrong'), ((True, False), None))
+        self.assertEqual(self.check('mallory:secret'), ((True, False), None))
+
+    def test_anonymous(self):
+        self.assertEqual(self.check(), ((True, False), None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from gittornado.cache import AdvertisementCache, get_ref_state, ref_state_changed
+
+class RefStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gitdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.gitdir, 'refs', 'heads', 'feature'))
+        os.makedirs(os.path.join(self.gitdir, 'refs', 'tags'))
+        self.write('HEAD', 'ref: refs/heads/master\n')
+        self.write('refs/heads/feature/a', '1' * 40 + '\n')
+        self.state = get_ref_state(self.gitdir)
+        # make sure every change gets a new mtime
+        time.sleep(0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.gitdir)
+
+    def write(self, name, content):
+        # like git, by renaming into place
+        path = os.path.join(self.gitdir, name)
+        with open(path + '.lock', 'w') as f:
+            f.write(content)
+        os.rename(path + '.lock', path)
+
+    def test_unchanged(self):
+        self.assertFalse(ref_state_changed(self.gitdir, self.state))
+
+    def test_loose_ref(self):
+        self.write('refs/heads/feature/a', '2' * 40 + '\n')
+        self.assertTrue(ref_state_changed(self.gitdir, self.state))
+
+    def test_new_directory(self):
+        os.makedirs(os.path.join(self.gitdir, 'refs', 'heads', 'feature', 'nested'))
+        self.assertTrue(ref_state_changed(self.gitdir, self.state))
+
+    def test_packed_refs(self):
+        self.write('packed-refs', '3' * 40 + ' refs/tags/v1\n')
+        self.assertTrue(ref_state_changed(self.gitdir, self.state))
+
+    def test_advertisement_cache(self):
+        cache = AdvertisementCache()
+        recorder = cache.recorder(self.gitdir, 'upload-pack', 'prelude')
+        recorder.write('refs')
+        recorder.finish(0)
+        self.assertEqual(cache.get(self.gitdir, 'upload-pack').body, 'preluderefs')
+        self.write('refs/tags/v1', '4' * 40 + '\n')
+        self.assertEqual(cache.get(self.gitdir, 'upload-pack'), None)
+
+    def test_failed_process(self):
+        cache = AdvertisementCache()
+        recorder = cache.recorder(self.gitdir, 'upload-pack')
+        recorder.write('refs')
+        recorder.finish(128)
+        self.assertEqual(cache.get(self.gitdir, 'upload-pack'), None)
+
+if __name__ == '__main__':
+    unittest.main()
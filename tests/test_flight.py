@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import unittest
+
+from gittornado.flight import SingleFlight
+
+class FakeStream(object):
+    def __init__(self):
+        self.close_callback = None
+        self.is_closed = False
+
+    def set_close_callback(self, callback):
+        self.close_callback = callback
+
+    def closed(self):
+        return self.is_closed
+
+    def close(self):
+        self.is_closed = True
+        if self.close_callback is not None:
+            self.close_callback()
+
+class FakeConnection(object):
+    def __init__(self):
+        self.stream = FakeStream()
+
+class FakeRequest(object):
+    """Records what is written, write callbacks run when flush is called"""
+
+    def __init__(self, body='0032want 0123456789012345678901234567890123456789\n00000009done\n', headers=None):
+        self.body = body
+        self.headers = headers or {}
+        self.connection = FakeConnection()
+        self.written = []
+        self.callbacks = []
+        self.finished = False
+
+    def supports_http_1_1(self):
+        return True
+
+    def write(self, data, callback=None):
+        self.written.append(data)
+        if callback is not None:
+            self.callbacks.append(callback)
+
+    def flush(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def finish(self):
+        self.finished = True
+
+    def output(self):
+        return ''.join(self.written)
+
+class FakeAccess(object):
+    def __init__(self):
+        self.written = []
+        self.finished = 0
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished += 1
+
+class SingleFlightTest(unittest.TestCase):
+
+    command = ['git', 'upload-pack', '--stateless-rpc', '/repo.git']
+
+    def test_key(self):
+        sf = SingleFlight()
+        key = sf.get_key(self.command, FakeRequest(), None)
+        self.assertEqual(key, sf.get_key(self.command, FakeRequest(), None))
+        self.assertNotEqual(key, sf.get_key(self.command, FakeRequest(), True))
+        self.assertNotEqual(key, sf.get_key(self.command, FakeRequest(body='0000'), None))
+        self.assertNotEqual(key, sf.get_key(self.command, FakeRequest(headers={'Git-Protocol': 'version=2'}), None))
+
+    def test_large_requests_are_not_shared(self):
+        sf = SingleFlight(max_request_size=10)
+        self.assertEqual(sf.get_key(self.command, FakeRequest(), None), None)
+
+    def test_followers_get_the_whole_response(self):
+        sf = SingleFlight()
+        key = sf.get_key(self.command, FakeRequest(), None)
+        self.assertFalse(sf.join(key, FakeRequest()))
+
+        flight = sf.start(key)
+        flight.write('HTTP/1.1 200 OK\r\n\r\n')
+        first = FakeRequest()
+        self.assertTrue(sf.join(key, first))
+        flight.write('abc')
+        first.flush()
+        second = FakeRequest()
+        self.assertTrue(sf.join(key, second))
+        flight.write('def')
+        flight.finish()
+        for request in (first, second):
+            request.flush()
+            request.flush()
+            self.assertEqual(request.output(), 'HTTP/1.1 200 OK\r\n\r\nabcdef')
+            self.assertTrue(request.finished)
+        self.assertFalse(sf.join(key, FakeRequest()))
+
+    def test_join_window(self):
+        sf = SingleFlight(join_window=4)
+        key = sf.get_key(self.command, FakeRequest(), None)
+        flight = sf.start(key)
+        flight.write('abcd')
+        self.assertTrue(sf.join(key, FakeRequest()))
+        flight.write('e')
+        self.assertFalse(sf.join(key, FakeRequest()))
+
+    def test_backlog(self):
+        sf = SingleFlight(max_backlog=4)
+        key = sf.get_key(self.command, FakeRequest(), None)
+        flight = sf.start(key)
+        follower = FakeRequest()
+        sf.join(key, follower)
+        flight.write('abcdef')
+        self.assertTrue(flight.blocked())
+        drained = []
+        flight.drain_callback = lambda: drained.append(True)
+        follower.flush()
+        self.assertFalse(flight.blocked())
+        self.assertTrue(drained)
+
+    def test_abandoned(self):
+        sf = SingleFlight()
+        key = sf.get_key(self.command, FakeRequest(), None)
+        flight = sf.start(key)
+        abandoned = []
+        flight.abandon_callback = lambda: abandoned.append(True)
+        follower = FakeRequest()
+        sf.join(key, follower)
+        self.assertTrue(flight.leave())
+        self.assertFalse(sf.join(key, FakeRequest()))
+        follower.connection.stream.close()
+        self.assertTrue(abandoned)
+
+    def test_leader_failed(self):
+        sf = SingleFlight()
+        key = sf.get_key(self.command, FakeRequest(), None)
+        flight = sf.start(key)
+        follower = FakeRequest()
+        sf.join(key, follower)
+        flight.finish()
+        self.assertTrue(follower.output().startswith('HTTP/1.1 500 '))
+        self.assertFalse(follower.finished)
+
+    def test_access_log(self):
+        sf = SingleFlight()
+        key = sf.get_key(self.command, FakeRequest(), None)
+        flight = sf.start(key)
+        flight.write('HTTP/1.1 200 OK\r\n\r\nabc')
+        done, gone = FakeRequest(), FakeRequest()
+        done_access, gone_access = FakeAccess(), FakeAccess()
+        sf.join(key, done, done_access)
+        sf.join(key, gone, gone_access)
+        gone.connection.stream.close()
+        flight.finish()
+        done.flush()
+        self.assertEqual(''.join(done_access.written), 'HTTP/1.1 200 OK\r\n\r\nabc')
+        self.assertEqual(done_access.finished, 1)
+        self.assertEqual(gone_access.finished, 1)
+
+if __name__ == '__main__':
+    unittest.main()
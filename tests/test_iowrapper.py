@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import zlib
+import socket
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import tornado.web
+import tornado.ioloop
+import tornado.iostream
+import tornado.testing
+
+from gittornado import InfoRefsHandler, get_advertisement_prelude
+from gittornado.iowrapper import ProcessWrapper
+from gittornado.metrics import Metrics
+
+class HTTP10Test(tornado.testing.AsyncHTTPTestCase):
+    """Responses to HTTP/1.0 clients are spooled, they need a Content-Length or end with the connection"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.gitdir = self.tmpdir + '/repo.git'
+        subprocess.check_call(['git', 'init', '-q', '--bare', self.gitdir])
+        tree = subprocess.check_output(['git', 'mktree'], cwd=self.gitdir, stdin=open('/dev/null')).strip()
+        commit = subprocess.check_output(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                                          'commit-tree', tree, '-m', 'test'], cwd=self.gitdir).strip()
+        for i in range(100):
+            subprocess.check_call(['git', 'update-ref', 'refs/heads/branch%d' % i, commit], cwd=self.gitdir)
+        self.expected = get_advertisement_prelude('upload-pack') + subprocess.check_output(
+            ['git', 'upload-pack', '--stateless-rpc', '--advertise-refs', self.gitdir])
+        tornado.testing.AsyncHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+        tornado.testing.AsyncHTTPTestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def get_new_ioloop(self):
+        # ProcessWrapper runs on the global IOLoop
+        return tornado.ioloop.IOLoop.instance()
+
+    def get_app(self):
+        conf = {'gitlookup': lambda request: self.gitdir, 'gzip_output': True, 'gzip_min_size': 100}
+        return tornado.web.Application([('/.*/info/refs', InfoRefsHandler, conf)])
+
+    def get(self, headers):
+        sock = socket.create_connection(('127.0.0.1', self.get_http_port()))
+        stream = tornado.iostream.IOStream(sock)
+        stream.write('GET /repo.git/info/refs?service=git-upload-pack HTTP/1.0\r\n%s\r\n' % ''.join(h + '\r\n' for h in headers))
+        stream.read_until_close(self.stop)
+        response = self.wait()
+        head, body = response.split('\r\n\r\n', 1)
+        lines = head.split('\r\n')
+        return lines[0], dict(line.split(': ', 1) for line in lines[1:]), body
+
+    def test_plain(self):
+        status, headers, body = self.get([])
+        self.assertEqual(status, 'HTTP/1.0 200 OK')
+        self.assertEqual(headers['Content-Length'], str(len(self.expected)))
+        self.assertEqual(body, self.expected)
+
+    def test_gzip(self):
+        status, headers, body = self.get(['Accept-Encoding: gzip', 'Connection: keep-alive'])
+        self.assertEqual(status, 'HTTP/1.0 200 OK')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Connection'], 'close')
+        self.assertFalse('Content-Length' in headers)
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), self.expected)
+
+class ExitStatusTest(tornado.testing.AsyncHTTPTestCase):
+    """git closes its output before it exits, its exit status must not be missed"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        subprocess.check_call(['git', 'init', '-q', '--bare', self.tmpdir + '/repo.git'])
+        self.exits = []
+        self.metrics = Metrics()
+        tornado.testing.AsyncHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+        tornado.testing.AsyncHTTPTestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def get_new_ioloop(self):
+        return tornado.ioloop.IOLoop.instance()
+
+    def get_app(self):
+        test = self
+
+        class Handler(tornado.web.RequestHandler):
+            @tornado.web.asynchronous
+            def get(self):
+                ProcessWrapper(test.metrics.track(self.request, 'info-refs'), ['git', 'upload-pack', '--stateless-rpc', '--advertise-refs', test.tmpdir + '/repo.git'],
+                               {'Content-Type': 'text/plain'}, finish_callback=test.exits.append)
+
+        return tornado.web.Application([('/', Handler)])
+
+    def test_exit_status(self):
+        for i in range(20):
+            self.assertEqual(self.fetch('/').code, 200)
+        self.assertEqual(self.exits, [0] * 20)
+        self.assertEqual(dict((values, child.value) for values, child in self.metrics.process_exits.children.items()),
+                         {('info-refs', '0'): 20})
+        self.assertEqual(self.metrics.active_processes.labels('info-refs').value, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import tornado.ioloop
+import tornado.testing
+
+from gittornado.maintenance import MaintenanceScheduler
+from gittornado.spawner import Spawner
+
+class RecordingMetrics(object):
+    def __init__(self, callback):
+        self.callback = callback
+
+    def maintenance_done(self, task, result, seconds):
+        self.callback((task, result))
+
+class MaintenanceSchedulerTest(tornado.testing.AsyncTestCase):
+
+    def get_new_ioloop(self):
+        # the scheduler and the spawner run on the global IOLoop
+        return tornado.ioloop.IOLoop.instance()
+
+    def setUp(self):
+        super(MaintenanceSchedulerTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.gitdir = os.path.join(self.tmpdir, 'repo.git')
+        os.mkdir(self.gitdir)
+        # stands in for git, noting its niceness and arguments
+        self.git = os.path.join(self.tmpdir, 'git')
+        with open(self.git, 'w') as f:
+            f.write('#!/bin/sh\necho "$(nice) $*" >> %s/calls\necho output >&2\nexit 0\n' % self.tmpdir)
+        os.chmod(self.git, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(MaintenanceSchedulerTest, self).tearDown()
+
+    def run_tasks(self, spawner=None):
+        done = []
+        scheduler = MaintenanceScheduler(gitcommand=self.git, nice=5, spawner=spawner)
+        scheduler.metrics = RecordingMetrics(lambda result: (done.append(result), len(done) == 2 and self.stop()))
+        scheduler.schedule(self.gitdir, ['repack'])
+        self.wait()
+        self.assertEqual(done, [('repack', 'success'), ('commit-graph', 'success')])
+        self.assertEqual(scheduler.running, {})
+
+        base = os.nice(0)
+        with open(os.path.join(self.tmpdir, 'calls')) as f:
+            calls = f.read().splitlines()
+        self.assertEqual(calls, ['%d --git-dir %s repack -a -d -q --write-bitmap-index' % (base + 5, self.gitdir),
+                                 '%d --git-dir %s commit-graph write --reachable' % (base + 5, self.gitdir)])
+
+    def test_without_spawner(self):
+        self.run_tasks()
+
+    def test_spawner(self):
+        spawner = Spawner()
+        spawner.start()
+        try:
+            self.run_tasks(spawner)
+            self.assertEqual(spawner.next_id, 2)
+        finally:
+            self.io_loop.remove_handler(spawner.sock.fileno())
+            spawner.sock.close()
+            spawner.helper.wait()
+
+if __name__ == '__main__':
+    unittest.main()
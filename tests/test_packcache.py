@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from gittornado.packcache import PackCache
+
+class PackCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, cache, key, data, retval=0):
+        resolved = []
+        recorder = cache.recorder(key)
+        cache.wait(key, resolved.append)
+        recorder.write(data)
+        recorder.finish(retval)
+        return resolved[0]
+
+    def test_store(self):
+        cache = PackCache(self.directory, max_bytes=100, max_entry_size=50)
+        path = self.store(cache, 'a', 'response')
+        self.assertEqual(path, cache.get('a'))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'response')
+        self.assertFalse(cache.is_pending('a'))
+
+    def test_failed_process(self):
+        cache = PackCache(self.directory, max_bytes=100, max_entry_size=50)
+        self.assertEqual(self.store(cache, 'a', 'partial', retval=128), None)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_shared_directory(self):
+        # two workers
+        first = PackCache(self.directory, max_bytes=100, max_entry_size=50)
+        second = PackCache(self.directory, max_bytes=100, max_entry_size=50)
+        self.store(first, 'a', 'x' * 40)
+        time.sleep(0.01)
+        self.store(second, 'b', 'x' * 40)
+        time.sleep(0.01)
+        # used by the first worker, so the second evicts b
+        self.assertTrue(first.get('a') is not None)
+        time.sleep(0.01)
+        self.store(second, 'c', 'x' * 40)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a', 'c'])
+        self.assertEqual(second.total_bytes, 80)
+
+    def test_stale_temporary_files(self):
+        with open(os.path.join(self.directory, 'tmp-999999999-abc'), 'w') as f:
+            f.write('partial')
+        PackCache(self.directory)
+        self.assertEqual(os.listdir(self.directory), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+
+import unittest
+
+from gittornado.ratelimit import TokenBucket, RateLimiter
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst(self):
+        bucket = TokenBucket(1, 3, now=0)
+        self.assertEqual([bucket.take(1, 0) for i in range(3)], [0, 0, 0])
+        self.assertEqual(bucket.take(1, 0), 1)
+
+    def test_refill(self):
+        bucket = TokenBucket(2, 2, now=0)
+        bucket.take(2, 0)
+        self.assertEqual(bucket.take(1, 0.5), 0)
+        # never more than burst
+        self.assertEqual(bucket.take(2, 100), 0)
+        self.assertEqual(bucket.take(1, 100), 0.5)
+
+    def test_debt(self):
+        bucket = TokenBucket(10, 10, now=0)
+        self.assertEqual(bucket.take(30, 0), 2)
+        self.assertEqual(bucket.take(1, 1), 1.1)
+
+    def test_give(self):
+        bucket = TokenBucket(1, 1, now=0)
+        bucket.take(2, 0)
+        bucket.give(2)
+        self.assertEqual(bucket.tokens, 1)
+        bucket.give(5)
+        self.assertEqual(bucket.tokens, 1)
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        limiter = RateLimiter()
+        self.assertEqual(limiter.admit('alice', '127.0.0.1', '/repo.git'), (True, 0))
+        self.assertEqual(limiter.get_throttle('alice', '127.0.0.1', '/repo.git'), None)
+
+    def test_reject(self):
+        limiter = RateLimiter(user_requests=(1, 1), max_delay=1.5)
+        self.assertEqual(limiter.admit('alice', '127.0.0.1', '/repo.git'), (True, 0))
+        admitted, delay = limiter.admit('alice', '127.0.0.1', '/repo.git')
+        self.assertTrue(admitted)
+        self.assertTrue(0 < delay <= 1)
+        admitted, delay = limiter.admit('alice', '127.0.0.1', '/repo.git')
+        self.assertFalse(admitted)
+        self.assertTrue(delay > 1.5)
+        # the rejected request didn't count
+        self.assertTrue(-1 <= limiter.buckets[('user', 'requests', 'alice')].tokens < 0)
+
+    def test_users_and_addresses(self):
+        limiter = RateLimiter(user_requests=(1, 1), ip_requests=(1, 2), max_delay=0)
+        self.assertTrue(limiter.admit('alice', '10.0.0.1', '/repo.git')[0])
+        self.assertFalse(limiter.admit('alice', '10.0.0.2', '/repo.git')[0])
+        self.assertTrue(limiter.admit('bob', '10.0.0.1', '/repo.git')[0])
+        # requests without a verified user only count against their address
+        self.assertFalse(limiter.admit(None, '10.0.0.1', '/repo.git')[0])
+        self.assertTrue(limiter.admit(None, '10.0.0.3', '/repo.git')[0])
+        self.assertTrue(('user', 'requests', None) not in limiter.buckets)
+
+    def test_max_buckets(self):
+        limiter = RateLimiter(ip_requests=(1, 1), max_buckets=2)
+        for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+            limiter.admit(None, ip, '/repo.git')
+        self.assertEqual(list(limiter.buckets), [('ip', 'requests', '10.0.0.2'), ('ip', 'requests', '10.0.0.3')])
+
+    def test_throttle(self):
+        limiter = RateLimiter(repo_bandwidth=(1000, 1000))
+        throttle = limiter.get_throttle('alice', '127.0.0.1', '/repo.git')
+        self.assertEqual(throttle.consume(1000), 0)
+        self.assertTrue(throttle.consume(500) > 0.4)
+
+if __name__ == '__main__':
+    unittest.main()
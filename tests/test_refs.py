@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import tornado.ioloop
+import tornado.testing
+
+from gittornado import get_advertisement_prelude
+from gittornado.refs import RefTable, RefIndex, parse_ls_refs
+from gittornado.spawner import Spawner
+from gittornado.util import pkt_line
+
+def git(gitdir, *args, **kwargs):
+    process = subprocess.Popen(['git', '--git-dir', gitdir] + list(args), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               env=kwargs.get('env'))
+    output = process.communicate(kwargs.get('input'))[0]
+    assert process.returncode == 0, args
+    return output
+
+def create_repository(path):
+    """Create a bare repository with branches, lightweight and annotated tags, some of them packed"""
+    git(path, 'init', '-q', '--bare')
+    env = dict(os.environ, GIT_AUTHOR_NAME='Test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='Test', GIT_COMMITTER_EMAIL='test@example.com')
+    tree = git(path, 'mktree', input='').strip()
+    parent = None
+    for i in range(5):
+        args = ['commit-tree', tree, '-m', 'commit %d' % i] + (['-p', parent] if parent else [])
+        parent = git(path, *args, env=env).strip()
+        git(path, 'update-ref', 'refs/heads/branch%d' % i, parent)
+        git(path, 'tag', '-a', '-m', 'tag %d' % i, 'v%d' % i, parent, env=env)
+    git(path, 'update-ref', 'refs/heads/master', parent)
+    git(path, 'tag', 'light', parent)
+    git(path, 'pack-refs', '--all')
+    # loose refs on top of the packed ones
+    git(path, 'tag', '-a', '-m', 'loose tag', 'loose', parent, env=env)
+    git(path, 'update-ref', 'refs/heads/branch0', parent)
+
+def upload_pack(gitdir, *args, **kwargs):
+    return subprocess.Popen(['git', 'upload-pack', '--stateless-rpc'] + list(args) + [gitdir], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, env=kwargs.get('env')).communicate(kwargs.get('input'))[0]
+
+class RefTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.gitdir = os.path.join(self.tmpdir, 'repo.git')
+        create_repository(self.gitdir)
+        self.table = RefTable(self.gitdir)
+        self.table.refresh()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertAdvertisementMatches(self):
+        expected = get_advertisement_prelude('upload-pack') + upload_pack(self.gitdir, '--advertise-refs')
+        self.assertEqual(self.table.advertise().body, expected)
+
+    def test_advertisement(self):
+        self.assertAdvertisementMatches()
+
+    def test_changes(self):
+        self.assertFalse(self.table.outdated())
+        git(self.gitdir, 'update-ref', '-d', 'refs/tags/v1')
+        git(self.gitdir, 'update-ref', 'refs/heads/new', 'refs/heads/branch2')
+        git(self.gitdir, 'symbolic-ref', 'HEAD', 'refs/heads/branch3')
+        self.assertTrue(self.table.outdated())
+        self.assertTrue(self.table.refresh())
+        self.assertFalse(self.table.outdated())
+        self.assertAdvertisementMatches()
+
+    def test_packed_refs_changed(self):
+        git(self.gitdir, 'pack-refs', '--all')
+        self.assertTrue(self.table.outdated())
+        self.table.refresh()
+        self.assertAdvertisementMatches()
+
+    def test_packed_tags_without_peeled_lines(self):
+        git(self.gitdir, 'repack', '-a', '-d', '-q')
+        git(self.gitdir, 'pack-refs', '--all')
+        with open(os.path.join(self.gitdir, 'packed-refs')) as f:
+            lines = [line for line in f if not line.startswith(('#', '^'))]
+        with open(os.path.join(self.gitdir, 'packed-refs'), 'w') as f:
+            f.writelines(lines)
+        self.table.refresh()
+        self.assertAdvertisementMatches()
+
+    def test_unborn(self):
+        git(self.gitdir, 'symbolic-ref', 'HEAD', 'refs/heads/unborn')
+        self.table.refresh()
+        self.assertAdvertisementMatches()
+
+    def test_ls_refs(self):
+        env = dict(os.environ, GIT_PROTOCOL='version=2')
+        for arguments in ([], ['peel', 'symrefs'], ['ref-prefix refs/tags/', 'ref-prefix HEAD', 'peel'],
+                          ['symrefs', 'ref-prefix refs/heads/branch']):
+            body = pkt_line('command=ls-refs\n') + '0001' + ''.join(pkt_line(argument + '\n') for argument in arguments) + '0000'
+            self.assertEqual(self.table.ls_refs(**parse_ls_refs(body)), upload_pack(self.gitdir, input=body, env=env))
+
+    def test_parse_ls_refs(self):
+        self.assertEqual(parse_ls_refs('0014command=ls-refs\n00010009peel\n0000'),
+                         {'prefixes': [], 'peel': True, 'symrefs': False, 'unborn': False})
+        self.assertEqual(parse_ls_refs('0012command=fetch\n0000'), None)
+        self.assertEqual(parse_ls_refs('0014command=ls-refs\n00010009what\n0000'), None)
+        self.assertEqual(parse_ls_refs('0014command=ls-refs\n0001'), None)
+
+class RefIndexTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        tornado.testing.AsyncTestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.gitdir = os.path.join(self.tmpdir, 'repo.git')
+        create_repository(self.gitdir)
+        self.index = RefIndex()
+        refreshed = self.index._refreshed
+        def on_refreshed(*args):
+            refreshed(*args)
+            self.stop()
+        self.index._refreshed = on_refreshed
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        tornado.testing.AsyncTestCase.tearDown(self)
+
+    def get_new_ioloop(self):
+        # the index calls back on the global IOLoop
+        return tornado.ioloop.IOLoop.instance()
+
+    def test_advertise(self):
+        expected = get_advertisement_prelude('upload-pack') + upload_pack(self.gitdir, '--advertise-refs')
+        # git answers while the refs are read in the background
+        self.assertEqual(self.index.advertise(self.gitdir), None)
+        self.assertEqual(self.index.advertise(self.gitdir), None)
+        self.wait()
+        self.assertEqual(self.index.advertise(self.gitdir).body, expected)
+
+        git(self.gitdir, 'update-ref', 'refs/heads/new', 'refs/heads/branch2')
+        self.assertEqual(self.index.advertise(self.gitdir), None)
+        self.wait()
+        entry = self.index.advertise(self.gitdir)
+        self.assertTrue(' refs/heads/new\n' in entry.body)
+        self.assertTrue(self.index.advertise(self.gitdir) is entry)
+
+    def test_spawner(self):
+        spawner = Spawner()
+        spawner.start()
+        try:
+            self.index.spawner = spawner
+            self.test_advertise()
+            self.assertTrue(spawner.next_id > 0)
+        finally:
+            self.io_loop.remove_handler(spawner.sock.fileno())
+            spawner.sock.close()
+            spawner.helper.wait()
+
+    def test_hidden_refs(self):
+        git(self.gitdir, 'config', 'uploadpack.hideRefs', 'refs/tags/')
+        self.assertEqual(self.index.advertise(self.gitdir), None)
+        self.wait()
+        self.assertEqual(self.index.advertise(self.gitdir), None)
+        self.assertEqual(self.index.ls_refs(self.gitdir, '0014command=ls-refs\n00010000'), None)
+
+    def test_missing_repository(self):
+        self.assertEqual(self.index.advertise(self.tmpdir + '/missing.git'), None)
+        self.wait()
+        self.assertFalse(self.tmpdir + '/missing.git' in self.index.tables)
+
+if __name__ == '__main__':
+    unittest.main()
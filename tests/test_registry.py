@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import tornado.ioloop
+import tornado.testing
+
+from gittornado.registry import RepositoryRegistry
+
+class RepositoryRegistryTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        tornado.testing.AsyncTestCase.setUp(self)
+        self.base = tempfile.mkdtemp()
+        self.init('repo.git')
+        self.init('group/sub/repo.git')
+        self.registry = RepositoryRegistry(self.base, negative_ttl=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+        tornado.testing.AsyncTestCase.tearDown(self)
+
+    def init(self, name):
+        subprocess.check_call(['git', 'init', '-q', '--bare', os.path.join(self.base, name)])
+
+    def test_lookup(self):
+        self.assertEqual(self.registry.lookup('/repo.git/info/refs'), os.path.join(self.base, 'repo.git'))
+        self.assertEqual(self.registry.lookup('/group/sub/repo.git/git-upload-pack'), os.path.join(self.base, 'group/sub/repo.git'))
+        self.assertEqual(self.registry.lookup('/group/repo.git/info/refs'), None)
+        self.assertEqual(self.registry.lookup('/../repo.git/info/refs'), None)
+
+    def test_new_repository(self):
+        self.init('group/new.git')
+        self.assertEqual(self.registry.lookup('/group/new.git/info/refs'), os.path.join(self.base, 'group/new.git'))
+
+    def test_deleted_repository(self):
+        shutil.rmtree(os.path.join(self.base, 'group/sub'))
+        self.registry.rescan()
+        self.assertEqual(self.registry.lookup('/group/sub/repo.git/info/refs'), None)
+
+    def test_start(self):
+        self.registry.rescan_interval = 0.01
+        rescans = []
+        self.registry.rescan = lambda: (rescans.append(True), self.stop())
+        callback = self.registry.start(self.io_loop)
+        self.wait()
+        callback.stop()
+        self.assertTrue(rescans)
+
+if __name__ == '__main__':
+    unittest.main()
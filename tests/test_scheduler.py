@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+
+import unittest
+
+import tornado.ioloop
+import tornado.testing
+
+from gittornado.scheduler import ProcessScheduler, Pool
+
+class ProcessSchedulerTest(tornado.testing.AsyncTestCase):
+
+    def get_new_ioloop(self):
+        # the scheduler uses the global IOLoop for its timeouts
+        return tornado.ioloop.IOLoop.instance()
+
+    def setUp(self):
+        super(ProcessSchedulerTest, self).setUp()
+        self.scheduler = ProcessScheduler({'upload-pack': Pool(2, 1), 'receive-pack': Pool(1, 1)}, queue_timeout=None)
+        self.started = []
+        self.tickets = {}
+
+    def schedule(self, name, gitdir='/a.git', client='ip:10.0.0.1', service='upload-pack'):
+        self.tickets[name] = self.scheduler.schedule(service, gitdir, client,
+                                                     lambda ticket: self.started.append(name),
+                                                     lambda: self.started.append(name + ' timed out'))
+
+    def test_limits(self):
+        self.schedule('a1', '/a.git')
+        self.schedule('a2', '/a.git')
+        self.schedule('b1', '/b.git', client='ip:10.0.0.2')
+        self.schedule('c1', '/c.git', client='ip:10.0.0.3')
+        # a2 waits for the repository, b1 takes the second slot
+        self.assertEqual(self.started, ['a1', 'b1'])
+        self.tickets['a1'].release()
+        self.assertEqual(self.started, ['a1', 'b1', 'a2'])
+        self.tickets['a1'].release()
+        self.assertEqual(self.scheduler.get_pool('upload-pack').running, 2)
+
+    def test_pools(self):
+        self.schedule('a1', '/a.git')
+        self.schedule('a2', '/a.git')
+        self.schedule('push', '/a.git', service='receive-pack')
+        self.schedule('other', '/a.git', service='upload-archive')
+        self.assertEqual(self.started, ['a1', 'push', 'other'])
+
+    def test_round_robin(self):
+        self.scheduler.pools['upload-pack'] = Pool(1)
+        for i in range(3):
+            self.schedule('greedy%d' % i, '/r%d.git' % i, client='user:greedy')
+        self.schedule('modest', '/modest.git', client='user:modest')
+        self.assertEqual(self.started, ['greedy0'])
+        for name in ('greedy0', 'greedy1', 'modest'):
+            self.tickets[name].release()
+        # modest didn't have to wait for every request of greedy
+        self.assertEqual(self.started, ['greedy0', 'greedy1', 'modest', 'greedy2'])
+
+    def test_cancel(self):
+        self.scheduler.pools['upload-pack'] = Pool(1)
+        self.schedule('first')
+        self.schedule('gone', '/b.git')
+        self.schedule('next', '/c.git', client='ip:10.0.0.2')
+        self.tickets['gone'].cancel()
+        self.tickets['first'].release()
+        self.assertEqual(self.started, ['first', 'next'])
+        self.assertEqual(self.scheduler.get_pool('upload-pack').waiting, 0)
+
+    def test_timeout(self):
+        self.scheduler.queue_timeout = 0.05
+        self.schedule('a1')
+        self.schedule('a2')
+        self.io_loop.add_timeout(self.io_loop.time() + 0.2, self.stop)
+        self.wait()
+        self.assertEqual(self.started, ['a1', 'a2 timed out'])
+        self.assertTrue(self.tickets['a2'].done)
+        self.assertEqual(self.scheduler.get_pool('upload-pack').waiting, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import tornado
+import tornado.web
+import tornado.testing
+
+from gittornado.util import pkt_line
+
+if tornado.version_info >= (4, 2):
+    from gittornado.streaming import StreamingRPCHandler
+else:
+    StreamingRPCHandler = None
+
+def create_repository(path, commits):
+    """Create a bare repository with a linear history, returns the commit ids oldest first"""
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    commands = []
+    for i in range(commits):
+        commands.append('commit refs/heads/master\nmark :%d\n'
+                        'committer Test <test@example.com> %d +0000\ndata 9\ncommit %d\n' % (i + 1, 1300000000 + i, i % 10))
+        commands.append('M 644 inline file\ndata %d\n%d\n\n' % (len(str(i)) + 1, i))
+    fast_import = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+    fast_import.communicate(''.join(commands))
+    assert fast_import.returncode == 0
+    return subprocess.check_output(['git', 'rev-list', '--reverse', 'master'], cwd=path).split()
+
+@unittest.skipIf(StreamingRPCHandler is None, 'needs Tornado 4.2 or later')
+class StreamingRPCHandlerTest(tornado.testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.gitdir = self.tmpdir + '/repo.git'
+        self.commits = create_repository(self.gitdir, 3000)
+        tornado.testing.AsyncHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+        tornado.testing.AsyncHTTPTestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def get_app(self):
+        self.conf = {'gitlookup': lambda request: self.gitdir}
+        return tornado.web.Application([('/.*/git-.*', StreamingRPCHandler, self.conf)])
+
+    def upload_pack(self, body):
+        return self.fetch('/repo.git/git-upload-pack', method='POST', body=body, request_timeout=20,
+                          headers={'Content-Type': 'application/x-git-upload-pack-request'})
+
+    def test_fetch(self):
+        body = pkt_line('want %s side-band-64k\n' % self.commits[-1]) + '0000' + pkt_line('done\n')
+        response = self.upload_pack(body)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'application/x-git-upload-pack-result')
+        self.assertTrue(response.body.startswith('0008NAK\n'))
+
+    def test_large_negotiation(self):
+        # git acknowledges haves while it still reads more of them, far more than fits into a pipe
+        body = [pkt_line('want %s multi_ack_detailed no-done side-band-64k\n' % self.commits[-1]), '0000']
+        body.extend(pkt_line('have %s\n' % commit) for commit in self.commits[:-1])
+        body.append(pkt_line('done\n'))
+        response = self.upload_pack(''.join(body))
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.body.count(' common\n') > 1000)
+
+    def test_request_too_large(self):
+        self.conf['max_request_size'] = 1024
+        body = [pkt_line('want %s multi_ack_detailed side-band-64k\n' % self.commits[-1]), '0000']
+        body.extend(pkt_line('have %s\n' % commit) for commit in self.commits[:-1])
+        response = self.upload_pack(''.join(body))
+        self.assertEqual(response.code, 413)
+
+if __name__ == '__main__':
+    unittest.main()
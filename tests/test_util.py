@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitTornado.
+#
+# GitTornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitTornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitTornado.  If not, see http://www.gnu.org/licenses
+
+import unittest
+
+from gittornado.util import parse_range_header, etag_matches
+
+class FakeRequest(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+class ParseRangeHeaderTest(unittest.TestCase):
+
+    def test_simple(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range_header('bytes=100-', 1000), (100, 999))
+
+    def test_end_is_clamped(self):
+        self.assertEqual(parse_range_header('bytes=900-5000', 1000), (900, 999))
+
+    def test_suffix(self):
+        self.assertEqual(parse_range_header('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range_header('bytes=-5000', 1000), (0, 999))
+        self.assertEqual(parse_range_header('bytes=-0', 1000), False)
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_range_header('bytes=1000-', 1000), False)
+        self.assertEqual(parse_range_header('bytes=1000-2000', 1000), False)
+
+    def test_empty_entity(self):
+        self.assertEqual(parse_range_header('bytes=0-', 0), False)
+        self.assertEqual(parse_range_header('bytes=0-10', 0), False)
+        self.assertEqual(parse_range_header('bytes=-10', 0), False)
+
+    def test_ignored(self):
+        self.assertEqual(parse_range_header('items=0-10', 1000), None)
+        self.assertEqual(parse_range_header('bytes=0-10,20-30', 1000), None)
+        self.assertEqual(parse_range_header('bytes=10', 1000), None)
+        self.assertEqual(parse_range_header('bytes=a-b', 1000), None)
+        self.assertEqual(parse_range_header('bytes=20-10', 1000), None)
+
+class EtagMatchesTest(unittest.TestCase):
+
+    def test_no_header(self):
+        self.assertFalse(etag_matches(FakeRequest({}), '"abc"'))
+
+    def test_match(self):
+        self.assertTrue(etag_matches(FakeRequest({'If-None-Match': '"abc"'}), '"abc"'))
+        self.assertTrue(etag_matches(FakeRequest({'If-None-Match': '"x", "abc" '}), '"abc"'))
+        self.assertTrue(etag_matches(FakeRequest({'If-None-Match': ' * '}), '"abc"'))
+
+    def test_mismatch(self):
+        self.assertFalse(etag_matches(FakeRequest({'If-None-Match': '"abcd"'}), '"abc"'))
+        self.assertFalse(etag_matches(FakeRequest({'If-None-Match': '"x", "y"'}), '"abc"'))
+
+if __name__ == '__main__':
+    unittest.main()